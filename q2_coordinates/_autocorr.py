@@ -0,0 +1,337 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import multiprocessing as mp
+
+import numpy as np
+from scipy import sparse, stats
+
+
+# number of distance matrix entries that are selected together in one
+# vectorized block
+BLOCK_SIZE = 2 ** 22
+
+KERNELS = ('distance', 'inverse', 'gaussian', 'exponential', 'binary')
+
+TRANSFORMATIONS = ('R', 'B', 'D', 'V', 'O')
+
+# per-process weights and values of the worker pool
+_shared = {}
+
+
+def _row_chunks(n, block_size=BLOCK_SIZE):
+    # (start, stop) bounds of blocks of rows with ~block_size entries each
+    step = max(1, block_size // max(n, 1))
+    return [(start, min(start + step, n)) for start in range(0, n, step)]
+
+
+def _nearest_mask(d, k):
+    # k smallest entries of each row of d, with ties resolved in favor of
+    # the first column
+    kth = np.partition(d, k - 1, axis=1)[:, k - 1:k]
+    closer = d < kth
+    need = k - closer.sum(axis=1, keepdims=True)
+    tied = d == kth
+    return closer | (tied & (np.cumsum(tied, axis=1) <= need))
+
+
+def _validate_kernel(kernel, bandwidth):
+    if kernel not in KERNELS:
+        raise ValueError('Unknown kernel: {0}. Valid options are: {1}'.format(
+            kernel, ', '.join(KERNELS)))
+    if kernel in ('gaussian', 'exponential') and bandwidth is None:
+        raise ValueError(
+            'A bandwidth must be defined for the {0} kernel.'.format(kernel))
+
+
+def kernel_weights(distances, kernel='distance', bandwidth=None, power=1.):
+    """Spatial weights of pairs of samples separated by distances.
+
+    The distance kernel uses the distances themselves as weights, inverse
+    uses distance ** -power, gaussian and exponential decay with distance
+    on the scale of bandwidth, and binary gives all pairs the same weight.
+    Coincident samples have an infinite inverse distance weight.
+    """
+    _validate_kernel(kernel, bandwidth)
+    distances = np.asarray(distances, dtype=float)
+    if kernel == 'distance':
+        return distances
+    elif kernel == 'inverse':
+        with np.errstate(divide='ignore'):
+            return distances ** -power
+    elif kernel == 'gaussian':
+        return np.exp(-0.5 * (distances / bandwidth) ** 2)
+    elif kernel == 'exponential':
+        return np.exp(-distances / bandwidth)
+    return np.ones_like(distances)
+
+
+def sparse_weights(distances, k=None, radius=None, kernel='distance',
+                   bandwidth=None, power=1., block_size=BLOCK_SIZE):
+    """Sparse spatial weights selected from a square distance matrix.
+
+    The neighbours of each sample are all other samples (by default), its
+    k nearest neighbours (if k is given) and/or all samples within radius
+    (if radius is given). Ties in distance are resolved in favor of the
+    first sample. Rows are selected in vectorized blocks of ~block_size
+    entries, so that no dense intermediate of the full matrix is created,
+    and the distances of the selected pairs are converted into weights with
+    kernel (see kernel_weights) in the same pass. Returns a CSR matrix of
+    the weights between neighbours. Pairs with a zero or infinite weight
+    are dropped, so coincident samples are not neighbours under the
+    distance and inverse kernels.
+    """
+    _validate_kernel(kernel, bandwidth)
+    distances = np.asarray(distances, dtype=float)
+    n = distances.shape[0]
+    if distances.shape != (n, n):
+        raise ValueError('Distances must be a square matrix.')
+    if k is not None:
+        k = min(k, n - 1)
+
+    rows, cols, data = [], [], []
+    for start, stop in _row_chunks(n, block_size):
+        d = distances[start:stop].copy()
+        d[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        mask = np.isfinite(d)
+        if k is not None:
+            mask = _nearest_mask(d, k) if k > 0 else np.zeros_like(mask)
+        if radius is not None:
+            mask &= d <= radius
+        i, j = np.nonzero(mask)
+        w = kernel_weights(d[i, j], kernel, bandwidth, power)
+        keep = np.isfinite(w) & (w != 0)
+        rows.append(i[keep] + start)
+        cols.append(j[keep])
+        data.append(w[keep])
+
+    rows, cols, data = (np.concatenate(a) if a else np.array([])
+                        for a in (rows, cols, data))
+    return sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+
+def _scale_rows(weights, scale):
+    # multiply each row of a CSR matrix in place by its entry of scale
+    weights.data *= np.repeat(scale, np.diff(weights.indptr))
+
+
+def _inverse(a):
+    # 1 / a, with 0 where a is 0
+    return np.divide(1., a, out=np.zeros_like(a), where=a != 0)
+
+
+def transform_weights(weights, transformation='R'):
+    """Transformed copy of a sparse spatial weights matrix.
+
+    The transformations are those of libpysal: R divides each row by its
+    sum, B gives all neighbours a weight of 1, D divides all weights by
+    their sum, V divides each row by the square root of its sum of squares
+    and then scales the weights to sum to the number of samples, and O
+    keeps the original weights. Rows without neighbours stay empty.
+    """
+    if transformation not in TRANSFORMATIONS:
+        raise ValueError(
+            'Unknown transformation: {0}. Valid options are: {1}'.format(
+                transformation, ', '.join(TRANSFORMATIONS)))
+    weights = sparse.csr_matrix(weights, dtype=float, copy=True)
+    if transformation == 'B':
+        weights.data[:] = 1.
+    elif transformation == 'R':
+        _scale_rows(weights, _inverse(
+            np.asarray(weights.sum(axis=1)).ravel()))
+    elif transformation == 'D':
+        weights.data *= _inverse(np.array(weights.sum()))
+    elif transformation == 'V':
+        _scale_rows(weights, _inverse(np.sqrt(
+            np.asarray(weights.multiply(weights).sum(axis=1)).ravel())))
+        weights.data *= weights.shape[0] * _inverse(np.array(weights.sum()))
+    return weights
+
+
+def _neighbor_sums(weights):
+    # row sums plus column sums of the weights
+    return np.asarray(weights.sum(axis=0)).ravel() + \
+        np.asarray(weights.sum(axis=1)).ravel()
+
+
+def analytical_statistics(weights, values, two_tailed=True):
+    """Moran's I and Geary's C of values, with their normal approximation.
+
+    weights is the (transformed) sparse spatial weights matrix. Both
+    statistics are computed from the quadratic form z'Wz of the centered
+    values z, as in permutation_statistics, and their variances under the
+    normality assumption from the sums s0, s1 and s2 of the weights, as in
+    esda. The p-value of Moran's I is doubled if two_tailed, the p-value of
+    Geary's C is always one-sided. Returns two tuples of the statistic, its
+    expected value, z-score and p-value, for I and C.
+    """
+    weights = sparse.csr_matrix(weights, dtype=float)
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    z = values - values.mean()
+    ss = (z * z).sum()
+    lag = _neighbor_sums(weights)
+    s0 = weights.sum()
+    s02 = s0 * s0
+    s1 = (weights + weights.T).power(2).sum() / 2
+    s2 = (lag * lag).sum()
+
+    quadratic = z @ (weights @ z)
+    i = n / s0 * quadratic / ss
+    ei = -1. / (n - 1)
+    vi = (n * n * s1 - n * s2 + 3 * s02) / ((n - 1) * (n + 1) * s02) - \
+        ei * ei
+    zi = (i - ei) / np.sqrt(vi)
+    pi = stats.norm.sf(abs(zi)) * (2. if two_tailed else 1.)
+
+    c = (n - 1) * (lag @ z ** 2 - 2 * quadratic) / (2 * s0 * ss)
+    vc = ((2 * s1 + s2) * (n - 1) - 4 * s02) / (2 * (n + 1) * s02)
+    zc = (c - 1.) / np.sqrt(vc)
+    pc = stats.norm.sf(abs(zc))
+    return (i, ei, zi, pi), (c, 1., zc, pc)
+
+
+def _permutation_chunks(permutations, n, block_size=BLOCK_SIZE):
+    # sizes of batches of permutations with ~block_size values each
+    step = max(1, block_size // max(n, 1))
+    return [min(step, permutations - start)
+            for start in range(0, permutations, step)]
+
+
+def _permuted_statistics(weights, z, lag, size, seed_sequence):
+    # quadratic forms z'Wz and neighbor sums of squares of a batch of
+    # random permutations of the centered values z, one per column
+    rng = np.random.default_rng(seed_sequence)
+    batch = rng.permuted(np.tile(z[:, None], (1, size)), axis=0)
+    quadratic = np.einsum('ij,ij->j', batch, weights @ batch)
+    return quadratic, lag @ batch ** 2
+
+
+def _to_shared(a):
+    # copy of array a in shared memory, with its dtype to read it back
+    buffer = mp.RawArray(np.ctypeslib.as_ctypes_type(a.dtype), a.size)
+    np.frombuffer(buffer, dtype=a.dtype)[:] = a
+    return buffer, a.dtype
+
+
+def _from_shared(buffer, dtype):
+    return np.frombuffer(buffer, dtype=dtype)
+
+
+def _init_worker(data, indices, indptr, z, lag):
+    n = len(lag)
+    _shared['weights'] = sparse.csr_matrix(
+        (_from_shared(*data), _from_shared(*indices), _from_shared(*indptr)),
+        shape=(n, n), copy=False)
+    _shared['z'] = z
+    _shared['lag'] = lag
+
+
+def _shared_permuted_statistics(chunk):
+    return _permuted_statistics(
+        _shared['weights'], _shared['z'], _shared['lag'], *chunk)
+
+
+def _exceedances(simulated, statistic):
+    # running number of simulated values in the smaller tail of statistic,
+    # as in the pseudo p-values of simulated_inference
+    above = np.cumsum(simulated >= statistic)
+    return np.minimum(above, np.arange(1, len(simulated) + 1) - above)
+
+
+def _collect(batches, n, s0, ss, observed, min_exceedances):
+    # convert the batches into permuted statistics, until both statistics
+    # have at least min_exceedances exceedances of observed
+    moran, geary = [], []
+    for quadratic, squares in batches:
+        moran.append(n / s0 * quadratic / ss)
+        geary.append((n - 1) * (squares - 2 * quadratic) / (2 * s0 * ss))
+        if min_exceedances is not None:
+            # exceedances never decrease, so the sequence stops at the
+            # first permutation where the rarer statistic reaches the limit
+            exceedances = np.minimum(
+                _exceedances(np.concatenate(moran), observed[0]),
+                _exceedances(np.concatenate(geary), observed[1]))
+            stop = np.searchsorted(exceedances, min_exceedances) + 1
+            if stop <= len(exceedances):
+                return np.concatenate(moran)[:stop], \
+                    np.concatenate(geary)[:stop]
+    if not moran:
+        return np.array([]), np.array([])
+    return np.concatenate(moran), np.concatenate(geary)
+
+
+def permutation_statistics(weights, values, permutations, seed=None,
+                           n_jobs=1, observed=None, min_exceedances=None,
+                           block_size=BLOCK_SIZE):
+    """Moran's I and Geary's C of random permutations of values.
+
+    weights is the (transformed) sparse spatial weights matrix. The
+    permutations are drawn and evaluated in batches of ~block_size values,
+    each with its own random stream spawned from seed, so that the results
+    only depend on seed, the number of permutations and block_size. Both
+    statistics share the quadratic form z'Wz of each permuted vector z of
+    centered values, computed for a whole batch with one sparse-dense
+    matrix product; Geary's C follows from the identity
+    sum_ij w_ij (z_i - z_j) ** 2 = sum_i (r_i + c_i) z_i ** 2 - 2 z'Wz, with
+    row and column sums r and c. Returns two arrays of the permuted I and C.
+
+    With min_exceedances, permutations stop early (Besag & Clifford, 1991)
+    at the first permutation where both statistics have min_exceedances
+    permuted values in the smaller tail of the observed (I, C), and only
+    the permutations up to that point are returned. permutations is then
+    the maximum budget, which is used in full by significant results.
+
+    With n_jobs > 1 the batches are distributed over a process pool, and
+    workers read the weights from shared memory. Batches and their random
+    streams do not depend on n_jobs, so the output is identical to the
+    serial result.
+    """
+    if min_exceedances is not None and observed is None:
+        raise ValueError('The observed statistics must be defined to stop '
+                         'permutations early.')
+    weights = sparse.csr_matrix(weights, dtype=float)
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    z = values - values.mean()
+    s0 = weights.sum()
+    ss = (z * z).sum()
+    lag = _neighbor_sums(weights)
+
+    sizes = _permutation_chunks(permutations, n, block_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if n_jobs == 1 or len(sizes) < 2:
+        batches = (_permuted_statistics(weights, z, lag, size, seed_sequence)
+                   for size, seed_sequence in zip(sizes, seeds))
+        return _collect(batches, n, s0, ss, observed, min_exceedances)
+    shared = [_to_shared(a)
+              for a in (weights.data, weights.indices, weights.indptr)]
+    # batches are consumed in order, and outstanding batches are discarded
+    # when the pool terminates after an early stop
+    with mp.Pool(min(n_jobs, len(sizes)), initializer=_init_worker,
+                 initargs=(*shared, z, lag)) as pool:
+        batches = pool.imap(_shared_permuted_statistics,
+                            list(zip(sizes, seeds)), chunksize=1)
+        return _collect(batches, n, s0, ss, observed, min_exceedances)
+
+
+def simulated_inference(statistic, simulated, permutations=None):
+    """Mean, z-score and pseudo p-value of statistic among simulated values.
+
+    The pseudo p-value is one-sided, in the direction of the tail with
+    fewer simulated values than statistic, as in esda. If fewer values than
+    the budget of permutations were simulated (after an early stop), the
+    p-value is the Besag & Clifford estimate exceedances / simulations.
+    """
+    used = len(simulated)
+    larger = _exceedances(simulated, statistic)[-1]
+    mean = simulated.mean()
+    z = (statistic - mean) / simulated.std()
+    if permutations is not None and used < permutations:
+        return mean, z, larger / used
+    return mean, z, (larger + 1.) / (used + 1.)
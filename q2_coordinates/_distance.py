@@ -0,0 +1,482 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import multiprocessing as mp
+
+import numpy as np
+from geopy import distance
+from scipy.spatial import cKDTree
+
+
+# WGS-84 ellipsoid (in meters), the default used by geopy's geodesic distance
+_A, _B, _F = distance.ELLIPSOIDS['WGS-84']
+_A, _B = _A * 1000, _B * 1000
+
+# mean earth radius (in meters) used by geopy's great-circle distance
+_R = distance.EARTH_RADIUS * 1000
+
+# number of pairs that are computed together in one vectorized block
+BLOCK_SIZE = 2 ** 20
+
+# convergence criteria for Vincenty's iteration on lambda (~0.006 mm)
+_MAX_ITERATIONS = 200
+_TOLERANCE = 1e-12
+
+# upper bound of the relative difference between spherical (mean earth
+# radius) and ellipsoidal distances, used to widen spatial index queries
+_SPHERICAL_TOLERANCE = 0.006
+
+# maximum number of pairs used to estimate the error of spherical distances
+ERROR_PAIRS = 10000
+
+# per-process inputs and output buffer of the worker pool
+_shared = {}
+
+
+def _validate_latitude(latitude):
+    if np.any(np.abs(latitude) > 90):
+        raise ValueError('Latitude must be in the [-90; 90] range.')
+
+
+def _as_coordinates(latitude, longitude):
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    _validate_latitude(latitude)
+    return latitude, longitude
+
+
+def _row_offset(row, n):
+    # position of the first pair (row, row + 1) in the condensed vector
+    return row * (2 * n - row - 1) // 2
+
+
+def _row_blocks(n, block_size=BLOCK_SIZE):
+    """Split the rows of the upper triangle into blocks of ~block_size pairs.
+
+    Returns a list of (start, stop) row bounds. Each block covers the
+    contiguous slice of the condensed vector between the row offsets of
+    start and stop. Block bounds only depend on n and block_size.
+    """
+    if n < 2:
+        return []
+    ends = np.cumsum(np.arange(n - 1, 0, -1))
+    targets = np.arange(block_size, ends[-1], block_size)
+    stops = np.searchsorted(ends, targets, side='left') + 1
+    stops = np.unique(np.append(stops, n - 1))
+    starts = np.concatenate([[0], stops[:-1]])
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def _block_pairs(n, start, stop):
+    # row and column indices of all pairs (i, j > i) for rows start:stop,
+    # in condensed order
+    rows = np.arange(start, stop)
+    counts = n - 1 - rows
+    i = np.repeat(rows, counts)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    j = np.arange(counts.sum()) - offsets + i + 1
+    return i, j
+
+
+def vincenty(lat1, lon1, lat2, lon2):
+    """Inverse geodesic distances (in meters) on the WGS-84 ellipsoid.
+
+    Vectorized implementation of Vincenty's (1975) inverse formula. Each
+    pair is iterated until its own convergence and is left untouched
+    afterwards, so the distance of a pair does not depend on which other
+    pairs are computed alongside it. Results agree with geopy's geodesic
+    distance (Karney 2013) to within 1 mm. Nearly antipodal pairs, for which
+    Vincenty's iteration does not converge, fall back to geopy.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.asarray(c, dtype=float) for c in (lat1, lon1, lat2, lon2))
+    L = np.radians(lon2 - lon1)
+    L = (L + np.pi) % (2 * np.pi) - np.pi
+    U1 = np.arctan((1 - _F) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - _F) * np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    sin_sigma = np.zeros_like(L)
+    cos_sigma = np.ones_like(L)
+    sigma = np.zeros_like(L)
+    cos2_alpha = np.ones_like(L)
+    cos_2sigma_m = np.zeros_like(L)
+
+    active = np.arange(L.size)
+    for _ in range(_MAX_ITERATIONS):
+        if active.size == 0:
+            break
+        lam_ = lam[active]
+        sU1, cU1 = sinU1[active], cosU1[active]
+        sU2, cU2 = sinU2[active], cosU2[active]
+        sin_lam, cos_lam = np.sin(lam_), np.cos(lam_)
+
+        ss = np.sqrt((cU2 * sin_lam) ** 2 +
+                     (cU1 * sU2 - sU1 * cU2 * cos_lam) ** 2)
+        cs = sU1 * sU2 + cU1 * cU2 * cos_lam
+        sg = np.arctan2(ss, cs)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # coincident points
+            sa = np.where(ss == 0, 0., cU1 * cU2 * sin_lam / ss)
+            c2a = 1 - sa ** 2
+            # equatorial lines
+            c2sm = np.where(c2a == 0, 0., cs - 2 * sU1 * sU2 / c2a)
+        C = _F / 16 * c2a * (4 + _F * (4 - 3 * c2a))
+        lam_new = L[active] + (1 - C) * _F * sa * (
+            sg + C * ss * (c2sm + C * cs * (-1 + 2 * c2sm ** 2)))
+
+        sin_sigma[active], cos_sigma[active], sigma[active] = ss, cs, sg
+        cos2_alpha[active], cos_2sigma_m[active] = c2a, c2sm
+        lam[active] = lam_new
+        active = active[np.abs(lam_new - lam_) > _TOLERANCE]
+
+    u2 = cos2_alpha * (_A ** 2 - _B ** 2) / _B ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+        B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) *
+        (-3 + 4 * cos_2sigma_m ** 2)))
+    s = _B * A * (sigma - delta_sigma)
+
+    for k in active:
+        s[k] = distance.geodesic(
+            (lat1[k], lon1[k]), (lat2[k], lon2[k])).meters
+
+    return s
+
+
+def great_circle(lat1, lon1, lat2, lon2):
+    """Great-circle distances (in meters) on a sphere of mean earth radius.
+
+    Uses the same (Vincenty's spherical) formula as geopy's great-circle
+    distance, which is well-conditioned for all distances.
+    """
+    phi1, lam1, phi2, lam2 = (
+        np.radians(c, dtype=float) for c in (lat1, lon1, lat2, lon2))
+    sin_phi1, cos_phi1 = np.sin(phi1), np.cos(phi1)
+    sin_phi2, cos_phi2 = np.sin(phi2), np.cos(phi2)
+    sin_dlam, cos_dlam = np.sin(lam2 - lam1), np.cos(lam2 - lam1)
+    d = np.arctan2(
+        np.sqrt((cos_phi2 * sin_dlam) ** 2 +
+                (cos_phi1 * sin_phi2 - sin_phi1 * cos_phi2 * cos_dlam) ** 2),
+        sin_phi1 * sin_phi2 + cos_phi1 * cos_phi2 * cos_dlam)
+    return _R * d
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Haversine distances (in meters) on a sphere of mean earth radius."""
+    phi1, lam1, phi2, lam2 = (
+        np.radians(c, dtype=float) for c in (lat1, lon1, lat2, lon2))
+    h = (np.sin((phi2 - phi1) / 2) ** 2 +
+         np.cos(phi1) * np.cos(phi2) * np.sin((lam2 - lam1) / 2) ** 2)
+    return 2 * _R * np.arcsin(np.sqrt(np.minimum(h, 1)))
+
+
+METRICS = {'geodesic': vincenty,
+           'great-circle': great_circle,
+           'haversine': haversine}
+
+
+def _validate_metric(metric):
+    if metric not in METRICS:
+        raise ValueError('Unknown metric "{0}". Valid options are: {1}'
+                         .format(metric, ', '.join(METRICS)))
+
+
+def _pair_distances(metric, lat1, lon1, lat2, lon2):
+    # evaluate each pair in a canonical (lexicographic) order so that the
+    # distance of two points does not depend on their order in the input
+    swap = (lat1 > lat2) | ((lat1 == lat2) & (lon1 > lon2))
+    lat1, lat2 = np.where(swap, lat2, lat1), np.where(swap, lat1, lat2)
+    lon1, lon2 = np.where(swap, lon2, lon1), np.where(swap, lon1, lon2)
+    return METRICS[metric](lat1, lon1, lat2, lon2)
+
+
+def _fill_block(metric, latitude, longitude, distances, start, stop):
+    n = len(latitude)
+    i, j = _block_pairs(n, start, stop)
+    distances[_row_offset(start, n):_row_offset(stop, n)] = _pair_distances(
+        metric, latitude[i], longitude[i], latitude[j], longitude[j])
+
+
+def _init_worker(metric, latitude, longitude, buffer):
+    _shared['metric'] = metric
+    _shared['latitude'] = latitude
+    _shared['longitude'] = longitude
+    _shared['distances'] = np.frombuffer(buffer)
+
+
+def _fill_shared_block(block):
+    _fill_block(_shared['metric'], _shared['latitude'], _shared['longitude'],
+                _shared['distances'], *block)
+
+
+def geodesic_pdist(latitude, longitude, metric='geodesic', n_jobs=1,
+                   block_size=BLOCK_SIZE):
+    """Condensed pairwise distances (in meters) between geocoordinates.
+
+    metric is one of METRICS: ellipsoidal "geodesic" distances, or the
+    spherical "great-circle" and "haversine" approximations, which are much
+    faster and deviate from geodesic distances by at most ~0.5%.
+
+    The condensed vector is filled in vectorized blocks of about block_size
+    pairs, so memory use beyond the output itself stays bounded. With
+    n_jobs > 1 the blocks are distributed over a process pool, and workers
+    write directly into a shared-memory condensed buffer. Blocks do not
+    depend on n_jobs, so the output is identical to the serial result.
+    """
+    _validate_metric(metric)
+    latitude, longitude = _as_coordinates(latitude, longitude)
+
+    n = len(latitude)
+    blocks = _row_blocks(n, block_size)
+    if n_jobs == 1 or len(blocks) < 2:
+        distances = np.empty(n * (n - 1) // 2)
+        for start, stop in blocks:
+            _fill_block(metric, latitude, longitude, distances, start, stop)
+    else:
+        buffer = mp.RawArray('d', n * (n - 1) // 2)
+        with mp.Pool(min(n_jobs, len(blocks)), initializer=_init_worker,
+                     initargs=(metric, latitude, longitude, buffer)) as pool:
+            pool.map(_fill_shared_block, blocks, chunksize=1)
+        distances = np.frombuffer(buffer)
+
+    return distances
+
+
+def paired_distances(latitude_a, longitude_a, latitude_b, longitude_b,
+                     metric='geodesic'):
+    """Distances (in meters) between corresponding points of two sets."""
+    _validate_metric(metric)
+    latitude_a, longitude_a = _as_coordinates(latitude_a, longitude_a)
+    latitude_b, longitude_b = _as_coordinates(latitude_b, longitude_b)
+    return _pair_distances(
+        metric, latitude_a, longitude_a, latitude_b, longitude_b)
+
+
+def geodesic_cdist(latitude_a, longitude_a, latitude_b, longitude_b,
+                   metric='geodesic', block_size=BLOCK_SIZE):
+    """Distances (in meters) between two sets of geocoordinates.
+
+    Returns an (m, n) array for m points in set a and n points in set b,
+    computed in vectorized blocks of about block_size pairs.
+    """
+    _validate_metric(metric)
+    latitude_a, longitude_a = _as_coordinates(latitude_a, longitude_a)
+    latitude_b, longitude_b = _as_coordinates(latitude_b, longitude_b)
+
+    m, n = len(latitude_a), len(latitude_b)
+    distances = np.empty((m, n))
+    rows = max(block_size // max(n, 1), 1)
+    for start in range(0, m, rows):
+        stop = min(start + rows, m)
+        i = np.repeat(np.arange(start, stop), n)
+        j = np.tile(np.arange(n), stop - start)
+        distances[start:stop] = _pair_distances(
+            metric, latitude_a[i], longitude_a[i],
+            latitude_b[j], longitude_b[j]).reshape(stop - start, n)
+    return distances
+
+
+def _expand_pdist(site_distances, inverse, block_size=BLOCK_SIZE):
+    # gather condensed distances between points from the condensed
+    # distances between the unique sites they belong to
+    n, m = len(inverse), int(inverse.max()) + 1 if len(inverse) else 0
+    distances = np.zeros(n * (n - 1) // 2)
+    if m < 2:
+        return distances
+    for start, stop in _row_blocks(n, block_size):
+        i, j = _block_pairs(n, start, stop)
+        lo = np.minimum(inverse[i], inverse[j])
+        hi = np.maximum(inverse[i], inverse[j])
+        # pairs from the same site (lo == hi) are masked below
+        k = _row_offset(lo, m) + hi - lo - 1
+        distances[_row_offset(start, n):_row_offset(stop, n)] = np.where(
+            lo == hi, 0., site_distances[k])
+    return distances
+
+
+def deduplicated_pdist(coordinates, pdist, block_size=BLOCK_SIZE):
+    """Condensed pairwise distances, computed once per unique site.
+
+    coordinates is an (n, d) array of point coordinates, and pdist a
+    function returning the condensed distances of an (m, d) array. Points
+    with identical coordinates are collapsed into unique sites, distances
+    are computed between sites only, and expanded back to all points by
+    index gathering. For replicated sampling sites this reduces the number
+    of distance computations quadratically. The result is identical to
+    pdist(coordinates) as long as pdist does not depend on point order.
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    sites, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+    if len(sites) == len(coordinates):
+        return pdist(coordinates)
+    return _expand_pdist(pdist(sites), inverse.ravel(), block_size)
+
+
+def _unit_vectors(latitude, longitude):
+    phi, lam = np.radians(latitude), np.radians(longitude)
+    return np.column_stack(
+        [np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)])
+
+
+def _arc(chord):
+    # spherical distance (in meters) of a chord on the unit sphere
+    return 2 * _R * np.arcsin(np.minimum(chord / 2, 1))
+
+
+def _search_chord(d):
+    # chord on the unit sphere that contains all points within distance d
+    # (in meters) under any of METRICS
+    theta = np.minimum(d / (1 - _SPHERICAL_TOLERANCE) / _R, np.pi)
+    return 2 * np.sin(theta / 2)
+
+
+def neighbor_pairs(latitude, longitude, k=None, radius=None,
+                   metric='geodesic'):
+    """Near neighbours of all points and their distances (in meters).
+
+    For every point, finds its k nearest neighbours (if k is given) and/or
+    all neighbours within radius meters (if radius is given). Returns
+    arrays of point indices, neighbour indices and distances, ordered by
+    point and increasing distance. Candidates are found with a KD-tree over
+    3D unit vectors in O(n log n), using search radii widened by the
+    maximum spherical error, and then measured exactly with metric.
+    """
+    _validate_metric(metric)
+    if k is None and radius is None:
+        raise ValueError('Either k or radius must be defined.')
+    latitude, longitude = _as_coordinates(latitude, longitude)
+
+    n = len(latitude)
+    points = _unit_vectors(latitude, longitude)
+    tree = cKDTree(points)
+    if k is None:
+        pairs = tree.query_pairs(_search_chord(radius), output_type='ndarray')
+        i = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        j = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    else:
+        k = min(k, n - 1)
+        if k < 1:
+            i = j = np.array([], dtype=int)
+        else:
+            # at least k neighbours lie within the spherical distance of the
+            # (k + 1)th nearest point (including the point itself), which
+            # bounds the distance of the k nearest neighbours under metric
+            chords, _ = tree.query(points, k=k + 1)
+            bound = _arc(chords[:, -1]) * (1 + _SPHERICAL_TOLERANCE)
+            if radius is not None:
+                bound = np.minimum(bound, radius)
+            candidates = tree.query_ball_point(points, _search_chord(bound))
+            i = np.repeat(np.arange(n), [len(c) for c in candidates])
+            j = np.concatenate(candidates).astype(int)
+            i, j = i[i != j], j[i != j]
+
+    d = _pair_distances(metric, latitude[i], longitude[i],
+                        latitude[j], longitude[j])
+    if radius is not None:
+        i, j, d = i[d <= radius], j[d <= radius], d[d <= radius]
+    order = np.lexsort((j, d, i))
+    i, j, d = i[order], j[order], d[order]
+    if k is not None:
+        # rank of each neighbour within the neighbours of its point
+        starts = np.searchsorted(i, i, side='left')
+        keep = np.arange(len(i)) - starts < k
+        i, j, d = i[keep], j[keep], d[keep]
+
+    return i, j, d
+
+
+def nearest_reference(latitude_a, longitude_a, latitude_b, longitude_b,
+                      metric='geodesic'):
+    """Nearest point in set b of each point in set a.
+
+    Returns the indices of the nearest points in b and their distances (in
+    meters), without computing the full (m, n) distance block. Candidates
+    are found with a KD-tree over 3D unit vectors of set b, using search
+    radii widened by the maximum spherical error, and then measured exactly
+    with metric. Ties are resolved in favor of the first point in b.
+    """
+    _validate_metric(metric)
+    latitude_a, longitude_a = _as_coordinates(latitude_a, longitude_a)
+    latitude_b, longitude_b = _as_coordinates(latitude_b, longitude_b)
+
+    points = _unit_vectors(latitude_a, longitude_a)
+    tree = cKDTree(_unit_vectors(latitude_b, longitude_b))
+    chords, _ = tree.query(points, k=1)
+    bound = _arc(chords) * (1 + _SPHERICAL_TOLERANCE)
+    candidates = tree.query_ball_point(points, _search_chord(bound))
+    i = np.repeat(np.arange(len(points)), [len(c) for c in candidates])
+    j = np.concatenate(candidates).astype(int)
+
+    d = _pair_distances(metric, latitude_a[i], longitude_a[i],
+                        latitude_b[j], longitude_b[j])
+    order = np.lexsort((j, d, i))
+    first = order[np.searchsorted(i[order], np.arange(len(points)))]
+    return j[first], d[first]
+
+
+def anchor_points(latitude, longitude):
+    """Indices of up to three points that fix the positions of all others.
+
+    The first point is always an anchor. The second is the point furthest
+    from the plane of the first point and the earth's center, and the third
+    the point furthest from the great circle through the first two. A point
+    on the sphere is determined by its distances to three anchors that do
+    not share a great circle. Fewer anchors are returned if all points
+    coincide or lie on a single great circle.
+    """
+    latitude, longitude = _as_coordinates(latitude, longitude)
+    if len(latitude) == 0:
+        return np.array([], dtype=int)
+    points = _unit_vectors(latitude, longitude)
+    anchors = [0]
+    sines = np.linalg.norm(np.cross(points[0], points), axis=1)
+    if sines.max() > _TOLERANCE:
+        anchors.append(int(sines.argmax()))
+        normal = np.cross(points[0], points[anchors[1]])
+        heights = np.abs(points @ normal)
+        if heights.max() > _TOLERANCE:
+            anchors.append(int(heights.argmax()))
+    return np.array(anchors)
+
+
+def _condensed_pairs(index, n):
+    # row and column indices of positions in a condensed vector
+    index = np.asarray(index)
+    rows = np.arange(n)
+    i = np.searchsorted(_row_offset(rows, n), index, side='right') - 1
+    j = index - _row_offset(i, n) + i + 1
+    return i, j
+
+
+def max_relative_error(latitude, longitude, distances,
+                       max_pairs=ERROR_PAIRS):
+    """Maximum relative error of distances against geodesic distances.
+
+    All pairs are compared if there are at most max_pairs of them,
+    otherwise max_pairs pairs evenly spread over the condensed vector.
+    Coincident points are ignored. Returns the error and number of pairs.
+    """
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    distances = np.asarray(distances)
+    if distances.size > max_pairs:
+        index = np.linspace(0, distances.size - 1, max_pairs).astype(int)
+    else:
+        index = np.arange(distances.size)
+    i, j = _condensed_pairs(index, len(latitude))
+    exp = vincenty(latitude[i], longitude[i], latitude[j], longitude[j])
+    nonzero = exp > 0
+    if not nonzero.any():
+        return 0., index.size
+    error = np.abs(distances[index][nonzero] - exp[nonzero]) / exp[nonzero]
+    return error.max(), index.size
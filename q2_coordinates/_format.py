@@ -9,6 +9,9 @@
 import qiime2.plugin.model as model
 from qiime2.plugin import ValidationError
 import csv
+import zipfile
+
+import numpy as np
 
 
 def _validate_record_min_len(cells, current_line_number, exp_len):
@@ -91,3 +94,100 @@ class QuadTreeFormat(model.TextFileFormat):
 QuadTreeDirectoryFormat = model.SingleFileDirectoryFormat(
     'QuadTreeDirectoryFormat', 'quadtree.tsv',
     QuadTreeFormat)
+
+
+class SpatialNeighborsFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        n_records = {'min': 10, 'max': None}[level]
+        with self.open() as fh:
+            fh_ = csv.reader(fh, delimiter='\t')
+            header = next(fh_, None)
+            if header is None or len(header) != 3:
+                raise ValidationError(
+                    'Expected a header line with 3 columns (sample ID, '
+                    'neighbor ID, distance). Found: {0!r}'.format(header))
+
+            for line_number, cells in enumerate(fh_, start=2):
+                if len(cells) != 3:
+                    raise ValidationError(
+                        'Line {0} has {1} cells ({2!r}), expected 3.'
+                        .format(line_number, len(cells), cells))
+                try:
+                    float(cells[2])
+                except ValueError:
+                    raise ValidationError(
+                        'Expected distances to be float values. Found '
+                        'non-float value {0} at line {1}'
+                        .format(cells[2], line_number))
+                if n_records is not None and (line_number - 1) >= n_records:
+                    break
+
+
+SpatialNeighborsDirectoryFormat = model.SingleFileDirectoryFormat(
+    'SpatialNeighborsDirectoryFormat', 'neighbors.tsv',
+    SpatialNeighborsFormat)
+
+
+class SpatialIndexFormat(model.BinaryFileFormat):
+    POINT_ARRAYS = ('sample_ids', 'x', 'y', 'order')
+    NODE_ARRAYS = ('start', 'stop', 'first_child', 'n_children')
+    FIELDS = ('x_coord', 'y_coord', 'index_name', 'bounds')
+
+    def _validate_(self, level):
+        try:
+            data = np.load(str(self), allow_pickle=False)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            raise ValidationError('Expected an index stored as a NumPy .npz '
+                                  'archive.')
+        with data:
+            missing = [name for name in
+                       self.POINT_ARRAYS + self.NODE_ARRAYS + self.FIELDS
+                       if name not in data.files]
+            if missing:
+                raise ValidationError(
+                    'Missing arrays in spatial index: %s' % ', '.join(missing))
+            if level == 'min':
+                return
+            for arrays, label in ((self.POINT_ARRAYS, 'points'),
+                                  (self.NODE_ARRAYS + ('bounds',), 'nodes')):
+                lengths = {name: len(data[name]) for name in arrays}
+                if len(set(lengths.values())) != 1:
+                    raise ValidationError(
+                        'Expected arrays of %s to have the same length. '
+                        'Found: %r' % (label, lengths))
+
+
+SpatialIndexDirectoryFormat = model.SingleFileDirectoryFormat(
+    'SpatialIndexDirectoryFormat', 'index.npz', SpatialIndexFormat)
+
+
+class BinStatisticsFormat(model.TextFileFormat):
+    REQUIRED = ('lineage', 'depth', 'count')
+
+    def _validate_(self, level):
+        n_records = {'min': 10, 'max': None}[level]
+        with self.open() as fh:
+            fh_ = csv.reader(fh, delimiter='\t')
+            header = next(fh_, None)
+            if header is None or tuple(header[:3]) != self.REQUIRED:
+                raise ValidationError(
+                    'Expected a header line starting with the columns '
+                    '{0}. Found: {1!r}'.format(', '.join(self.REQUIRED),
+                                               header))
+
+            for line_number, cells in enumerate(fh_, start=2):
+                if len(cells) != len(header):
+                    raise ValidationError(
+                        'Line {0} has {1} cells ({2!r}), expected {3}.'
+                        .format(line_number, len(cells), cells, len(header)))
+                if not cells[2].isdigit():
+                    raise ValidationError(
+                        'Expected sample counts to be integers. Found {0} '
+                        'at line {1}'.format(cells[2], line_number))
+                if n_records is not None and (line_number - 1) >= n_records:
+                    break
+
+
+BinStatisticsDirectoryFormat = model.SingleFileDirectoryFormat(
+    'BinStatisticsDirectoryFormat', 'bin-statistics.tsv',
+    BinStatisticsFormat)
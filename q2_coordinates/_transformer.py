@@ -9,7 +9,10 @@
 import pandas as pd
 import qiime2
 from .plugin_setup import plugin
-from ._format import CoordinatesFormat, QuadTreeFormat
+from ._format import (CoordinatesFormat, QuadTreeFormat,
+                      SpatialNeighborsFormat, SpatialIndexFormat,
+                      BinStatisticsFormat)
+from .qtrees import QuadTreeIndex
 
 
 def _read_dataframe(fh):
@@ -64,3 +67,62 @@ def _5(ff: QuadTreeFormat) -> pd.DataFrame:
 def _6(ff: QuadTreeFormat) -> qiime2.Metadata:
     with ff.open() as fh:
         return qiime2.Metadata(_read_dataframe(fh))
+
+
+@plugin.register_transformer
+def _7(data: pd.DataFrame) -> SpatialNeighborsFormat:
+    ff = SpatialNeighborsFormat()
+    with ff.open() as fh:
+        data.to_csv(fh, sep='\t', header=True, index=False)
+    return ff
+
+
+@plugin.register_transformer
+def _8(ff: SpatialNeighborsFormat) -> pd.DataFrame:
+    with ff.open() as fh:
+        df = pd.read_csv(fh, sep='\t', header=0, dtype=object)
+        df[df.columns[2]] = pd.to_numeric(df[df.columns[2]])
+        return df
+
+
+@plugin.register_transformer
+def _9(data: QuadTreeIndex) -> SpatialIndexFormat:
+    ff = SpatialIndexFormat()
+    with ff.open() as fh:
+        data.save(fh)
+    return ff
+
+
+@plugin.register_transformer
+def _10(ff: SpatialIndexFormat) -> QuadTreeIndex:
+    with ff.open() as fh:
+        return QuadTreeIndex.load(fh)
+
+
+@plugin.register_transformer
+def _11(data: pd.DataFrame) -> BinStatisticsFormat:
+    ff = BinStatisticsFormat()
+    with ff.open() as fh:
+        data.to_csv(fh, sep='\t', header=True, index=True)
+    return ff
+
+
+def _read_bin_statistics(fh):
+    df = pd.read_csv(fh, sep='\t', header=0, index_col=0,
+                     dtype={'lineage': object})
+    return df
+
+
+@plugin.register_transformer
+def _12(ff: BinStatisticsFormat) -> pd.DataFrame:
+    with ff.open() as fh:
+        return _read_bin_statistics(fh)
+
+
+@plugin.register_transformer
+def _13(ff: BinStatisticsFormat) -> qiime2.Metadata:
+    with ff.open() as fh:
+        df = _read_bin_statistics(fh)
+        # lineages are the IDs of the bins
+        df.index.name = 'id'
+        return qiime2.Metadata(df)
@@ -13,3 +13,6 @@ from q2_types.sample_data import SampleData
 Coordinates = SemanticType('Coordinates', variant_of=SampleData.field['type'])
 QuadTree = SemanticType('QuadTree',
                         variant_of=SampleData.field['type'])
+SpatialNeighbors = SemanticType('SpatialNeighbors')
+SpatialIndex = SemanticType('SpatialIndex')
+BinStatistics = SemanticType('BinStatistics')
@@ -7,6 +7,8 @@
 # ----------------------------------------------------------------------------
 
 
+import warnings
+
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import matplotlib.cm as cm
@@ -15,10 +17,13 @@ import matplotlib.colors as mcolors
 import matplotlib.patches as mpatch
 import qiime2
 import scipy
+import pandas as pd
 
 from skbio import DistanceMatrix
-from geopy import distance, Point
 
+from ._distance import (geodesic_pdist, geodesic_cdist, deduplicated_pdist,
+                        max_relative_error, neighbor_pairs, nearest_reference,
+                        anchor_points)
 from ._utilities import (plot_basemap,
                          save_map,
                          mapviz,
@@ -30,24 +35,196 @@ from ._utilities import (plot_basemap,
 def geodesic_distance(metadata: qiime2.Metadata,
                       latitude: str = 'Latitude',
                       longitude: str = 'Longitude',
-                      missing_data: str = 'error') -> DistanceMatrix:
+                      missing_data: str = 'error',
+                      metric: str = 'geodesic',
+                      n_jobs: int = 1) -> DistanceMatrix:
     sample_md = _load_and_validate(
         metadata, [latitude, longitude], ['latitude', 'longitude'],
         missing_data=missing_data)
 
-    # Collect geocoordinate points
-    points = [Point(x) for x in zip(sample_md[latitude], sample_md[longitude])]
+    # Compute pairwise distances between all unique sites
+    def pdist(sites):
+        return geodesic_pdist(
+            sites[:, 0], sites[:, 1], metric=metric, n_jobs=n_jobs)
+
+    distances = deduplicated_pdist(
+        sample_md[[latitude, longitude]].values, pdist)
+
+    # Report the error of spherical approximations on this dataset
+    if metric != 'geodesic':
+        error, n_pairs = max_relative_error(
+            sample_md[latitude], sample_md[longitude], distances)
+        warnings.warn(
+            'Estimated maximum relative error of {0} distances against '
+            'geodesic distances: {1:.4%} (sampled from {2} sample '
+            'pairs).'.format(metric, error, n_pairs), UserWarning)
+
+    dm = DistanceMatrix(distances, ids=sample_md.index)
+
+    return dm
+
 
-    # Compute pairwise distances between all points
-    def distance_function(a, b):
-        return distance.geodesic(a, b).meters
+def update_geodesic_distance(distance_matrix: DistanceMatrix,
+                             metadata: qiime2.Metadata,
+                             latitude: str = 'Latitude',
+                             longitude: str = 'Longitude',
+                             missing_data: str = 'error',
+                             metric: str = 'geodesic',
+                             n_jobs: int = 1) -> DistanceMatrix:
+    sample_md = _load_and_validate(
+        metadata, [latitude, longitude], ['latitude', 'longitude'],
+        missing_data=missing_data)
 
-    dm = DistanceMatrix.from_iterable(
-        points, metric=distance_function, keys=sample_md.index)
+    old_ids = list(distance_matrix.ids)
+    missing_ids = set(old_ids).difference(sample_md.index)
+    if len(missing_ids) > 0:
+        raise ValueError(
+            'Samples found in the distance matrix are missing from the '
+            'sample metadata. Missing IDs: {0}'.format(missing_ids))
+    old_md = sample_md.loc[old_ids]
+    new_md = sample_md[~sample_md.index.isin(old_ids)]
+
+    # Check that shared samples have not moved, by recomputing distances
+    # from every existing sample to up to three anchor samples that do not
+    # share a great circle
+    anchors = anchor_points(old_md[latitude], old_md[longitude])
+    observed = distance_matrix.data[:, anchors]
+    expected = geodesic_cdist(
+        old_md[latitude], old_md[longitude],
+        old_md[latitude].iloc[anchors], old_md[longitude].iloc[anchors],
+        metric=metric)
+    mismatched = ~np.isclose(observed, expected, rtol=1e-7, atol=1e-3)
+    if mismatched.any():
+        rows, columns = np.nonzero(mismatched)
+        changed = {old_ids[i] for i in rows}.union(
+            old_ids[anchors[j]] for j in columns)
+        raise ValueError(
+            'Distances in the distance matrix do not match the sample '
+            'metadata. Check that the coordinates of samples in the '
+            'distance matrix have not changed, and that the distance matrix '
+            'was computed with the "{0}" metric. Mismatched distances '
+            'involve samples: {1}'.format(metric, changed))
+
+    # Compute only distances that involve new samples
+    cross = geodesic_cdist(
+        new_md[latitude], new_md[longitude],
+        old_md[latitude], old_md[longitude], metric=metric)
+
+    def pdist(sites):
+        return geodesic_pdist(
+            sites[:, 0], sites[:, 1], metric=metric, n_jobs=n_jobs)
+
+    new = deduplicated_pdist(new_md[[latitude, longitude]].values, pdist)
+
+    n = len(old_ids)
+    data = np.empty((n + len(new_md), n + len(new_md)))
+    data[:n, :n] = distance_matrix.data
+    data[n:, :n] = cross
+    data[:n, n:] = cross.T
+    data[n:, n:] = scipy.spatial.distance.squareform(new)
+
+    dm = DistanceMatrix(data, ids=old_ids + list(new_md.index))
 
     return dm
 
 
+def geodesic_neighbors(metadata: qiime2.Metadata,
+                       latitude: str = 'Latitude',
+                       longitude: str = 'Longitude',
+                       missing_data: str = 'error',
+                       k: int = None,
+                       radius: float = None,
+                       metric: str = 'geodesic') -> pd.DataFrame:
+    if k is None and radius is None:
+        raise ValueError('Either k or radius must be defined to select '
+                         'neighboring samples.')
+
+    sample_md = _load_and_validate(
+        metadata, [latitude, longitude], ['latitude', 'longitude'],
+        missing_data=missing_data)
+
+    # Find near neighbors of all points with a spatial index
+    i, j, distances = neighbor_pairs(
+        sample_md[latitude], sample_md[longitude], k=k, radius=radius,
+        metric=metric)
+
+    ids = sample_md.index.values
+    neighbors = pd.DataFrame(
+        {'sample_id': ids[i], 'neighbor_id': ids[j], 'distance': distances})
+
+    return neighbors
+
+
+def _cross_distance_table(query_ids, reference_ids, distances=None,
+                          nearest=None):
+    # long-form table of the full cross-distance block, or of the nearest
+    # reference of each query
+    if nearest is not None:
+        index, distances = nearest
+        return pd.DataFrame({'sample_id': query_ids,
+                             'neighbor_id': reference_ids[index],
+                             'distance': distances})
+    return pd.DataFrame(
+        {'sample_id': np.repeat(query_ids, len(reference_ids)),
+         'neighbor_id': np.tile(reference_ids, len(query_ids)),
+         'distance': distances.ravel()})
+
+
+def geodesic_cross_distance(query_metadata: qiime2.Metadata,
+                            reference_metadata: qiime2.Metadata,
+                            latitude: str = 'Latitude',
+                            longitude: str = 'Longitude',
+                            missing_data: str = 'error',
+                            metric: str = 'geodesic',
+                            nearest: bool = False) -> pd.DataFrame:
+    query_md, reference_md = [_load_and_validate(
+        md, [latitude, longitude], ['latitude', 'longitude'],
+        missing_data=missing_data)
+        for md in (query_metadata, reference_metadata)]
+    query_ids = query_md.index.values
+    reference_ids = reference_md.index.values
+
+    coordinates = (query_md[latitude], query_md[longitude],
+                   reference_md[latitude], reference_md[longitude])
+    if nearest:
+        return _cross_distance_table(
+            query_ids, reference_ids,
+            nearest=nearest_reference(*coordinates, metric=metric))
+
+    distances = geodesic_cdist(*coordinates, metric=metric)
+    return _cross_distance_table(query_ids, reference_ids, distances)
+
+
+def euclidean_cross_distance(query_metadata: qiime2.Metadata,
+                             reference_metadata: qiime2.Metadata,
+                             x: str,
+                             y: str,
+                             z: str = None,
+                             missing_data: str = 'error',
+                             nearest: bool = False) -> pd.DataFrame:
+    cols = [x, y]
+    names = ['x', 'y']
+    if z is not None:
+        cols.append(z)
+        names.append('z')
+
+    query_md, reference_md = [
+        _load_and_validate(md, cols, names, missing_data)
+        for md in (query_metadata, reference_metadata)]
+    query_ids = query_md.index.values
+    reference_ids = reference_md.index.values
+
+    if nearest:
+        tree = scipy.spatial.cKDTree(reference_md.values)
+        distances, index = tree.query(query_md.values, k=1)
+        return _cross_distance_table(
+            query_ids, reference_ids, nearest=(index, distances))
+
+    distances = scipy.spatial.distance.cdist(
+        query_md.values, reference_md.values, metric='euclidean')
+    return _cross_distance_table(query_ids, reference_ids, distances)
+
+
 def euclidean_distance(metadata: qiime2.Metadata,
                        x: str,
                        y: str,
@@ -61,9 +238,11 @@ def euclidean_distance(metadata: qiime2.Metadata,
 
     sample_md = _load_and_validate(metadata, cols, names, missing_data)
 
-    # Compute pairwise distances between all points
-    distances = scipy.spatial.distance.pdist(
-        sample_md.values, metric='euclidean')
+    # Compute pairwise distances between all unique sites
+    def pdist(sites):
+        return scipy.spatial.distance.pdist(sites, metric='euclidean')
+
+    distances = deduplicated_pdist(sample_md.values, pdist)
 
     dm = DistanceMatrix(distances, ids=sample_md.index)
 
@@ -8,19 +8,27 @@
 
 
 from qiime2.plugin import (Str, Plugin, Metadata, Choices, Bool, Citations,
-                           Int, MetadataColumn, Numeric, Range)
+                           Int, Float, MetadataColumn, Numeric, Range, List)
 from .mapper import (draw_map, geodesic_distance, euclidean_distance,
-                     draw_interactive_map)
+                     draw_interactive_map, geodesic_neighbors,
+                     update_geodesic_distance, geodesic_cross_distance,
+                     euclidean_cross_distance)
 import q2_coordinates
 import importlib
 from q2_types.sample_data import SampleData
 from q2_types.distance_matrix import DistanceMatrix
 from q2_types.tree import Phylogeny, Rooted
 from ._format import (CoordinatesFormat, CoordinatesDirectoryFormat,
-                      QuadTreeFormat, QuadTreeDirectoryFormat)
-from ._type import (Coordinates, QuadTree)
+                      QuadTreeFormat, QuadTreeDirectoryFormat,
+                      SpatialNeighborsFormat, SpatialNeighborsDirectoryFormat,
+                      SpatialIndexFormat, SpatialIndexDirectoryFormat,
+                      BinStatisticsFormat, BinStatisticsDirectoryFormat)
+from ._type import (Coordinates, QuadTree, SpatialNeighbors, SpatialIndex,
+                    BinStatistics)
 from .stats import autocorr
-from .qtrees import quadtree
+from .qtrees import (quadtree, octree, quadtree_statistics,
+                     multi_threshold_quadtree, insert_quadtree,
+                     build_spatial_index, query_bounding_box, query_neighbors)
 
 citations = Citations.load('citations.bib', package='q2_coordinates')
 
@@ -119,20 +127,166 @@ plugin.visualizers.register_function(
 plugin.methods.register_function(
     function=geodesic_distance,
     inputs={},
-    parameters=base_parameters,
+    parameters={**base_parameters,
+                'metric': Str % Choices(
+                    ['geodesic', 'great-circle', 'haversine']),
+                'n_jobs': Int % Range(1, None)},
     outputs=[('distance_matrix', DistanceMatrix)],
     input_descriptions={},
-    parameter_descriptions=base_parameter_descriptions,
+    parameter_descriptions={
+        **base_parameter_descriptions,
+        'metric': 'Distance metric. "geodesic" (default) measures distances '
+                  'on the WGS-84 ellipsoid. "great-circle" and "haversine" '
+                  'measure distances on a sphere of mean earth radius; they '
+                  'are much faster but deviate from geodesic distances by up '
+                  'to ~0.5%. An estimate of the maximum relative error '
+                  'against geodesic distances on the input data, sampled '
+                  'from up to 10,000 sample pairs, is issued as a warning.',
+        'n_jobs': 'Number of processes to use for computing distances. '
+                  'The output is identical regardless of the number of '
+                  'processes.'},
     name='Create a distance matrix from sample geocoordinates.',
     description='Measure pairwise geodesic distances between coordinates. '
-                'Output distances are reported in meters. '
+                'Output distances are reported in meters. Distances are '
+                'computed on the WGS-84 ellipsoid with a vectorized '
+                'implementation of Vincenty\'s inverse formula, which agrees '
+                'with Karney\'s algorithm to within 1 mm; nearly antipodal '
+                'points fall back to Karney\'s algorithm. '
+                'Note that samples with missing values are silently dropped.',
+    citations=[citations['Karney2013'], citations['Vincenty1975']]
+)
+
+plugin.methods.register_function(
+    function=update_geodesic_distance,
+    inputs={'distance_matrix': DistanceMatrix},
+    parameters={**base_parameters,
+                'metric': Str % Choices(
+                    ['geodesic', 'great-circle', 'haversine']),
+                'n_jobs': Int % Range(1, None)},
+    outputs=[('updated_distance_matrix', DistanceMatrix)],
+    input_descriptions={
+        'distance_matrix': 'Existing geodesic distance matrix, as computed '
+                           'by geodesic-distance.'},
+    parameter_descriptions={
+        **base_parameter_descriptions,
+        'metadata': 'The sample metadata containing coordinate data for all '
+                    'samples in the distance matrix and for the new samples.',
+        'metric': 'Distance metric that was used to compute the existing '
+                  'distance matrix. See geodesic-distance.',
+        'n_jobs': 'Number of processes to use for computing distances '
+                  'between new samples.'},
+    name='Add new samples to a geodesic distance matrix.',
+    description='Add samples that are found in the metadata but not in an '
+                'existing geodesic distance matrix. Only distances between '
+                'new and existing samples and among new samples are '
+                'computed; existing distances are reused unchanged. '
+                'Distances from every existing sample to three anchor '
+                'samples that do not share a great circle are recomputed to '
+                'check that their coordinates have not changed. The check '
+                'cannot detect reflections across the great circle when all '
+                'existing samples lie on one, and is skipped when the '
+                'distance matrix holds a single sampling site. Output '
+                'distances are reported in meters.',
+    citations=[citations['Karney2013'], citations['Vincenty1975']]
+)
+
+plugin.methods.register_function(
+    function=geodesic_neighbors,
+    inputs={},
+    parameters={**base_parameters,
+                'k': Int % Range(1, None),
+                'radius': Float % Range(0, None, inclusive_start=False),
+                'metric': Str % Choices(
+                    ['geodesic', 'great-circle', 'haversine'])},
+    outputs=[('neighbors', SpatialNeighbors)],
+    input_descriptions={},
+    parameter_descriptions={
+        **base_parameter_descriptions,
+        'k': 'Number of nearest neighbors to report for each sample.',
+        'radius': 'Report all neighbors within this distance (in meters) of '
+                  'each sample. If k is also defined, only the k nearest '
+                  'neighbors within this distance are reported.',
+        'metric': 'Distance metric. "geodesic" (default) measures distances '
+                  'on the WGS-84 ellipsoid. "great-circle" and "haversine" '
+                  'measure distances on a sphere of mean earth radius.'},
+    name='Find nearest neighbors of samples from sample geocoordinates.',
+    description='Find the k nearest neighbors and/or all neighbors within a '
+                'radius of each sample, and report their distances in '
+                'meters. In contrast to geodesic-distance, only neighboring '
+                'pairs are stored, and neighbors are found with a spatial '
+                'index in O(n log n) time, so this scales to datasets that '
+                'are too large for a full distance matrix. '
                 'Note that samples with missing values are silently dropped.',
-    citations=[citations['Karney2013']]
+    citations=[citations['Karney2013'], citations['Vincenty1975']]
+)
+
+cross_parameter_descriptions = {
+    'query_metadata': 'The sample metadata containing coordinate data of '
+                      'query samples.',
+    'reference_metadata': 'The sample metadata containing coordinate data '
+                          'of reference samples.',
+    'nearest': 'Only report the nearest reference sample of each query '
+               'sample, without computing the full cross-distance block.'}
+
+plugin.methods.register_function(
+    function=geodesic_cross_distance,
+    inputs={},
+    parameters={'query_metadata': Metadata,
+                'reference_metadata': Metadata,
+                'latitude': Str,
+                'longitude': Str,
+                'missing_data': Str,
+                'metric': Str % Choices(
+                    ['geodesic', 'great-circle', 'haversine']),
+                'nearest': Bool},
+    outputs=[('distances', SpatialNeighbors)],
+    input_descriptions={},
+    parameter_descriptions={
+        **cross_parameter_descriptions,
+        'latitude': base_parameter_descriptions['latitude'],
+        'longitude': base_parameter_descriptions['longitude'],
+        'missing_data': base_parameter_descriptions['missing_data'],
+        'metric': 'Distance metric. "geodesic" (default) measures distances '
+                  'on the WGS-84 ellipsoid. "great-circle" and "haversine" '
+                  'measure distances on a sphere of mean earth radius.'},
+    name='Measure distances between query and reference geocoordinates.',
+    description='Measure geodesic distances between each query sample and '
+                'each reference sample, or only to the nearest reference '
+                'sample of each query sample. Output distances are reported '
+                'in meters. Note that samples with missing values are '
+                'silently dropped.',
+    citations=[citations['Karney2013'], citations['Vincenty1975']]
 )
 
 coords_description = ('Name of metadata column containing {0}-axis coordinate '
                       'in cartesian space.')
 
+plugin.methods.register_function(
+    function=euclidean_cross_distance,
+    inputs={},
+    parameters={'query_metadata': Metadata,
+                'reference_metadata': Metadata,
+                'x': Str,
+                'y': Str,
+                'z': Str,
+                'missing_data': Str,
+                'nearest': Bool},
+    outputs=[('distances', SpatialNeighbors)],
+    input_descriptions={},
+    parameter_descriptions={
+        **cross_parameter_descriptions,
+        'x': coords_description.format('x'),
+        'y': coords_description.format('y'),
+        'z': coords_description.format('z'),
+        'missing_data': base_parameter_descriptions['missing_data']},
+    name='Measure distances between query and reference cartesian '
+         'coordinates.',
+    description='Measure euclidean distances between each query sample and '
+                'each reference sample, or only to the nearest reference '
+                'sample of each query sample. Note that samples with missing '
+                'values are silently dropped.',
+)
+
 plugin.methods.register_function(
     function=euclidean_distance,
     inputs={},
@@ -162,7 +316,17 @@ plugin.visualizers.register_function(
                 'permutations': Int % Range(0, None),
                 'two_tailed': Bool,
                 'transformation': Str % Choices(['R', 'B', 'D', 'V']),
-                'intersect_ids': Bool},
+                'intersect_ids': Bool,
+                'k': Int % Range(1, None),
+                'radius': Float % Range(0, None, inclusive_start=False),
+                'kernel': Str % Choices(['distance', 'inverse', 'gaussian',
+                                         'exponential', 'binary']),
+                'bandwidth': Float % Range(0, None, inclusive_start=False),
+                'power': Float % Range(0, None, inclusive_start=False),
+                'random_seed': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None),
+                'adaptive': Bool,
+                'min_exceedances': Int % Range(1, None)},
     input_descriptions={'distance_matrix': 'Spatial distance matrix'},
     parameter_descriptions={
         'metadata': 'Variable to test for spatial autocorrelation.',
@@ -178,12 +342,45 @@ plugin.visualizers.register_function(
         'intersect_ids': 'If supplied, IDs that are not found in both the '
                          'distance matrix and metadata will be discarded '
                          'before testing. Default behavior is to error on any '
-                         'mismatched IDs.'},
+                         'mismatched IDs.',
+        'k': 'Only use the k nearest neighbors of each sample as its '
+             'spatial neighbors. By default, all other samples are '
+             'neighbors.',
+        'radius': 'Only use samples within this distance of each sample as '
+                  'its spatial neighbors. If combined with k, the k nearest '
+                  'neighbors within this distance are used.',
+        'kernel': 'Function converting distances between neighbors into '
+                  'spatial weights. "distance" (default) uses the distances '
+                  'themselves, "inverse" uses distance ** -power, "gaussian" '
+                  'uses exp(-(distance / bandwidth) ** 2 / 2), "exponential" '
+                  'uses exp(-distance / bandwidth) and "binary" gives all '
+                  'neighbors a weight of 1. Neighbors with a zero weight '
+                  'are dropped, including coincident samples under the '
+                  '"distance" and "inverse" kernels.',
+        'bandwidth': 'Distance scale of the "gaussian" and "exponential" '
+                     'kernels. Required for these kernels.',
+        'power': 'Power of the distance in the "inverse" kernel.',
+        'random_seed': 'Seed of the random permutations, for reproducible '
+                       'pseudo p-values. By default, a different seed is '
+                       'drawn for every run.',
+        'n_jobs': 'Number of processes to use for computing random '
+                  'permutations. The output is identical regardless of the '
+                  'number of processes.',
+        'adaptive': 'If True, stop the random permutations early (Besag & '
+                    'Clifford sequential Monte Carlo test) once both '
+                    'statistics have min_exceedances permuted values as '
+                    'extreme as the observed values. permutations is then '
+                    'the maximum number of permutations, and the number of '
+                    'permutations used is reported with the results.',
+        'min_exceedances': 'Number of permuted values as extreme as the '
+                           'observed statistic after which adaptive '
+                           'permutations stop.'},
     name='Compute Moran\'s I and Geary\'s C autocorrelation statistics.',
     description='Compute Moran\'s I and Geary\'s C autocorrelation statistics '
                 'on a (geo)spatial distance matrix and an independent '
                 'variable.',
-    citations=[citations['Moran'], citations['Geary']]
+    citations=[citations['Moran'], citations['Geary'],
+               citations['BesagClifford']]
 )
 
 plugin.methods.register_function(
@@ -192,7 +389,13 @@ plugin.methods.register_function(
     parameters={'metadata': Metadata,
                 'threshold': Int,
                 'x_coord': Str,
-                'y_coord': Str},
+                'y_coord': Str,
+                'method': Str % Choices(['quadtree', 'morton', 'kdtree']),
+                'max_depth': Int % Range(1, None),
+                'min_cell_size': Float % Range(0, None,
+                                               inclusive_start=False),
+                'half_open': Bool,
+                'n_jobs': Int % Range(1, None)},
     outputs=[('output_tree', Phylogeny[Rooted]),
              ('output_table', SampleData[QuadTree])],
     input_descriptions={},
@@ -203,7 +406,35 @@ plugin.methods.register_function(
                      'divide itself again. If there is fewer than this number '
                      'of samples in a bin the tree will not subdivide again.',
         'x_coord': 'Metadata column containing x coordinates, i.e. longitude.',
-        'y_coord': 'Metadata column containing y coordinates, i.e. latitude'},
+        'y_coord': 'Metadata column containing y coordinates, i.e. latitude',
+        'method': 'Tree construction method. "quadtree" (default) divides '
+                  'partitions level by level, assigning samples on a '
+                  'partition edge to every partition sharing that edge. '
+                  '"morton" sorts samples once by Morton (Z-order) code and '
+                  'assigns each sample to exactly one partition per level; '
+                  'it is faster on large datasets and divides at most 32 '
+                  'times. "kdtree" divides partitions in two halves at the '
+                  'median sample, alternating between x and y, so that bins '
+                  'are balanced and the tree is shallow however unevenly '
+                  'samples are spread.',
+        'max_depth': 'Maximum number of times a partition is divided. By '
+                     'default partitions are divided until they hold fewer '
+                     'samples than the threshold, or only samples sharing '
+                     'the same coordinates.',
+        'min_cell_size': 'Partitions are not divided into partitions whose '
+                         'width and height are both smaller than this size, '
+                         'in units of the coordinates.',
+        'half_open': 'Assign samples on a partition edge to only one '
+                     'partition (the one to their north-east) when using the '
+                     '"quadtree" method, so that every sample belongs to '
+                     'exactly one partition per level. "morton" and '
+                     '"kdtree" partitions are always half-open; "morton" '
+                     'gives the same bins as "quadtree" with half-open '
+                     'partitions, down to 32 divisions.',
+        'n_jobs': 'Number of processes to use for building the subtrees of '
+                  'the top partitions with the "quadtree" method. The '
+                  'output is identical regardless of the number of '
+                  'processes.'},
     name='Divide samples into bins by quadtrees based on'
          'x and y coordinates',
     description='Objective binning of samples based on spatial data '
@@ -213,6 +444,240 @@ plugin.methods.register_function(
                 'binning based both on location and sample density.',
 
 )
+
+plugin.methods.register_function(
+    function=octree,
+    inputs={},
+    parameters={'metadata': Metadata,
+                'threshold': Int,
+                'x_coord': Str,
+                'y_coord': Str,
+                'z_coord': Str,
+                'max_depth': Int % Range(1, None),
+                'min_cell_size': Float % Range(0, None,
+                                               inclusive_start=False),
+                'half_open': Bool,
+                'n_jobs': Int % Range(1, None)},
+    outputs=[('output_tree', Phylogeny[Rooted]),
+             ('output_table', SampleData[QuadTree])],
+    input_descriptions={},
+    parameter_descriptions={
+        'metadata': 'The sample metadata containing coordinate data.',
+        'threshold': 'The amount of samples which constitutes the "bin" '
+                     'size. Partitions with at least this many samples are '
+                     'divided again.',
+        'x_coord': 'Metadata column containing x coordinates, i.e. longitude.',
+        'y_coord': 'Metadata column containing y coordinates, i.e. latitude',
+        'z_coord': 'Metadata column containing z coordinates, e.g. depth or '
+                   'elevation.',
+        'max_depth': 'Maximum number of times a partition is divided.',
+        'min_cell_size': 'Partitions are not divided into partitions whose '
+                         'width, height and depth are all smaller than this '
+                         'size, in units of the coordinates.',
+        'half_open': 'Assign samples on a partition face to only one '
+                     'partition, as in the quadtree method.',
+        'n_jobs': 'Number of processes to use for building the subtrees of '
+                  'the top partitions. The output is identical regardless '
+                  'of the number of processes.'},
+    name='Divide samples into bins by octrees based on x, y and z '
+         'coordinates',
+    description='Bin samples in three dimensions by octrees. Like the '
+                'quadtree method, partitions holding at least threshold '
+                'samples are divided, here into eight. Partitions 1 to 4 '
+                'are the quadrants of the upper half along z, and 5 to 8 '
+                'those of the lower half.',
+)
+
+plugin.methods.register_function(
+    function=quadtree_statistics,
+    inputs={},
+    parameters={'metadata': Metadata,
+                'threshold': Int,
+                'x_coord': Str,
+                'y_coord': Str,
+                'columns': List[Str],
+                'method': Str % Choices(['quadtree', 'morton', 'kdtree']),
+                'max_depth': Int % Range(1, None),
+                'min_cell_size': Float % Range(0, None,
+                                               inclusive_start=False),
+                'half_open': Bool},
+    outputs=[('output_tree', Phylogeny[Rooted]),
+             ('output_table', SampleData[QuadTree]),
+             ('bin_statistics', BinStatistics)],
+    input_descriptions={},
+    parameter_descriptions={
+        'metadata': 'The sample metadata containing coordinate data and the '
+                    'columns to average.',
+        'threshold': 'The amount of samples which constitutes the "bin" '
+                     'size, as in the quadtree method.',
+        'x_coord': 'Metadata column containing x coordinates, i.e. longitude.',
+        'y_coord': 'Metadata column containing y coordinates, i.e. latitude',
+        'columns': 'Numeric metadata columns to average in every bin. '
+                   'Missing values are ignored.',
+        'method': 'Tree construction method, as in the quadtree method.',
+        'max_depth': 'Maximum number of times a partition is divided.',
+        'min_cell_size': 'Partitions are not divided into partitions whose '
+                         'width and height are both smaller than this size, '
+                         'in units of the coordinates.',
+        'half_open': 'Assign samples on a partition edge to only one '
+                     'partition, as in the quadtree method.'},
+    name='Divide samples into bins by quadtrees and summarize the bins',
+    description='Bin samples as the quadtree method does, and summarize '
+                'every bin of the tree (at all depths) while it is built: '
+                'the number of samples, their centroid and bounding box, '
+                'and the means of the selected columns. The summary table '
+                'has one row per bin, identified by its lineage.',
+)
+
+plugin.methods.register_function(
+    function=multi_threshold_quadtree,
+    inputs={},
+    parameters={'metadata': Metadata,
+                'thresholds': List[Int % Range(2, None)],
+                'x_coord': Str,
+                'y_coord': Str,
+                'method': Str % Choices(['quadtree', 'morton', 'kdtree']),
+                'max_depth': Int % Range(1, None),
+                'min_cell_size': Float % Range(0, None,
+                                               inclusive_start=False),
+                'half_open': Bool},
+    outputs=[('output_tree', Phylogeny[Rooted]),
+             ('output_table', SampleData[QuadTree])],
+    input_descriptions={},
+    parameter_descriptions={
+        'metadata': 'The sample metadata containing coordinate data.',
+        'thresholds': 'The bin sizes to divide samples by. Partitions with '
+                      'at least this many samples are divided again.',
+        'x_coord': 'Metadata column containing x coordinates, i.e. longitude.',
+        'y_coord': 'Metadata column containing y coordinates, i.e. latitude',
+        'method': 'Tree construction method, as in the quadtree method.',
+        'max_depth': 'Maximum number of times a partition is divided.',
+        'min_cell_size': 'Partitions are not divided into partitions whose '
+                         'width and height are both smaller than this size, '
+                         'in units of the coordinates.',
+        'half_open': 'Assign samples on a partition edge to only one '
+                     'partition, as in the quadtree method.'},
+    name='Divide samples into bins by quadtrees at several thresholds',
+    description='Bin samples by quadtrees at several thresholds at once. The '
+                'tree is built once for the smallest threshold, and the bins '
+                'of larger thresholds are derived by pruning it, giving the '
+                'same bins as separate quadtree runs. The output table has '
+                'one "lineage-<threshold>" column per threshold. The output '
+                'tree is the tree of the smallest threshold; the bins of '
+                'larger thresholds are its clades.',
+)
+
+plugin.methods.register_function(
+    function=insert_quadtree,
+    inputs={'quadtree': SampleData[QuadTree]},
+    parameters={'metadata': Metadata,
+                'threshold': Int,
+                'x_coord': Str,
+                'y_coord': Str,
+                'max_depth': Int % Range(1, None),
+                'min_cell_size': Float % Range(0, None,
+                                               inclusive_start=False),
+                'half_open': Bool},
+    outputs=[('output_tree', Phylogeny[Rooted]),
+             ('output_table', SampleData[QuadTree])],
+    input_descriptions={
+        'quadtree': 'Quadtree table made by the quadtree action with the '
+                    '"quadtree" or "morton" method. Morton quadtrees have '
+                    'the same half-open partitions as quadtrees, so '
+                    'samples are added to them with half_open. Tables made '
+                    'by the "kdtree" '
+                    'method cannot be told apart from quadtrees and are not '
+                    'supported; tables made by the octree action are '
+                    'rejected.'},
+    parameter_descriptions={
+        'metadata': 'The sample metadata containing coordinate data of the '
+                    'samples in the quadtree and of the samples to add.',
+        'threshold': 'The amount of samples which constitutes the "bin" '
+                     'size, as used to build the quadtree.',
+        'x_coord': 'Metadata column containing x coordinates, i.e. longitude.',
+        'y_coord': 'Metadata column containing y coordinates, i.e. latitude',
+        'max_depth': 'Maximum number of times a partition is divided, as '
+                     'used to build the quadtree.',
+        'min_cell_size': 'Partitions are not divided into partitions whose '
+                         'width and height are both smaller than this size, '
+                         'as used to build the quadtree.',
+        'half_open': 'Whether the quadtree was built with half-open '
+                     'partitions.'},
+    name='Add samples to an existing quadtree',
+    description='Add samples to the bins of a quadtree without rebuilding '
+                'it. New samples are placed in the bins they fall into, and '
+                'only bins reaching the threshold are divided again, so '
+                'bins that received no new samples keep their lineage. '
+                'Given the parameters the quadtree was built with, the bins '
+                'are the same as those of a quadtree of all samples covering '
+                'the area of the original samples. New samples must lie '
+                'within that area.',
+)
+
+plugin.methods.register_function(
+    function=build_spatial_index,
+    inputs={},
+    parameters={'metadata': Metadata,
+                'x_coord': Str,
+                'y_coord': Str,
+                'threshold': Int % Range(2, None)},
+    outputs=[('spatial_index', SpatialIndex)],
+    input_descriptions={},
+    parameter_descriptions={
+        'metadata': 'The sample metadata containing coordinate data.',
+        'x_coord': 'Metadata column containing x coordinates, i.e. longitude.',
+        'y_coord': 'Metadata column containing y coordinates, i.e. latitude',
+        'threshold': 'Partitions of the index holding at least this many '
+                     'samples are divided.'},
+    name='Build a spatial index of sample coordinates.',
+    description='Build a quadtree index of samples based on x and y '
+                'coordinates, for fast bounding box, radius and nearest '
+                'neighbor queries. Samples with missing or non-numeric '
+                'coordinates are dropped.',
+)
+
+plugin.methods.register_function(
+    function=query_bounding_box,
+    inputs={'index': SpatialIndex},
+    parameters={'min_x': Float,
+                'max_x': Float,
+                'min_y': Float,
+                'max_y': Float},
+    outputs=[('coordinates', SampleData[Coordinates])],
+    input_descriptions={'index': 'The spatial index to query.'},
+    parameter_descriptions={
+        'min_x': 'Minimum x coordinate of the bounding box.',
+        'max_x': 'Maximum x coordinate of the bounding box.',
+        'min_y': 'Minimum y coordinate of the bounding box.',
+        'max_y': 'Maximum y coordinate of the bounding box.'},
+    name='Find samples in a bounding box.',
+    description='Find the indexed samples whose coordinates lie in a '
+                'bounding box (edges included).',
+)
+
+plugin.methods.register_function(
+    function=query_neighbors,
+    inputs={'index': SpatialIndex},
+    parameters={'metadata': Metadata,
+                'k': Int % Range(1, None),
+                'radius': Float % Range(0, None, inclusive_start=False)},
+    outputs=[('neighbors', SpatialNeighbors)],
+    input_descriptions={'index': 'The spatial index to query.'},
+    parameter_descriptions={
+        'metadata': 'The metadata of query samples, containing coordinates '
+                    'in the columns the index was built from.',
+        'k': 'Number of nearest indexed samples to report for each query '
+             'sample.',
+        'radius': 'Report all indexed samples within this euclidean '
+                  'distance of each query sample. If k is also provided, '
+                  'at most k of them are reported.'},
+    name='Find indexed samples near query samples.',
+    description='Find the k nearest indexed samples and/or the indexed '
+                'samples within a radius of each query sample. Query samples '
+                'that are also indexed are not reported as their own '
+                'neighbors.',
+)
+
 # Registrations
 plugin.register_formats(CoordinatesFormat, CoordinatesDirectoryFormat)
 
@@ -229,4 +694,29 @@ plugin.register_semantic_types(QuadTree)
 plugin.register_semantic_type_to_format(
     SampleData[QuadTree],
     artifact_format=QuadTreeDirectoryFormat)
+
+plugin.register_formats(SpatialNeighborsFormat,
+                        SpatialNeighborsDirectoryFormat)
+
+plugin.register_semantic_types(SpatialNeighbors)
+
+plugin.register_semantic_type_to_format(
+    SpatialNeighbors,
+    artifact_format=SpatialNeighborsDirectoryFormat)
+
+plugin.register_formats(SpatialIndexFormat, SpatialIndexDirectoryFormat)
+
+plugin.register_semantic_types(SpatialIndex)
+
+plugin.register_semantic_type_to_format(
+    SpatialIndex,
+    artifact_format=SpatialIndexDirectoryFormat)
+
+plugin.register_formats(BinStatisticsFormat, BinStatisticsDirectoryFormat)
+
+plugin.register_semantic_types(BinStatistics)
+
+plugin.register_semantic_type_to_format(
+    BinStatistics,
+    artifact_format=BinStatisticsDirectoryFormat)
 importlib.import_module('q2_coordinates._transformer')
@@ -6,13 +6,18 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import multiprocessing as mp
+
+import numpy as np
 import pandas as pd
 import skbio
 import qiime2
-from functools import partial
+
+# bits per axis of Morton codes, i.e. the maximum depth of Morton quadtrees
+MORTON_BITS = 32
 
 
-def clean(metadata, y_coord, x_coord):
+def clean(metadata, y_coord, x_coord, origin=None, z_coord=None):
 
     if y_coord not in metadata:
         raise ValueError("Must have y_coord in metadata to use quadtrees")
@@ -20,203 +25,1295 @@ def clean(metadata, y_coord, x_coord):
     if x_coord not in metadata:
         raise ValueError("Must have x_coord in metadata to use quadtrees")
 
-    df = metadata[[x_coord, y_coord]]
+    if z_coord is not None and z_coord not in metadata:
+        raise ValueError("Must have z_coord in metadata to use octrees")
+
+    columns = [x_coord, y_coord] + ([] if z_coord is None else [z_coord])
+    df = metadata[columns]
 
     # as global or local in function, define all null or this:
-    df[y_coord] = pd.to_numeric(df[y_coord], errors='coerce')
-    df[x_coord] = pd.to_numeric(df[x_coord], errors='coerce')
+    for column in columns:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
 
     # drop nan values (formerly strings) from dataframe
-    df = df.dropna(subset=[x_coord, y_coord])
+    df = df.dropna(subset=columns)
 
     if df.empty is True:
         raise ValueError("x coordinates and/or y coordinates have "
                          "no numeric values, please check your data.")
-    # resolve points shifted left or down
-    xmin = df[x_coord].min()
-    if xmin > 0:
-        df[x_coord] = df[x_coord] - xmin
-        xmin = 0
+    if origin is not None:
+        # place the given origin at (0, 0)
+        xmin, ymin = origin[:2]
+    else:
+        # resolve points shifted left or down
+        xmin = df[x_coord].min()
+        if xmin > 0:
+            df[x_coord] = df[x_coord] - xmin
+            xmin = 0
 
-    ymin = df[y_coord].min()
-    if ymin > 0:
-        df[y_coord] = df[y_coord] - ymin
-        ymin = 0
+        ymin = df[y_coord].min()
+        if ymin > 0:
+            df[y_coord] = df[y_coord] - ymin
+            ymin = 0
 
     df[x_coord] = df[x_coord] - xmin
     df[y_coord] = df[y_coord] - ymin
+    if z_coord is not None:
+        zmin = df[z_coord].min() if origin is None else origin[2]
+        df[z_coord] = df[z_coord] - zmin
     return df
 
 
-class Point():
-    def __init__(self, x, y, sample_id):
-        self.x = float(x)
-        self.y = float(y)
-        self.sample_id = sample_id
+class QTree():
+    def __init__(self, threshold, data):
+        self.threshold = threshold
+        data = np.asarray(data, dtype=object)
+        if data.ndim < 2:
+            data = data.reshape(-1, 3)
+        self.sample_ids = data[:, 0]
+        self.x = data[:, 1].astype(float)
+        self.y = data[:, 2].astype(float)
+        # points with a z coordinate are divided by octrees
+        self.z = data[:, 3].astype(float) if data.shape[1] > 3 else None
 
+    def add_point(self, x, y, sample_id):
+        self.sample_ids = np.append(self.sample_ids, np.array(
+            [sample_id], dtype=object))
+        self.x = np.append(self.x, float(x))
+        self.y = np.append(self.y, float(y))
 
-class Node():
-    def __init__(self, x0, y0, w, h, points, _id):
-        self.x0 = x0
-        self.y0 = y0
-        self.width = float(w)
-        self.height = float(h)
-        self.points = points
-        self.children = []
-        self.id = _id
+    def get_points(self):
+        return list(zip(self.sample_ids, self.x, self.y))
 
-    def get_width(self):
-        return self.width
+    def subdivide(self, threshold, method='quadtree', max_depth=None,
+                  min_cell_size=None, half_open=False):
+        sample_ids, depths, lineages = self._subdivide(
+            threshold, method, max_depth, min_cell_size, half_open)
+        return list(zip(sample_ids, depths.tolist(), lineages))
 
-    def get_height(self):
-        return self.height
+    def _subdivide(self, threshold, method, max_depth, min_cell_size,
+                   half_open, n_jobs=1):
+        if method not in METHODS:
+            raise ValueError('Unknown method "%s". Choose one of: %s' % (
+                method, ', '.join(METHODS)))
+        kwargs = {'max_depth': max_depth, 'min_cell_size': min_cell_size}
+        # morton quadtrees and k-d trees are always half-open, and built
+        # serially
+        if method == 'quadtree':
+            kwargs.update(half_open=half_open, n_jobs=n_jobs)
+        if self.z is not None:
+            if method != 'quadtree':
+                raise ValueError('Only the quadtree method supports z '
+                                 'coordinates.')
+            kwargs.update(z=self.z, z_size=self.z.max())
+        points, depths, lineages = METHODS[method](
+            self.x, self.y, self.x.max(), self.y.max(), threshold, **kwargs)
+        return self.sample_ids[points], depths, lineages
 
-    def get_points(self):
-        return self.points
 
-    def get_id(self):
-        return self.id
+def subdivide(x, y, width, height, threshold, max_depth=None,
+              min_cell_size=None, half_open=False, origin=(0., 0., 0.),
+              z=None, z_size=None, n_jobs=1):
+    """Subdivide points into quadrants until bins hold < threshold points.
 
-    def set_id(self, _id):
-        self.id = self.id+_id
+    The tree is built one level at a time over index arrays, with the
+    points of every node kept as a contiguous run, so its depth is not
+    bounded by the interpreter stack. Quadrants are closed intervals, so
+    points on a shared edge belong to every quadrant touching it, unless
+    half_open, in which case quadrants include only their lower and left
+    edges (and the outer edges of the root) and every point belongs to
+    exactly one quadrant per level. Nodes are
+    not divided further if all their points share the same coordinates, if
+    they are max_depth levels deep, or if their quadrants would be smaller
+    than min_cell_size along all axes.
 
+    The root is the box of size width x height with its lower left corner at
+    origin. If z is given, points are divided into octants instead, with the
+    root z_size deep along z: octants 1 to 4 are the quadrants of the upper
+    half along z and 5 to 8 those of the lower half. With n_jobs > 1 the
+    subtrees below the top levels are built by a process pool, with the
+    same result. Returns the point index, depth and lineage of each
+    (point, bin) membership, in depth-first order of the bins.
+    """
+    _check_threshold(len(x), threshold)
+    keep = None
+    if half_open:
+        # points outside the root belong to no half-open quadrant
+        inside = ((x >= origin[0]) & (x <= origin[0] + width)
+                  & (y >= origin[1]) & (y <= origin[1] + height))
+        if z is not None:
+            inside &= (z >= origin[2]) & (z <= origin[2] + z_size)
+        if not inside.all():
+            keep = np.flatnonzero(inside)
+            x, y = x[keep], y[keep]
+            z = None if z is None else z[keep]
+    args = (x, y, width, height, threshold, max_depth, min_cell_size,
+            half_open, origin, z, z_size)
+    if n_jobs > 1:
+        points, depths, lineages = _depth_first(*_parallel_nodes(
+            *args, n_jobs))
+    else:
+        points, depths, lineages = _depth_first(*_subdivide_nodes(*args))
+    if keep is not None:
+        points = keep[points]
+    return points, depths, lineages
 
-class QTree():
-    def __init__(self, threshold, data):
-        self.threshold = threshold
-        self.points = [Point(x, y, sample_id) for sample_id, x, y in data]
-        x_max = max(x for _, x, _ in data)
-        y_max = max(y for _, _, y in data)
-        self.root = Node(0, 0, x_max, y_max, self.points, "0")
 
-    def add_point(self, x, y, sample_id):
-        self.points.append(Point(x, y, sample_id))
+def _quadrants(x0, y0, w, h):
+    # quadrant origins, in the order 1 (NW), 2 (NE), 3 (SW), 4 (SE)
+    w_, h_ = w / 2, h / 2
+    qx0, qy0 = [x0], [y0 + h_]
+    qx0.append(x0 + w_)
+    qy0.append(qy0[0])
+    qx0.append(qx0[1] - w_)
+    qy0.append(qy0[1] - h_)
+    qx0.append(qx0[2] + w_)
+    qy0.append(qy0[2])
+    return qx0, qy0, w_, h_
 
-    def get_points(self):
-        return self.points
 
-    def subdivide(self, threshold):
-        depth = 0
-        node_id = ""
-        bins = []
-        bins = recursive_subdivide(self.root, threshold, depth, node_id, bins)
-        return bins
+def _halves(z0, d):
+    # origins of the upper and lower halves along z
+    d_ = d / 2
+    qz0 = [z0 + d_]
+    qz0.append(qz0[0] - d_)
+    return qz0, d_
+
+
+def _subdivide_nodes(x, y, width, height, threshold, max_depth,
+                     min_cell_size, half_open, origin, z, z_size):
+    # the nodes of each level, with the runs of points they hold; all
+    # points must lie in the root, so that half-open quadrants keep points
+    # on the outer edges of subtree roots whose edges were rounded
+    n = len(x)
+    octree = z is not None
+    fanout = 8 if octree else 4
+    # current level: nodes and the runs of points they hold
+    x0, y0 = np.array([origin[0]], dtype=float), np.array([origin[1]],
+                                                          dtype=float)
+    w, h = np.array([width], dtype=float), np.array([height], dtype=float)
+    lineage = ['']
+    points = np.arange(n)
+    if octree:
+        z0, d = np.array([origin[2]], dtype=float), np.array([z_size],
+                                                             dtype=float)
+    owner = np.zeros(points.size, dtype=np.intp)
+
+    # memberships of each level, as one contiguous run of points per node
+    out_points, out_counts = [], []
+    node_lineages, node_depths = [], []
+    depth = 0
+    while points.size and (max_depth is None or depth < max_depth):
+        counts = np.bincount(owner, minlength=len(lineage))
+        starts = np.cumsum(counts) - counts
+        px, py = x[points], y[points]
+        identical = (
+            (np.minimum.reduceat(px, starts)
+             == np.maximum.reduceat(px, starts))
+            & (np.minimum.reduceat(py, starts)
+               == np.maximum.reduceat(py, starts)))
+        size = np.maximum(w, h)
+        if octree:
+            pz = z[points]
+            identical &= (np.minimum.reduceat(pz, starts)
+                          == np.maximum.reduceat(pz, starts))
+            size = np.maximum(size, d)
+        split = (counts >= threshold) & ~identical
+        if min_cell_size is not None:
+            split &= size / 2 >= min_cell_size
+        if not split.any():
+            break
+        keep = split[owner]
+        points, px, py = points[keep], px[keep], py[keep]
+        owner = (np.cumsum(split) - 1)[owner[keep]]
+        x0, y0, w, h = x0[split], y0[split], w[split], h[split]
+        if octree:
+            pz, z0, d = pz[keep], z0[split], d[split]
+        lineage = [lin for lin, s in zip(lineage, split) if s]
+        depth += 1
+
+        qx0, qy0, w_, h_ = _quadrants(x0, y0, w, h)
+        if octree:
+            qz0, d_ = _halves(z0, d)
+
+        if half_open:
+            quad = ((py < qy0[0][owner]) * 2
+                    + (px >= qx0[1][owner])).astype(np.intp)
+            if octree:
+                quad += (pz < qz0[0][owner]) * 4
+            child_points, child_ids = points, owner * fanout + quad
+        else:
+            child_points, child_ids = [], []
+            ow, oh = w_[owner], h_[owner]
+            for q in range(fanout):
+                cx0, cy0 = qx0[q % 4][owner], qy0[q % 4][owner]
+                inside = ((px >= cx0) & (px <= cx0 + ow)
+                          & (py >= cy0) & (py <= cy0 + oh))
+                if octree:
+                    cz0 = qz0[q // 4][owner]
+                    inside &= (pz >= cz0) & (pz <= cz0 + d_[owner])
+                child_points.append(points[inside])
+                child_ids.append(owner[inside] * fanout + q)
+            child_points = np.concatenate(child_points)
+            child_ids = np.concatenate(child_ids)
+        order = np.argsort(child_ids, kind='stable')
+        points, child_ids = child_points[order], child_ids[order]
 
+        first = np.ones(child_ids.size, dtype=bool)
+        first[1:] = child_ids[1:] != child_ids[:-1]
+        nodes, owner = child_ids[first], np.cumsum(first) - 1
+        parent, quad = nodes // fanout, nodes % fanout
+        x0 = np.stack(qx0)[quad % 4, parent]
+        y0 = np.stack(qy0)[quad % 4, parent]
+        w, h = w_[parent], h_[parent]
+        if octree:
+            z0, d = np.stack(qz0)[quad // 4, parent], d_[parent]
+        lineage = [lineage[p] + str(q + 1) + '.'
+                   for p, q in zip(parent.tolist(), quad.tolist())]
 
-def recursive_subdivide(node, k, depth, node_id, bins):
-    if len(node.points) < k:
-        return
-    elif len(node.points)/k >= len(node.points):
+        out_points.append(points)
+        out_counts.append(np.bincount(owner))
+        node_lineages.extend(lineage)
+        node_depths.extend([depth] * len(lineage))
+    return out_points, out_counts, node_lineages, node_depths
+
+
+def _lineage_box(lineage, origin, width, height, z_size=None):
+    # the cell of a node, with the same arithmetic as _subdivide_nodes
+    x0, y0, w, h = origin[0], origin[1], width, height
+    z0, d = origin[2], z_size
+    for digit in lineage.split('.')[:-1]:
+        q = int(digit) - 1
+        qx0, qy0, w, h = _quadrants(x0, y0, w, h)
+        x0, y0 = qx0[q % 4], qy0[q % 4]
+        if z_size is not None:
+            qz0, d = _halves(z0, d)
+            z0 = qz0[q // 4]
+    return (x0, y0, z0), w, h, d
+
+
+def _parallel_nodes(x, y, width, height, threshold, max_depth,
+                    min_cell_size, half_open, origin, z, z_size, n_jobs):
+    # build the top levels, with enough nodes to balance the workers
+    fanout = 4 if z is None else 8
+    levels = 1
+    while fanout ** levels < 4 * n_jobs:
+        levels += 1
+    if max_depth is not None:
+        levels = min(levels, max_depth)
+    nodes = _subdivide_nodes(x, y, width, height, threshold, levels,
+                             min_cell_size, half_open, origin, z, z_size)
+    out_points, out_counts, node_lineages, node_depths = nodes
+    if len(out_points) < levels or levels == max_depth:
+        return nodes
+
+    # then the subtree of every node of the last level that has enough
+    # points, each in its own cell
+    counts = out_counts[-1]
+    starts = np.cumsum(counts) - counts
+    frontier = [(node_lineages[len(node_lineages) - len(counts) + i],
+                 out_points[-1][start:start + count])
+                for i, (start, count) in enumerate(zip(starts.tolist(),
+                                                       counts.tolist()))
+                if count >= threshold]
+    # largest subtrees first
+    frontier.sort(key=lambda node: -len(node[1]))
+    tasks = []
+    for lineage, points in frontier:
+        origin_, w, h, d = _lineage_box(lineage, origin, width, height,
+                                        z_size)
+        tasks.append((x[points], y[points], w, h, threshold,
+                      None if max_depth is None else max_depth - levels,
+                      min_cell_size, half_open, origin_,
+                      None if z is None else z[points], d))
+    if not tasks:
+        return nodes
+    with mp.Pool(min(n_jobs, len(tasks))) as pool:
+        subtrees = pool.starmap(_subdivide_nodes, tasks, chunksize=1)
+
+    # stitch the subtrees in below their roots
+    for (lineage, points), subtree in zip(frontier, subtrees):
+        sub_points, sub_counts, sub_lineages, sub_depths = subtree
+        out_points.extend(points[p] for p in sub_points)
+        out_counts.extend(sub_counts)
+        node_lineages.extend(lineage + lin for lin in sub_lineages)
+        node_depths.extend(levels + depth for depth in sub_depths)
+    return out_points, out_counts, node_lineages, node_depths
+
+
+def _depth_first(out_points, out_counts, node_lineages, node_depths):
+    # (point, depth, lineage) memberships of nodes in depth-first order
+    if not out_points:
+        return (np.array([], dtype=np.intp), np.array([], dtype=int),
+                np.array([], dtype=object))
+    points = np.concatenate(out_points)
+    counts = np.concatenate(out_counts)
+    starts = np.cumsum(counts) - counts
+    # lexicographic order of lineages is the depth-first order of bins, so
+    # gather the runs of points of all nodes in that order
+    order = np.argsort(np.array(node_lineages), kind='stable')
+    counts = counts[order]
+    index = _ranges(starts[order], counts)
+    nodes = np.repeat(order, counts)
+    node_lineages = np.array(node_lineages, dtype=object)
+    return (points[index], np.array(node_depths, dtype=int)[nodes],
+            node_lineages[nodes])
+
+
+def _check_threshold(n, threshold):
+    if n >= threshold and threshold <= 1:
         raise ValueError("The threshold for subdivision is less than "
                          "the amount of points, "
                          "please chose a larger threshold for division")
-    w_ = node.width/2
-    h_ = node.height/2
-    depth += 1
-    nodes = []
-    for i in range(4):
-        # northwest
-        if(i == 0):
-            quad = "1"
-            node.x0 = node.x0
-            node.y0 = node.y0+h_
-        # northeast
-        elif(i == 1):
-            quad = "2"
-            node.x0 = node.x0+w_
-            node.y0 = node.y0
-        # southwest
-        elif(i == 2):
-            quad = "3"
-            node.x0 = node.x0-w_
-            node.y0 = node.y0-h_
-        # southeast
-        elif(i == 3):
-            quad = "4"
-            node.x0 = node.x0+w_
-            node.y0 = node.y0
-
-        p = contains(node.x0, node.y0, w_, h_, node.points)
-        new_id = node_id + quad + "."
-        quad_node = Node(node.x0, node.y0, w_, h_, p, new_id)
-        nodes.append(quad_node)
-
-        for pt in p:
-            bins.append((pt.sample_id, depth, new_id))
-
-        recursive_subdivide(quad_node, k, depth, new_id, bins)
-    node.children = nodes
-    return bins
-
-
-def contains(x, y, w, h, points):
-    pts = []
-    for point in points:
-        if point.x >= x and point.x <= x+w and point.y >= y and point.y <= y+h:
-            pts.append(point)
-    return pts
-
-
-def create_tree_df(bins, index):
+
+
+def _ranges(starts, counts):
+    # concatenated aranges [start, start + count) of every run
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+def morton_codes(x, y, width, height, bits=MORTON_BITS):
+    """Interleaved-bit (Z-order) codes of points in [0, width]x[0, height].
+
+    Each pair of bits, from the most significant down, encodes the quadrant
+    of a point at one level of the tree, so that codes sort in lineage
+    order: 1 (NW), 2 (NE), 3 (SW), 4 (SE). Quadrants are half-open, and
+    their edges are computed with the same arithmetic as subdivide, so
+    points on an edge fall into the same quadrant as with
+    subdivide(half_open=True).
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    x0, y0 = np.zeros(len(x)), np.zeros(len(y))
+    w, h = float(width), float(height)
+    codes = np.zeros(len(x), dtype=np.uint64)
+    for _ in range(bits):
+        qx0, qy0, w, h = _quadrants(x0, y0, w, h)
+        quad = ((y < qy0[0]) * 2 + (x >= qx0[1])).astype(np.intp)
+        x0, y0 = np.choose(quad, qx0), np.choose(quad, qy0)
+        codes = (codes << np.uint64(2)) | quad.astype(np.uint64)
+    return codes
+
+
+def _morton_levels(codes, threshold, levels, bits=MORTON_BITS):
+    """Nodes of each level of a tree over sorted Morton codes.
+
+    Yields the depth, and the parent (index into the nodes of the previous
+    level), start, stop and quadrant digit (0-3) of each node of that level.
+    Nodes are divided if they hold at least threshold points with more than
+    one distinct code.
+    """
+    starts, stops = np.array([0]), np.array([len(codes)])
+    for depth in range(1, levels + 1):
+        counts = stops - starts
+        split = (counts >= threshold) & (counts > 0)
+        split[split] = codes[starts[split]] != codes[stops[split] - 1]
+        if not split.any():
+            return
+        parents = np.flatnonzero(split)
+        starts, counts = starts[split], counts[split]
+
+        positions = _ranges(starts, counts)
+        owner = np.repeat(np.arange(len(starts)), counts)
+        digits = ((codes[positions] >> np.uint64(2 * (bits - depth)))
+                  & np.uint64(3)).astype(np.intp)
+        first = np.ones(positions.size, dtype=bool)
+        first[1:] = (owner[1:] != owner[:-1]) | (digits[1:] != digits[:-1])
+        first_index = np.flatnonzero(first)
+        counts = np.diff(np.append(first_index, positions.size))
+        starts = positions[first_index]
+        stops = starts + counts
+        yield (depth, parents[owner[first_index]], starts, stops,
+               digits[first_index])
+
+
+def morton_subdivide(x, y, width, height, threshold, max_depth=None,
+                     min_cell_size=None, bits=MORTON_BITS):
+    """Subdivide points into quadrants using sorted Morton codes.
+
+    Points are sorted once by Morton code, so that every node of the tree
+    is a contiguous run of the sorted points, and the runs of its children
+    are found where the next pair of code bits changes. Cells are
+    half-open, so each point belongs to exactly one quadrant per level.
+    The tree is at most bits levels deep, and max_depth and min_cell_size
+    limit it as in subdivide.
+
+    Returns the same (point, depth, lineage) memberships as subdivide.
+    """
+    n = len(x)
+    _check_threshold(n, threshold)
+    codes = morton_codes(x, y, width, height, bits)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+
+    levels = bits if max_depth is None else min(bits, max_depth)
+    if min_cell_size is not None:
+        while levels and max(width, height) / 2 ** levels < min_cell_size:
+            levels -= 1
+    lineage = ['']
+    node_starts, node_stops, node_depths, node_lineages = [], [], [], []
+    for depth, parents, starts, stops, digits in _morton_levels(
+            codes, threshold, levels, bits):
+        lineage = [lineage[p] + str(q + 1) + '.'
+                   for p, q in zip(parents.tolist(), digits.tolist())]
+        node_starts.append(starts)
+        node_stops.append(stops)
+        node_depths.append(np.full(len(starts), depth))
+        node_lineages.extend(lineage)
+
+    if not node_starts:
+        return (np.array([], dtype=np.intp), np.array([], dtype=int),
+                np.array([], dtype=object))
+    starts = np.concatenate(node_starts)
+    counts = np.concatenate(node_stops) - starts
+    depths = np.concatenate(node_depths)
+    # nodes in depth-first order: by first point, then parents first
+    nodes = np.lexsort((depths, starts))
+    counts = counts[nodes]
+    positions = _ranges(starts[nodes], counts)
+    nodes = np.repeat(nodes, counts)
+    node_lineages = np.array(node_lineages, dtype=object)
+    return order[positions], depths[nodes], node_lineages[nodes]
+
+
+def kdtree_subdivide(x, y, width, height, threshold, max_depth=None,
+                     min_cell_size=None):
+    """Subdivide points in halves at the median, alternating the axis.
+
+    Nodes are divided along x at odd depths and along y at even depths,
+    into the half of their points with the lower coordinates (digit 1) and
+    the rest (digit 2), so the tree is at most log2(n) levels deep however
+    the points are spread. The points are sorted once along each axis, and
+    every node is kept as a contiguous run of both orders, so that the
+    median of a node is the middle of its run and dividing a node only
+    partitions its run along the other axis. Nodes are not divided further
+    if all their points share the same coordinates, if they are max_depth
+    levels deep, or if their cell is smaller than twice min_cell_size along
+    both axes; cells are divided at the coordinate of their median point.
+
+    Returns the same (point, depth, lineage) memberships as subdivide.
+    """
+    n = len(x)
+    _check_threshold(n, threshold)
+    coords = (x, y)
+    runs = [np.argsort(x, kind='stable'), np.argsort(y, kind='stable')]
+    starts, stops = np.array([0]), np.array([n])
+    lo = [np.zeros(1), np.zeros(1)]
+    size = [np.array([width], dtype=float), np.array([height], dtype=float)]
+    side = np.empty(n, dtype=np.intp)
+    lineage = ['']
+    node_starts, node_stops, node_depths, node_lineages = [], [], [], []
+    depth = 0
+    while max_depth is None or depth < max_depth:
+        counts = stops - starts
+        # runs are sorted along each axis, so their ends are the extremes
+        identical = np.ones(len(starts), dtype=bool)
+        for axis in range(2):
+            run = coords[axis][runs[axis]]
+            identical &= run[starts] == run[stops - 1]
+        split = (counts >= threshold) & ~identical
+        if min_cell_size is not None:
+            split &= np.maximum(size[0], size[1]) / 2 >= min_cell_size
+        if not split.any():
+            break
+        axis = depth % 2
+        depth += 1
+        starts, counts = starts[split], counts[split]
+        lo = [v[split] for v in lo]
+        size = [v[split] for v in size]
+        lineage = [lin for lin, s in zip(lineage, split) if s]
+        half = (counts + 1) // 2
+
+        # the lower half of each run along axis goes to the first child,
+        # and the runs along the other axis are partitioned alike
+        positions = _ranges(starts, counts)
+        owner = np.repeat(np.arange(len(starts)), counts)
+        run = runs[axis]
+        side[run[positions]] = positions - starts[owner] >= half[owner]
+        other = runs[1 - axis]
+        points = other[positions]
+        other[positions] = points[np.argsort(owner * 2 + side[points],
+                                             kind='stable')]
+
+        # children, with their cells divided at the median point
+        median = coords[axis][run[starts + half]]
+        stop = lo[axis] + size[axis]
+        starts = np.stack([starts, starts + half], axis=1).ravel()
+        stops = np.stack([starts[::2] + half, starts[::2] + counts],
+                         axis=1).ravel()
+        lo[axis] = np.stack([lo[axis], median], axis=1).ravel()
+        size[axis] = np.stack([median - lo[axis][::2], stop - median],
+                              axis=1).ravel()
+        lo[1 - axis] = np.repeat(lo[1 - axis], 2)
+        size[1 - axis] = np.repeat(size[1 - axis], 2)
+        lineage = [lin + digit for lin in lineage for digit in ('1.', '2.')]
+        node_starts.append(starts)
+        node_stops.append(stops)
+        node_depths.append(np.full(len(starts), depth))
+        node_lineages.extend(lineage)
+
+    if not node_starts:
+        return (np.array([], dtype=np.intp), np.array([], dtype=int),
+                np.array([], dtype=object))
+    starts = np.concatenate(node_starts)
+    counts = np.concatenate(node_stops) - starts
+    depths = np.concatenate(node_depths)
+    # nodes in depth-first order: by first point, then parents first
+    nodes = np.lexsort((depths, starts))
+    counts = counts[nodes]
+    positions = _ranges(starts[nodes], counts)
+    nodes = np.repeat(nodes, counts)
+    node_lineages = np.array(node_lineages, dtype=object)
+    return runs[0][positions], depths[nodes], node_lineages[nodes]
+
+
+METHODS = {'quadtree': subdivide, 'morton': morton_subdivide,
+           'kdtree': kdtree_subdivide}
+
+
+def lineage_chopper(depth, lineage):
+    lin = '.'.join(lineage.split('.', depth)[:depth])
+    if lineage.count('.') < depth:
+        lin = None
+    return lin
+
+
+def create_tree_df(bins, index, half_open=False):
     # create df for trees and df
     df = pd.DataFrame(bins, columns=[index, 'depth', 'lineage'])
-    try:
-        max_depth = max([lineage.count('.') for lineage in df['lineage']])+1
-    except ValueError:
+    if df.empty:
         raise ValueError("The threshold for subdivision is greater than "
                          "the amount of samples, "
                          "please chose a smaller threshold for division")
 
-    # for df only
-    def lineage_chopper(depth, lineage):
-        lin = '.'.join(lineage.split('.', depth)[:depth])
-        if lineage.count('.') < depth:
-            lin = None
-        return lin
+    # tree and df: the deepest bin of each sample (the first one on ties)
+    if half_open:
+        # samples have one bin per depth, and their deepest bin comes last
+        longest_lineages = df.drop_duplicates(index, keep='last')
+        longest_lineages = longest_lineages.sort_values(index, kind='stable')
+    else:
+        longest_lineages = df.sort_values(
+            [index, 'depth'], ascending=[True, False], kind='stable')
+        longest_lineages = longest_lineages.drop_duplicates(index)
+    return _lineage_results(longest_lineages.copy(), index)
+
 
+def _lineage_results(longest_lineages, index):
+    # for df only: chop each distinct lineage once, then broadcast
+    codes, lineages = pd.factorize(longest_lineages['lineage'])
+    max_depth = max(lineage.count('.') for lineage in lineages) + 1
     for depth in range(1, max_depth):
         name = 'split-depth-%d' % depth
-        df[name] = df['lineage'].apply(partial(lineage_chopper, depth))
-
-    # tree and df
-    longest_lineages = []
-    for sample_id, sample_grp in df.groupby(index):
-        sample_grp_sorted = sample_grp.sort_values('depth', ascending=False)
-        longest_lineages.append(sample_grp_sorted.iloc[0])
-    longest_lineages = pd.DataFrame(longest_lineages)
-    # tree only
-    lineage_bit = longest_lineages['lineage'].apply(
-        lambda lin: lin.split('.')[:-1])
-    taxonomy = [(i, lin) for i, lin in zip(longest_lineages[index],
-                                           lineage_bit)]
+        chopped = np.array([lineage_chopper(depth, lineage)
+                            for lineage in lineages], dtype=object)
+        longest_lineages[name] = chopped[codes]
+
     # df formatting
-    longest_lineages = pd.DataFrame(longest_lineages).set_index(index)
+    trees = lineage_tree(longest_lineages[index], longest_lineages['lineage'])
+    longest_lineages = longest_lineages.set_index(index)
     longest_lineages.index.name = index
-    trees = skbio.TreeNode.from_taxonomy(taxonomy)
-
-    # to allow plotting in q2-empress node lenght must be > 0,
-    # so set arbitrary node length
-    for node in trees.traverse():
-        if node.length is None:
-            node.length = 1.0
     return trees, longest_lineages
 
 
-def get_results(cleaned_df, threshold, index):
+def _adopt(parent, child):
+    # the tree is built before any of its caches exist, so children can be
+    # linked directly instead of through TreeNode.append
+    child.parent = parent
+    parent.children.append(child)
+
+
+def lineage_tree(sample_ids, lineages):
+    """Tree of bins, with each sample as a tip of its bin.
+
+    Bin nodes are named by their last lineage digit and created, like
+    children, in order of first appearance. To allow plotting in q2-empress
+    node lengths must be > 0, so all nodes have length 1.0.
+    """
+    root = skbio.TreeNode(length=1.0)
+    nodes = {'': root}
+    for sample_id, lineage in zip(sample_ids, lineages):
+        node = nodes.get(lineage)
+        if node is None:
+            # walk up to the nearest existing ancestor, then create the
+            # missing bins top-down
+            missing = []
+            while lineage not in nodes:
+                head, _, name = lineage[:-1].rpartition('.')
+                missing.append((lineage, name))
+                lineage = head + '.' if head else ''
+            node = nodes[lineage]
+            for lineage, name in reversed(missing):
+                child = skbio.TreeNode(name, length=1.0)
+                _adopt(node, child)
+                nodes[lineage] = node = child
+        _adopt(node, skbio.TreeNode(sample_id, length=1.0))
+    return root
+
+
+def _get_bins(cleaned_df, threshold, index, method, max_depth,
+              min_cell_size, half_open, n_jobs=1):
     cleaned_df = cleaned_df.reset_index()
     xy = cleaned_df.to_numpy()
     q = QTree(threshold, xy)
-    bins = q.subdivide(threshold)
-    tree, samples = create_tree_df(bins, index)
+    sample_ids, depths, lineages = q._subdivide(
+        threshold, method, max_depth, min_cell_size, half_open, n_jobs)
+    return pd.DataFrame({index: sample_ids, 'depth': depths,
+                         'lineage': lineages})
+
+
+def get_results(cleaned_df, threshold, index, method='quadtree',
+                max_depth=None, min_cell_size=None, half_open=False,
+                n_jobs=1):
+    bins = _get_bins(cleaned_df, threshold, index, method, max_depth,
+                     min_cell_size, half_open, n_jobs)
+    tree, samples = create_tree_df(
+        bins, index, half_open=half_open or method != 'quadtree')
     return tree, samples
 
 
+def prune_bins(bins, threshold, n_points):
+    """Bins of the tree that a larger threshold would have built.
+
+    Whether a node is divided depends on the threshold only through its
+    number of points, which never grows from parent to child. A node of the
+    tree built with a smaller threshold is therefore in the tree built with
+    threshold exactly if its parent holds at least threshold points. The
+    root holds all n_points points.
+    """
+    codes, lineages = pd.factorize(bins['lineage'])
+    counts = np.append(np.bincount(codes), n_points)
+    parents = pd.Index(lineages).get_indexer(
+        [lineage[:-1].rpartition('.')[0] + '.' for lineage in lineages])
+    alive = counts[parents] >= threshold
+    return bins[alive[codes]]
+
+
+def get_multi_results(cleaned_df, thresholds, index, method='quadtree',
+                      max_depth=None, min_cell_size=None, half_open=False):
+    thresholds = sorted(set(thresholds))
+    bins = _get_bins(cleaned_df, thresholds[0], index, method, max_depth,
+                     min_cell_size, half_open)
+    trees, samples = [], pd.DataFrame(index=pd.Index([], name=index))
+    for threshold in thresholds:
+        tree, samples_ = create_tree_df(
+            prune_bins(bins, threshold, len(cleaned_df)), index,
+            half_open=half_open or method != 'quadtree')
+        trees.append(tree)
+        samples = samples.join(
+            samples_['lineage'].rename('lineage-%d' % threshold),
+            how='outer')
+    return trees, samples
+
+
+def bin_statistics(bins, index, values, x_coord, y_coord):
+    """Sample count, centroid, bounding box and column means of every bin.
+
+    bins holds the (sample, depth, lineage) memberships as built, with the
+    memberships of each bin contiguous, so that every statistic is a single
+    reduction over runs. values holds the coordinates and the numeric
+    columns to average, indexed by sample; missing values are ignored.
+    """
+    lineages = bins['lineage'].to_numpy()
+    first = np.ones(len(lineages), dtype=bool)
+    first[1:] = lineages[1:] != lineages[:-1]
+    starts = np.flatnonzero(first)
+    counts = np.diff(np.append(starts, len(lineages)))
+    rows = values.index.get_indexer(bins[index])
+    x = values[x_coord].to_numpy(dtype=float)[rows]
+    y = values[y_coord].to_numpy(dtype=float)[rows]
+    stats = pd.DataFrame({
+        'depth': bins['depth'].to_numpy()[starts],
+        'count': counts,
+        'centroid-x': np.add.reduceat(x, starts) / counts,
+        'centroid-y': np.add.reduceat(y, starts) / counts,
+        'min-x': np.minimum.reduceat(x, starts),
+        'max-x': np.maximum.reduceat(x, starts),
+        'min-y': np.minimum.reduceat(y, starts),
+        'max-y': np.maximum.reduceat(y, starts)},
+        index=pd.Index(lineages[starts], name='lineage'))
+    for column in values.columns.drop([x_coord, y_coord]):
+        v = values[column].to_numpy(dtype=float)[rows]
+        missing = np.isnan(v)
+        n = counts - np.add.reduceat(missing, starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats['mean-%s' % column] = np.add.reduceat(
+                np.where(missing, 0., v), starts) / n
+    return stats
+
+
+def descend(x, y, width, height, split, half_open=False):
+    """Leaves of an existing quadtree that points fall into.
+
+    Points descend from the root through the nodes whose lineage is in
+    split, into quadrants computed as in subdivide, so a leaf may also be a
+    quadrant that held no points, or a node of split if a point lies in
+    none of its closed quadrants. Returns the point index, lineage, depth
+    and box (x0, y0, width, height) of each (point, leaf) membership.
+    """
+    points = np.arange(len(x))
+    lineage = np.full(points.size, '', dtype=object)
+    x0, y0 = np.zeros(points.size), np.zeros(points.size)
+    w = np.full(points.size, width, dtype=float)
+    h = np.full(points.size, height, dtype=float)
+    out = []
+    depth = 0
+    while points.size:
+        px, py = x[points], y[points]
+        # same arithmetic as subdivide, so boxes are identical
+        qx0, qy0, w_, h_ = _quadrants(x0, y0, w, h)
+
+        if half_open:
+            member = np.arange(points.size)
+            quad = ((py < qy0[0]) * 2 + (px >= qx0[1])).astype(np.intp)
+        else:
+            member, quad = [], []
+            for q in range(4):
+                inside = np.flatnonzero(
+                    (px >= qx0[q]) & (px <= qx0[q] + w_)
+                    & (py >= qy0[q]) & (py <= qy0[q] + h_))
+                member.append(inside)
+                quad.append(np.full(inside.size, q))
+            member, quad = np.concatenate(member), np.concatenate(quad)
+            # points between the rounded edges of the quadrants stay in
+            # their node, as in subdivide
+            lost = np.ones(points.size, dtype=bool)
+            lost[member] = False
+            if lost.any():
+                out.append((points[lost], lineage[lost],
+                            np.full(lost.sum(), depth), x0[lost], y0[lost],
+                            w[lost], h[lost]))
+        points = points[member]
+        x0 = np.stack(qx0)[quad, member]
+        y0 = np.stack(qy0)[quad, member]
+        w, h = w_[member], h_[member]
+        lineage = np.array([lin + str(q + 1) + '.' for lin, q in zip(
+            lineage[member], quad.tolist())], dtype=object)
+        depth += 1
+
+        inner = np.array([lin in split for lin in lineage], dtype=bool)
+        leaf = ~inner
+        out.append((points[leaf], lineage[leaf], np.full(leaf.sum(), depth),
+                    x0[leaf], y0[leaf], w[leaf], h[leaf]))
+        points, lineage = points[inner], lineage[inner]
+        x0, y0, w, h = x0[inner], y0[inner], w[inner], h[inner]
+    if not out:
+        return (np.array([], dtype=np.intp), np.array([], dtype=object),
+                np.array([], dtype=int)) + (np.array([]),) * 4
+    return tuple(np.concatenate(arrays) for arrays in zip(*out))
+
+
+def insert_points(lineages, cleaned_df, threshold, index, max_depth=None,
+                  min_cell_size=None, half_open=False):
+    """Add samples to a quadtree without rebuilding it.
+
+    lineages holds the bin of every sample in the quadtree, and cleaned_df
+    the coordinates of those and of the new samples, placed so that the
+    quadtree's root is the box from (0, 0) to the maxima of its samples.
+    New samples descend into the leaves they fall into, and only these
+    leaves are subdivided again. Adding points never joins bins, so with
+    the parameters the quadtree was built with this gives the same bins as
+    building it from all samples in the same root, and bins that received
+    no new samples keep their lineage.
+    """
+    ids = cleaned_df.index
+    x = cleaned_df.iloc[:, 0].to_numpy(dtype=float)
+    y = cleaned_df.iloc[:, 1].to_numpy(dtype=float)
+    is_old = ids.isin(lineages.index)
+    width, height = x[is_old].max(), y[is_old].max()
+    new = np.flatnonzero(~is_old)
+
+    codes, unique = pd.factorize(lineages)
+    samples = pd.DataFrame({
+        index: lineages.index,
+        'depth': np.array([lin.count('.') for lin in unique])[codes],
+        'lineage': lineages.to_numpy(dtype=object)})
+    if new.size == 0:
+        # nothing to add, all bins keep their lineage
+        return _lineage_results(
+            samples.sort_values(index, kind='stable').reset_index(drop=True),
+            index)
+    outside = ((x[new] < 0) | (x[new] > width)
+               | (y[new] < 0) | (y[new] > height))
+    if outside.any():
+        raise ValueError(
+            "Samples are outside of the area covered by the quadtree, "
+            "please rebuild it with all samples instead: %s"
+            % ', '.join(map(str, ids[new[outside]])))
+
+    # nodes with children are the proper prefixes of the lineages
+    split = set()
+    for lineage in pd.unique(lineages):
+        dots = [i for i, c in enumerate(lineage[:-1]) if c == '.']
+        split.update(lineage[:i + 1] for i in dots)
+
+    # leaves receiving new samples, and the samples they already hold
+    points, leaves, depths, lx0, ly0, lw, lh = descend(
+        x[new], y[new], width, height, split, half_open)
+    touched, first = np.unique(leaves, return_index=True)
+    old = np.flatnonzero(is_old)
+    ox, oy = x[old], y[old]
+    order = np.argsort(ox, kind='stable')
+    sx = ox[order]
+    # leaf boxes are widened by far more than the rounding of their edges,
+    # as candidates descend again to find their leaves
+    pad = 1e-9 * max(width, height)
+    candidates = []
+    for i in first:
+        lo = np.searchsorted(sx, lx0[i] - pad, side='left')
+        hi = np.searchsorted(sx, lx0[i] + lw[i] + pad, side='right')
+        box = order[lo:hi]
+        candidates.append(box[(oy[box] >= ly0[i] - pad)
+                              & (oy[box] <= ly0[i] + lh[i] + pad)])
+    candidates = old[np.unique(np.concatenate(
+        candidates + [np.array([], dtype=np.intp)]))]
+    members = descend(x[candidates], y[candidates], width, height, split,
+                      half_open)
+    keep = np.isin(members[1], touched)
+    members = [candidates[members[0][keep]]] + [
+        array[keep] for array in members[1:]]
+    points, leaves, depths, lx0, ly0, lw, lh = (
+        np.concatenate([a, b]) for a, b in zip(
+            [new[points], leaves, depths, lx0, ly0, lw, lh], members))
+
+    affected = samples[index].isin(ids[points])
+
+    # memberships of the touched leaves and of their new subtrees, competing
+    # with the bins the affected samples had
+    bins = [samples[affected],
+            pd.DataFrame({index: ids[points], 'depth': depths,
+                          'lineage': leaves})]
+    order = np.argsort(leaves, kind='stable')
+    starts = np.flatnonzero(np.r_[True, leaves[order][1:]
+                                  != leaves[order][:-1]])
+    for start, stop in zip(starts, np.r_[starts[1:], order.size]):
+        leaf = order[start:stop]
+        i = leaf[0]
+        if max_depth is not None and depths[i] >= max_depth:
+            continue
+        sub = points[leaf]
+        _check_threshold(sub.size, threshold)
+        # the samples descended into this leaf, so they are not checked
+        # against its rounded edges
+        sub_points, sub_depths, sub_lineages = _depth_first(
+            *_subdivide_nodes(
+                x[sub], y[sub], lw[i], lh[i], threshold,
+                None if max_depth is None else max_depth - depths[i],
+                min_cell_size, half_open, (lx0[i], ly0[i]), None, None))
+        bins.append(pd.DataFrame({
+            index: ids[sub[sub_points]],
+            'depth': depths[i] + sub_depths,
+            'lineage': leaves[i] + sub_lineages}))
+    bins = pd.concat(bins, ignore_index=True)
+
+    # the deepest bin of each affected sample (the first one on ties)
+    bins = bins.sort_values(
+        [index, 'depth', 'lineage'], ascending=[True, False, True],
+        kind='stable').drop_duplicates(index)
+    longest_lineages = pd.concat([samples[~affected], bins]).sort_values(
+        index, kind='stable')
+    return _lineage_results(longest_lineages.reset_index(drop=True), index)
+
+
 def quadtree(metadata: qiime2.Metadata,
              y_coord: str,
              x_coord: str,
-             threshold: int) -> (skbio.TreeNode, pd.DataFrame):
+             threshold: int,
+             method: str = 'quadtree',
+             max_depth: int = None,
+             min_cell_size: float = None,
+             half_open: bool = False,
+             n_jobs: int = 1) -> (skbio.TreeNode, pd.DataFrame):
+    metadata = metadata.to_dataframe()
+    index = metadata.index.name
+    cleaned_df = clean(metadata, y_coord, x_coord)
+    tree, samples = get_results(cleaned_df, threshold, index, method,
+                                max_depth, min_cell_size, half_open, n_jobs)
+    return tree, samples
+
+
+def octree(metadata: qiime2.Metadata,
+           y_coord: str,
+           x_coord: str,
+           z_coord: str,
+           threshold: int,
+           max_depth: int = None,
+           min_cell_size: float = None,
+           half_open: bool = False,
+           n_jobs: int = 1) -> (skbio.TreeNode, pd.DataFrame):
+    metadata = metadata.to_dataframe()
+    index = metadata.index.name
+    cleaned_df = clean(metadata, y_coord, x_coord, z_coord=z_coord)
+    tree, samples = get_results(cleaned_df, threshold, index, 'quadtree',
+                                max_depth, min_cell_size, half_open, n_jobs)
+    return tree, samples
+
+
+def quadtree_statistics(
+        metadata: qiime2.Metadata,
+        y_coord: str,
+        x_coord: str,
+        threshold: int,
+        columns: list = None,
+        method: str = 'quadtree',
+        max_depth: int = None,
+        min_cell_size: float = None,
+        half_open: bool = False) -> (skbio.TreeNode, pd.DataFrame,
+                                     pd.DataFrame):
     metadata = metadata.to_dataframe()
     index = metadata.index.name
+    columns = [] if columns is None else list(columns)
+    missing = [column for column in columns if column not in metadata]
+    if missing:
+        raise ValueError('Columns not found in metadata: %s'
+                         % ', '.join(missing))
     cleaned_df = clean(metadata, y_coord, x_coord)
-    tree, samples = get_results(cleaned_df, threshold, index)
+    bins = _get_bins(cleaned_df, threshold, index, method, max_depth,
+                     min_cell_size, half_open)
+    tree, samples = create_tree_df(
+        bins, index, half_open=half_open or method != 'quadtree')
+
+    # statistics in the units of the metadata
+    values = metadata.loc[cleaned_df.index, columns].copy()
+    for column in columns:
+        try:
+            values[column] = pd.to_numeric(values[column])
+        except ValueError:
+            raise ValueError('Column "%s" is not numeric.' % column)
+    values[x_coord] = pd.to_numeric(metadata.loc[cleaned_df.index, x_coord])
+    values[y_coord] = pd.to_numeric(metadata.loc[cleaned_df.index, y_coord])
+    statistics = bin_statistics(bins, index, values, x_coord, y_coord)
+    return tree, samples, statistics
+
+
+def multi_threshold_quadtree(
+        metadata: qiime2.Metadata,
+        y_coord: str,
+        x_coord: str,
+        thresholds: list,
+        method: str = 'quadtree',
+        max_depth: int = None,
+        min_cell_size: float = None,
+        half_open: bool = False) -> (skbio.TreeNode, pd.DataFrame):
+    metadata = metadata.to_dataframe()
+    index = metadata.index.name
+    cleaned_df = clean(metadata, y_coord, x_coord)
+    trees, samples = get_multi_results(cleaned_df, thresholds, index, method,
+                                       max_depth, min_cell_size, half_open)
+    # the bins of larger thresholds are clades of the finest tree
+    return trees[0], samples
+
+
+def insert_quadtree(
+        quadtree: pd.DataFrame,
+        metadata: qiime2.Metadata,
+        y_coord: str,
+        x_coord: str,
+        threshold: int,
+        max_depth: int = None,
+        min_cell_size: float = None,
+        half_open: bool = False) -> (skbio.TreeNode, pd.DataFrame):
+    if 'lineage' not in quadtree:
+        raise ValueError("The quadtree table has no lineage column, please "
+                         "use a table made by the quadtree action.")
+    digits = set(''.join(pd.unique(quadtree['lineage']))) - {'.'}
+    if not digits <= set('1234'):
+        raise ValueError("The quadtree table has bins other than quadrants, "
+                         "please use a table made by the quadtree action, "
+                         "not by the octree action.")
+    metadata = metadata.to_dataframe()
+    index = metadata.index.name
+    missing = quadtree.index.difference(metadata.index)
+    if len(missing) == 0:
+        old = metadata.loc[quadtree.index, [x_coord, y_coord]].apply(
+            pd.to_numeric, errors='coerce')
+        missing = old.index[old.isna().any(axis=1)]
+    if len(missing):
+        raise ValueError("Samples in the quadtree have no coordinates in "
+                         "the metadata: %s" % ', '.join(missing))
+    # the quadtree's root is the area covered by its samples
+    cleaned_df = clean(metadata, y_coord, x_coord,
+                       origin=(old[x_coord].min(), old[y_coord].min()))
+    tree, samples = insert_points(quadtree['lineage'], cleaned_df, threshold,
+                                  index, max_depth, min_cell_size, half_open)
     return tree, samples
+
+
+class QuadTreeIndex():
+    """A Morton-ordered quadtree over points, kept as flat arrays.
+
+    Points are stored sorted by Morton code, with order mapping them back to
+    their input positions. Every node is a contiguous run start:stop of the
+    sorted points, bounded by the tight bounding box of its points
+    (min x, min y, max x, max y). Nodes are stored level by level, so the
+    children of a node are the n_children nodes from first_child on.
+    """
+    ARRAYS = ('sample_ids', 'x', 'y', 'order', 'bounds', 'start', 'stop',
+              'first_child', 'n_children')
+
+    def __init__(self, sample_ids, x, y, order, bounds, start, stop,
+                 first_child, n_children, x_coord='x', y_coord='y',
+                 index_name='id'):
+        self.sample_ids = np.asarray(sample_ids, dtype=str)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.order = np.asarray(order, dtype=np.intp)
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.start = np.asarray(start, dtype=np.intp)
+        self.stop = np.asarray(stop, dtype=np.intp)
+        self.first_child = np.asarray(first_child, dtype=np.intp)
+        self.n_children = np.asarray(n_children, dtype=np.intp)
+        self.x_coord, self.y_coord = x_coord, y_coord
+        self.index_name = index_name
+
+    @classmethod
+    def build(cls, sample_ids, x, y, threshold=16, **kwargs):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        n = len(x)
+        if n == 0:
+            raise ValueError('Cannot build a spatial index without samples.')
+        _check_threshold(n, threshold)
+        x_min, y_min = x.min(), y.min()
+        codes = morton_codes(x - x_min, y - y_min, x.max() - x_min,
+                             y.max() - y_min)
+        order = np.argsort(codes, kind='stable')
+        codes, x, y = codes[order], x[order], y[order]
+
+        starts, stops, parents = [np.array([0])], [np.array([n])], []
+        for _, parent, start, stop, _ in _morton_levels(
+                codes, threshold, MORTON_BITS):
+            starts.append(start)
+            stops.append(stop)
+            parents.append(parent)
+        sizes = [len(start) for start in starts]
+        offsets = np.cumsum([0] + sizes)
+        first_child = np.zeros(offsets[-1], dtype=np.intp)
+        n_children = np.zeros(offsets[-1], dtype=np.intp)
+        for level, parent in enumerate(parents):
+            counts = np.bincount(parent, minlength=sizes[level])
+            level_nodes = slice(offsets[level], offsets[level + 1])
+            n_children[level_nodes] = counts
+            first_child[level_nodes] = (offsets[level + 1] + np.cumsum(counts)
+                                        - counts)
+
+        bounds = [_run_bounds(x, y, start, stop)
+                  for start, stop in zip(starts, stops)]
+        return cls(np.asarray(sample_ids)[order], x, y, order,
+                   np.concatenate(bounds), np.concatenate(starts),
+                   np.concatenate(stops), first_child, n_children, **kwargs)
+
+    def __len__(self):
+        return len(self.x)
+
+    def save(self, fh):
+        np.savez(fh, x_coord=self.x_coord, y_coord=self.y_coord,
+                 index_name=self.index_name,
+                 **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, fh):
+        with np.load(fh, allow_pickle=False) as data:
+            return cls(*(data[name] for name in cls.ARRAYS),
+                       x_coord=str(data['x_coord']),
+                       y_coord=str(data['y_coord']),
+                       index_name=str(data['index_name']))
+
+    def _children(self, nodes):
+        return _ranges(self.first_child[nodes], self.n_children[nodes])
+
+    def _points(self, nodes):
+        return _ranges(self.start[nodes], self.stop[nodes] - self.start[nodes])
+
+    def bounding_box(self, min_x, max_x, min_y, max_y):
+        """Input positions of the points in a (closed) bounding box."""
+        nodes, found = np.array([0]), []
+        while nodes.size:
+            b = self.bounds[nodes]
+            overlap = ((b[:, 0] <= max_x) & (b[:, 2] >= min_x)
+                       & (b[:, 1] <= max_y) & (b[:, 3] >= min_y))
+            nodes, b = nodes[overlap], b[overlap]
+            inside = ((b[:, 0] >= min_x) & (b[:, 2] <= max_x)
+                      & (b[:, 1] >= min_y) & (b[:, 3] <= max_y))
+            leaf = self.n_children[nodes] == 0
+            found.append(self._points(nodes[inside]))
+            points = self._points(nodes[~inside & leaf])
+            x, y = self.x[points], self.y[points]
+            found.append(points[(x >= min_x) & (x <= max_x)
+                                & (y >= min_y) & (y <= max_y)])
+            nodes = self._children(nodes[~inside & ~leaf])
+        return np.sort(self.order[np.concatenate(found)])
+
+    def _within(self, qx, qy, radius):
+        # (query, sorted point, distance) of points within radius of queries
+        queries = np.arange(len(qx))
+        nodes = np.zeros(len(qx), dtype=np.intp)
+        found_queries, found_points = [], []
+        while nodes.size:
+            b = self.bounds[nodes]
+            x, y, r2 = qx[queries], qy[queries], radius[queries] ** 2
+            dx = np.maximum(np.maximum(b[:, 0] - x, x - b[:, 2]), 0)
+            dy = np.maximum(np.maximum(b[:, 1] - y, y - b[:, 3]), 0)
+            near = dx * dx + dy * dy <= r2
+            queries, nodes, b = queries[near], nodes[near], b[near]
+            x, y, r2 = x[near], y[near], r2[near]
+            fx = np.maximum(np.abs(x - b[:, 0]), np.abs(x - b[:, 2]))
+            fy = np.maximum(np.abs(y - b[:, 1]), np.abs(y - b[:, 3]))
+            # whole nodes within radius, or leaves to scan
+            scan = (fx * fx + fy * fy <= r2) | (self.n_children[nodes] == 0)
+            counts = self.stop[nodes[scan]] - self.start[nodes[scan]]
+            found_queries.append(np.repeat(queries[scan], counts))
+            found_points.append(self._points(nodes[scan]))
+            queries = np.repeat(queries[~scan], self.n_children[nodes[~scan]])
+            nodes = self._children(nodes[~scan])
+        queries = np.concatenate(found_queries)
+        points = np.concatenate(found_points)
+        distances = np.hypot(self.x[points] - qx[queries],
+                             self.y[points] - qy[queries])
+        keep = distances <= radius[queries]
+        return queries[keep], points[keep], distances[keep]
+
+    def neighbors(self, x, y, k=None, radius=None, exclude=None,
+                  chunk_size=1024):
+        """Points within radius of, and/or the k nearest points to, queries.
+
+        exclude optionally gives, per query, the input position of a point
+        to leave out (e.g. the query itself), or -1. Returns the query
+        index, input position and euclidean distance of each neighbor,
+        sorted by query, then distance, then input position.
+        """
+        if k is None and radius is None:
+            raise ValueError('Either k or radius must be provided.')
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if exclude is None:
+            exclude = np.full(len(x), -1)
+        results = [self._neighbors(x[i:i + chunk_size], y[i:i + chunk_size],
+                                   k, radius, exclude[i:i + chunk_size])
+                   for i in range(0, len(x), chunk_size)]
+        if not results:
+            return (np.array([], dtype=np.intp), np.array([], dtype=np.intp),
+                    np.array([]))
+        queries = np.concatenate([q + i * chunk_size
+                                  for i, (q, _, _) in enumerate(results)])
+        return (queries, np.concatenate([p for _, p, _ in results]),
+                np.concatenate([d for _, _, d in results]))
+
+    def _neighbors(self, x, y, k, radius, exclude):
+        n = len(self)
+        x_min, y_min, x_max, y_max = self.bounds[0]
+        # distance from each query to the farthest corner of the index
+        farthest = np.hypot(np.maximum(np.abs(x - x_min), np.abs(x - x_max)),
+                            np.maximum(np.abs(y - y_min), np.abs(y - y_max)))
+        if radius is not None:
+            r = np.full(len(x), float(radius))
+        else:
+            # start from the radius expected to hold k points, past the
+            # distance of the query to the index, and double it as needed
+            area = (x_max - x_min) * (y_max - y_min)
+            if area > 0:
+                r0 = np.sqrt(area * k / (np.pi * n))
+            else:
+                r0 = max(x_max - x_min, y_max - y_min, 1.0) * k / n
+            dx = np.maximum(np.maximum(x_min - x, x - x_max), 0)
+            dy = np.maximum(np.maximum(y_min - y, y - y_max), 0)
+            r = np.hypot(dx, dy) + r0
+
+        found, pending = [], np.arange(len(x))
+        while pending.size:
+            queries, points, distances = self._within(
+                x[pending], y[pending], r[pending])
+            queries = pending[queries]
+            keep = self.order[points] != exclude[queries]
+            queries, points, distances = (
+                queries[keep], points[keep], distances[keep])
+            if radius is None:
+                counts = np.bincount(queries, minlength=len(x))[pending]
+                wanted = np.minimum(k, n - (exclude[pending] >= 0))
+                done = (counts >= wanted) | (r[pending] >= farthest[pending])
+                keep = np.isin(queries, pending[done])
+                found.append((queries[keep], points[keep], distances[keep]))
+                pending = pending[~done]
+                r[pending] *= 2
+            else:
+                found.append((queries, points, distances))
+                pending = pending[:0]
+
+        queries = np.concatenate([q for q, _, _ in found])
+        positions = self.order[np.concatenate([p for _, p, _ in found])]
+        distances = np.concatenate([d for _, _, d in found])
+        order = np.lexsort((positions, distances, queries))
+        queries, positions, distances = (
+            queries[order], positions[order], distances[order])
+        if k is not None:
+            first = np.searchsorted(queries, queries)
+            rank = np.arange(len(queries)) - first
+            keep = rank < k
+            queries, positions, distances = (
+                queries[keep], positions[keep], distances[keep])
+        return queries, positions, distances
+
+
+def _run_bounds(x, y, start, stop):
+    # bounding boxes of the points in runs start:stop
+    indices = np.column_stack([start, stop]).ravel()
+    x, y = np.append(x, 0), np.append(y, 0)
+    return np.column_stack([np.minimum.reduceat(x, indices)[::2],
+                            np.minimum.reduceat(y, indices)[::2],
+                            np.maximum.reduceat(x, indices)[::2],
+                            np.maximum.reduceat(y, indices)[::2]])
+
+
+def _index_coordinates(metadata, x_coord, y_coord):
+    for column, name in ((x_coord, 'x_coord'), (y_coord, 'y_coord')):
+        if column not in metadata:
+            raise ValueError('Must have %s in metadata to use spatial '
+                             'indexes' % name)
+    df = metadata[[x_coord, y_coord]].apply(pd.to_numeric, errors='coerce')
+    df = df.dropna()
+    if df.empty:
+        raise ValueError("x coordinates and/or y coordinates have "
+                         "no numeric values, please check your data.")
+    return df
+
+
+def build_spatial_index(metadata: qiime2.Metadata,
+                        x_coord: str,
+                        y_coord: str,
+                        threshold: int = 16) -> QuadTreeIndex:
+    metadata = metadata.to_dataframe()
+    df = _index_coordinates(metadata, x_coord, y_coord)
+    return QuadTreeIndex.build(
+        df.index, df[x_coord], df[y_coord], threshold, x_coord=x_coord,
+        y_coord=y_coord, index_name=metadata.index.name)
+
+
+def query_bounding_box(index: QuadTreeIndex,
+                       min_x: float,
+                       max_x: float,
+                       min_y: float,
+                       max_y: float) -> pd.DataFrame:
+    positions = index.order.argsort()[index.bounding_box(
+        min_x, max_x, min_y, max_y)]
+    if positions.size == 0:
+        raise ValueError('No samples were found in the bounding box.')
+    df = pd.DataFrame({index.x_coord: index.x[positions],
+                       index.y_coord: index.y[positions]},
+                      index=pd.Index(index.sample_ids[positions],
+                                     name=index.index_name))
+    return df
+
+
+def query_neighbors(index: QuadTreeIndex,
+                    metadata: qiime2.Metadata,
+                    k: int = None,
+                    radius: float = None) -> pd.DataFrame:
+    metadata = metadata.to_dataframe()
+    df = _index_coordinates(metadata, index.x_coord, index.y_coord)
+    # queries that are indexed samples are not their own neighbors
+    position = pd.Series(index.order, index=index.sample_ids)
+    exclude = position.reindex(df.index.astype(str)).fillna(-1).to_numpy(int)
+    queries, positions, distances = index.neighbors(
+        df[index.x_coord], df[index.y_coord], k=k, radius=radius,
+        exclude=exclude)
+    sample_ids = index.sample_ids[index.order.argsort()]
+    return pd.DataFrame({'sample_id': df.index[queries],
+                         'neighbor_id': sample_ids[positions],
+                         'distance': distances})
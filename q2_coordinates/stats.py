@@ -9,12 +9,13 @@
 
 import matplotlib.pyplot as plt
 import qiime2
-from pysal.explore.esda import geary, moran
-from pysal.lib import weights as psw
 import pandas as pd
 from skbio import DistanceMatrix
 import seaborn as sns
 from ._utilities import save_map, mapviz
+from ._autocorr import (
+    sparse_weights, transform_weights, analytical_statistics,
+    permutation_statistics, simulated_inference)
 
 
 def autocorr(output_dir: str,
@@ -23,7 +24,16 @@ def autocorr(output_dir: str,
              permutations: int = 999,
              two_tailed: bool = True,
              transformation: str = 'R',
-             intersect_ids: bool = False) -> None:
+             intersect_ids: bool = False,
+             k: int = None,
+             radius: float = None,
+             kernel: str = 'distance',
+             bandwidth: float = None,
+             power: float = 1.,
+             random_seed: int = None,
+             n_jobs: int = 1,
+             adaptive: bool = False,
+             min_exceedances: int = 10) -> None:
     # match ids — metadata can be superset
     metadata = metadata.to_series()
     metadata, distance_matrix = match_ids(
@@ -34,9 +44,14 @@ def autocorr(output_dir: str,
                                         distance_matrix,
                                         permutations=permutations,
                                         two_tailed=two_tailed,
-                                        transformation=transformation)
+                                        transformation=transformation,
+                                        k=k, radius=radius, kernel=kernel,
+                                        bandwidth=bandwidth, power=power,
+                                        random_seed=random_seed,
+                                        n_jobs=n_jobs, adaptive=adaptive,
+                                        min_exceedances=min_exceedances)
 
-    mplot = moran_plot(metadata, weights, transformation)
+    mplot = moran_plot(metadata, weights)
 
     # Visualize
     save_map(mplot, output_dir)
@@ -63,13 +78,11 @@ def match_ids(metadata, distance_matrix, intersect_ids):
     return metadata, distance_matrix
 
 
-def moran_plot(metadata, weights, transformation):
+def moran_plot(metadata, weights):
     # standardize (center) metadata values
     std_y = (metadata - metadata.mean()) / metadata.std()
-    # perform designated transformation of weights matrix
-    weights.transform = transformation
-    # compute spatial lag
-    _spatial_lag = psw.spatial_lag.lag_spatial(weights, std_y)
+    # compute spatial lag with the transformed weights matrix
+    _spatial_lag = weights @ std_y.values
     # draw Moran plot
     sns.set_style("whitegrid")
     mplot = sns.regplot(x=std_y, y=_spatial_lag, color='grey')
@@ -81,26 +94,48 @@ def moran_plot(metadata, weights, transformation):
     return mplot
 
 
+def distance_weights(distance_matrix, k=None, radius=None,
+                     kernel='distance', bandwidth=None, power=1.):
+    # select neighbors from distance_matrix into a sparse weights matrix
+    return sparse_weights(distance_matrix.data, k=k, radius=radius,
+                          kernel=kernel, bandwidth=bandwidth, power=power)
+
+
 def autocorr_from_dm(metadata, distance_matrix, permutations, two_tailed,
-                     transformation):
-    # convert distance_matrix to weights matrix
-    weights = psw.util.full2W(distance_matrix.data, ids=distance_matrix.ids)
+                     transformation, k=None, radius=None, kernel='distance',
+                     bandwidth=None, power=1., random_seed=None, n_jobs=1,
+                     adaptive=False, min_exceedances=10):
+    # convert distance_matrix to transformed sparse weights matrix
+    weights = transform_weights(
+        distance_weights(distance_matrix, k=k, radius=radius, kernel=kernel,
+                         bandwidth=bandwidth, power=power),
+        transformation)
+    if weights.sum() == 0:
+        raise ValueError(
+            'No samples have neighbors with a nonzero weight (k={0}, '
+            'radius={1}, kernel={2}, bandwidth={3}), so autocorrelation '
+            'cannot be computed. Use a larger k, radius or '
+            'bandwidth.'.format(k, radius, kernel, bandwidth))
 
     # Compute autocorrelation stats
-    mi = moran.Moran(metadata, weights, permutations=permutations,
-                     two_tailed=two_tailed, transformation=transformation)
-
-    gc = geary.Geary(metadata, weights, permutations=permutations,
-                     transformation=transformation)
+    moran, geary = analytical_statistics(weights, metadata, two_tailed)
 
     names = ['Test Statistic', 'Expected Value', 'Z norm', 'p norm']
-    moran_res = [mi.I, mi.EI, mi.z_norm, mi.p_norm]
-    geary_res = [gc.C, gc.EC, gc.z_norm, gc.p_norm]
+    moran_res, geary_res = list(moran), list(geary)
     if permutations > 0:
-        names.extend(
-            ['Permuted Avg Test Statistic', 'Z simulated', 'p simulated'])
-        moran_res.extend([mi.EI_sim, mi.z_sim, mi.p_sim])
-        geary_res.extend([gc.EC_sim, gc.z_sim, gc.p_sim])
+        # permuted statistics share each permutation
+        moran_sim, geary_sim = permutation_statistics(
+            weights, metadata, permutations, seed=random_seed,
+            n_jobs=n_jobs, observed=(moran[0], geary[0]),
+            min_exceedances=min_exceedances if adaptive else None)
+        names.extend(['Permuted Avg Test Statistic', 'Z simulated',
+                      'p simulated', 'Permutations used'])
+        moran_res.extend(
+            simulated_inference(moran[0], moran_sim, permutations))
+        geary_res.extend(
+            simulated_inference(geary[0], geary_sim, permutations))
+        moran_res.append(len(moran_sim))
+        geary_res.append(len(geary_sim))
 
     results = pd.DataFrame(
         {'Moran\'s I': moran_res, 'Geary\'s C': geary_res}, index=names)
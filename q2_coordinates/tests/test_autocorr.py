@@ -0,0 +1,279 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial.distance import cdist
+
+from q2_coordinates._autocorr import (
+    sparse_weights, kernel_weights, transform_weights, analytical_statistics,
+    permutation_statistics, simulated_inference, _permutation_chunks)
+
+
+class TestSparseWeights(unittest.TestCase):
+
+    def setUp(self):
+        # integer grid coordinates, with coincident points and tied distances
+        rng = np.random.RandomState(0)
+        points = rng.randint(0, 20, (60, 2)).astype(float)
+        self.distances = cdist(points, points)
+        self.n = len(points)
+
+    def brute_force(self, k, radius):
+        # distances to the selected neighbors, and the neighbor mask
+        exp = np.zeros_like(self.distances)
+        selected = np.zeros(exp.shape, dtype=bool)
+        for i in range(self.n):
+            neighbors = sorted(
+                (self.distances[i, j], j) for j in range(self.n) if j != i)
+            if k is not None:
+                neighbors = neighbors[:k]
+            if radius is not None:
+                neighbors = [(d, j) for d, j in neighbors if d <= radius]
+            for d, j in neighbors:
+                exp[i, j] = d
+                selected[i, j] = True
+        return exp, selected
+
+    def test_sparse_weights_match_brute_force(self):
+        for k, radius in ((None, None), (4, None), (None, 5.), (4, 5.)):
+            for block_size in (7, 2 ** 22):
+                obs = sparse_weights(self.distances, k=k, radius=radius,
+                                     block_size=block_size)
+                self.assertTrue(sparse.isspmatrix_csr(obs))
+                np.testing.assert_array_equal(
+                    obs.toarray(), self.brute_force(k, radius)[0])
+
+    def test_sparse_weights_drop_zero_distances(self):
+        obs = sparse_weights(self.distances)
+        self.assertEqual(obs.nnz, np.count_nonzero(self.distances))
+        self.assertTrue(np.all(obs.data > 0))
+
+    def test_sparse_weights_k_exceeds_n(self):
+        obs = sparse_weights(self.distances[:5, :5], k=10)
+        np.testing.assert_array_equal(obs.toarray(), self.distances[:5, :5])
+        self.assertEqual(sparse_weights([[0.]], k=10).nnz, 0)
+
+    def test_kernel_weights(self):
+        d = np.array([0., 1., 2.])
+        np.testing.assert_array_equal(kernel_weights(d), d)
+        np.testing.assert_allclose(
+            kernel_weights(d, 'inverse', power=2.), [np.inf, 1., 0.25])
+        np.testing.assert_allclose(
+            kernel_weights(d, 'gaussian', bandwidth=2.),
+            np.exp([0., -0.125, -0.5]))
+        np.testing.assert_allclose(
+            kernel_weights(d, 'exponential', bandwidth=2.),
+            np.exp([0., -0.5, -1.]))
+        np.testing.assert_array_equal(kernel_weights(d, 'binary'), [1, 1, 1])
+
+    def test_sparse_weights_kernels(self):
+        _, neighbors = self.brute_force(4, None)
+        coincident = neighbors & (self.distances == 0)
+        self.assertTrue(coincident.any())
+        for kernel in ('inverse', 'gaussian', 'exponential', 'binary'):
+            obs = sparse_weights(self.distances, k=4, kernel=kernel,
+                                 bandwidth=3., power=2., block_size=7)
+            exp = kernel_weights(self.distances, kernel, 3., 2.)
+            exp[~neighbors | np.isinf(exp)] = 0.
+            np.testing.assert_allclose(obs.toarray(), exp)
+            # coincident samples are only dropped by the inverse kernel
+            self.assertEqual(obs.toarray()[coincident].all(),
+                             kernel != 'inverse')
+        obs = sparse_weights(self.distances, kernel='binary')
+        self.assertEqual(obs.nnz, self.n * (self.n - 1))
+
+    def test_sparse_weights_drop_underflow(self):
+        obs = sparse_weights(self.distances, kernel='gaussian', bandwidth=0.1)
+        exp = kernel_weights(self.distances, 'gaussian', bandwidth=0.1)
+        np.fill_diagonal(exp, 0.)
+        self.assertEqual(obs.nnz, np.count_nonzero(exp))
+
+    def test_invalid_kernel(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown kernel'):
+            sparse_weights(self.distances, kernel='triangular')
+        with self.assertRaisesRegex(ValueError, 'bandwidth must be defined'):
+            sparse_weights(self.distances, kernel='gaussian')
+
+    def test_sparse_weights_not_square(self):
+        with self.assertRaisesRegex(ValueError, 'square'):
+            sparse_weights(self.distances[:5])
+
+
+class TestPermutationStatistics(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        points = rng.uniform(0, 10, (40, 2))
+        self.weights = sparse_weights(
+            cdist(points, points), k=5, kernel='inverse')
+        self.values = points[:, 0] + rng.normal(size=40)
+
+    def moran(self, y):
+        w = self.weights.toarray()
+        z = y - y.mean()
+        return len(y) / w.sum() * (z @ w @ z) / (z @ z)
+
+    def geary(self, y):
+        w = self.weights.toarray()
+        z = y - y.mean()
+        num = (w * (y[:, None] - y[None, :]) ** 2).sum()
+        return (len(y) - 1) * num / (2 * w.sum() * (z @ z))
+
+    def test_permutation_statistics_match_brute_force(self):
+        n = len(self.values)
+        obs_i, obs_c = permutation_statistics(
+            self.weights, self.values, 25, seed=11, block_size=3 * n)
+        self.assertEqual(len(obs_i), 25)
+        # regenerate the permutations from the spawned random streams
+        sizes = _permutation_chunks(25, n, 3 * n)
+        self.assertEqual(sizes, [3] * 8 + [1])
+        seeds = np.random.SeedSequence(11).spawn(len(sizes))
+        exp_i, exp_c = [], []
+        for size, seed in zip(sizes, seeds):
+            rng = np.random.default_rng(seed)
+            batch = rng.permuted(
+                np.tile(self.values[:, None], (1, size)), axis=0)
+            exp_i.extend(self.moran(y) for y in batch.T)
+            exp_c.extend(self.geary(y) for y in batch.T)
+        np.testing.assert_allclose(obs_i, exp_i, rtol=1e-12)
+        np.testing.assert_allclose(obs_c, exp_c, rtol=1e-12)
+
+    def test_transform_weights(self):
+        w = self.weights.toarray()
+        n = len(w)
+        exp = {'O': w,
+               'B': (w > 0).astype(float),
+               'R': w / w.sum(axis=1, keepdims=True),
+               'D': w / w.sum()}
+        q = w / np.sqrt((w ** 2).sum(axis=1, keepdims=True))
+        exp['V'] = q * n / q.sum()
+        for transformation, weights in exp.items():
+            obs = transform_weights(self.weights, transformation)
+            self.assertTrue(sparse.isspmatrix_csr(obs))
+            np.testing.assert_allclose(obs.toarray(), weights, rtol=1e-12)
+        # the input is not modified
+        np.testing.assert_array_equal(self.weights.toarray(), w)
+        with self.assertRaisesRegex(ValueError, 'Unknown transformation'):
+            transform_weights(self.weights, 'X')
+
+    def test_transform_weights_islands(self):
+        weights = sparse.csr_matrix(np.array([[0., 2.], [0., 0.]]))
+        for transformation in ('R', 'V'):
+            obs = transform_weights(weights, transformation)
+            self.assertTrue(np.isfinite(obs.data).all())
+            self.assertEqual(obs[1].nnz, 0)
+
+    def test_analytical_statistics(self):
+        moran, geary = analytical_statistics(self.weights, self.values)
+        self.assertAlmostEqual(moran[0], self.moran(self.values), places=12)
+        self.assertAlmostEqual(geary[0], self.geary(self.values), places=12)
+        self.assertEqual(moran[1], -1 / (len(self.values) - 1))
+        self.assertEqual(geary[1], 1.)
+        one_tailed, _ = analytical_statistics(
+            self.weights, self.values, two_tailed=False)
+        self.assertAlmostEqual(moran[3], 2 * one_tailed[3])
+        self.assertEqual(moran[2], one_tailed[2])
+
+    def test_permutation_statistics_reproducible(self):
+        exp = permutation_statistics(self.weights, self.values, 99, seed=5)
+        obs = permutation_statistics(self.weights, self.values, 99, seed=5)
+        np.testing.assert_array_equal(obs, exp)
+        obs = permutation_statistics(self.weights, self.values, 99, seed=6)
+        self.assertFalse(np.array_equal(obs, exp))
+
+    def test_permutation_statistics_parallel_identical_to_serial(self):
+        n = len(self.values)
+        exp = permutation_statistics(
+            self.weights, self.values, 101, seed=7, block_size=10 * n)
+        for n_jobs in (2, 3, 20):
+            obs = permutation_statistics(
+                self.weights, self.values, 101, seed=7, n_jobs=n_jobs,
+                block_size=10 * n)
+            np.testing.assert_array_equal(obs, exp)
+        # a single batch is computed serially
+        exp = permutation_statistics(self.weights, self.values, 50, seed=7)
+        obs = permutation_statistics(
+            self.weights, self.values, 50, seed=7, n_jobs=2)
+        np.testing.assert_array_equal(obs, exp)
+
+    def test_permutation_statistics_null_distribution(self):
+        moran, geary = permutation_statistics(
+            self.weights, self.values, 2000, seed=0, block_size=400)
+        n = len(self.values)
+        self.assertAlmostEqual(moran.mean(), -1 / (n - 1), places=2)
+        self.assertAlmostEqual(geary.mean(), 1., places=1)
+        # the values are spatially autocorrelated
+        _, _, p = simulated_inference(self.moran(self.values), moran)
+        self.assertEqual(p, 1 / 2001)
+        _, _, p = simulated_inference(self.geary(self.values), geary)
+        self.assertEqual(p, 1 / 2001)
+
+    def test_permutation_statistics_adaptive_stop(self):
+        n = len(self.values)
+        # a null variable, with observed statistics near their expectations
+        null = np.random.RandomState(1).permutation(self.values)
+        observed = (self.moran(null), self.geary(null))
+        full = permutation_statistics(
+            self.weights, null, 999, seed=2, block_size=7 * n)
+        obs = permutation_statistics(
+            self.weights, null, 999, seed=2, observed=observed,
+            min_exceedances=10, block_size=7 * n)
+        # stops at the first permutation where both tails reach 10
+        used = len(obs[0])
+        self.assertLess(used, 100)
+
+        def tail(simulated, statistic):
+            return min((simulated >= statistic).sum(),
+                       (simulated < statistic).sum())
+
+        for sim, exp, statistic in zip(obs, full, observed):
+            np.testing.assert_array_equal(sim, exp[:used])
+            self.assertGreaterEqual(tail(exp[:used], statistic), 10)
+        self.assertLess(min(tail(exp[:used - 1], statistic)
+                            for exp, statistic in zip(full, observed)), 10)
+        for n_jobs in (2, 4):
+            parallel = permutation_statistics(
+                self.weights, null, 999, seed=2, observed=observed,
+                min_exceedances=10, n_jobs=n_jobs, block_size=7 * n)
+            np.testing.assert_array_equal(parallel, obs)
+
+    def test_permutation_statistics_adaptive_significant(self):
+        # significant results use the whole budget
+        observed = (self.moran(self.values), self.geary(self.values))
+        moran, geary = permutation_statistics(
+            self.weights, self.values, 500, seed=0, observed=observed,
+            min_exceedances=10, block_size=100)
+        self.assertEqual(len(moran), 500)
+        self.assertEqual(len(geary), 500)
+
+    def test_permutation_statistics_adaptive_no_observed(self):
+        with self.assertRaisesRegex(ValueError, 'observed statistics'):
+            permutation_statistics(
+                self.weights, self.values, 99, min_exceedances=10)
+
+    def test_simulated_inference_early_stop(self):
+        simulated = np.array([1., 2., 3., 4., 5.])
+        # Besag & Clifford estimate after stopping within the budget
+        self.assertEqual(simulated_inference(4.5, simulated, 99)[2], 1 / 5)
+        self.assertEqual(simulated_inference(4.5, simulated, 5)[2], 2 / 6)
+
+    def test_simulated_inference(self):
+        simulated = np.array([1., 2., 3., 4.])
+        mean, z, p = simulated_inference(3.5, simulated)
+        self.assertEqual(mean, 2.5)
+        self.assertEqual(z, 1. / simulated.std())
+        self.assertEqual(p, 2 / 5)
+        self.assertEqual(simulated_inference(0., simulated)[2], 1 / 5)
+        self.assertEqual(simulated_inference(5., simulated)[2], 1 / 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,14 +7,20 @@
 # ----------------------------------------------------------------------------
 
 from q2_coordinates.plugin_setup import (
-    CoordinatesFormat, CoordinatesDirectoryFormat, Coordinates)
+    CoordinatesFormat, CoordinatesDirectoryFormat, Coordinates,
+    SpatialNeighborsFormat, SpatialNeighborsDirectoryFormat, SpatialNeighbors,
+    SpatialIndexFormat, SpatialIndexDirectoryFormat, SpatialIndex,
+    BinStatisticsFormat, BinStatisticsDirectoryFormat, BinStatistics)
+from q2_coordinates.qtrees import QuadTreeIndex
 from q2_types.sample_data import SampleData
 import tempfile
 import shutil
 import pkg_resources
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugin import ValidationError
+import numpy as np
 import pandas as pd
+import pandas.testing as pdt
 import qiime2
 
 
@@ -90,3 +96,136 @@ class TestSemanticTypes(CoordinatesTestPluginBase):
         exp = pd.Series(['38.306', '38.306', '38.306', '38.306'],
                         name='Latitude', index=exp_index)
         self.assertEqual(sorted(exp), sorted(obs_category.to_series()))
+
+
+class TestSpatialNeighborsTypes(CoordinatesTestPluginBase):
+
+    def test_spatial_neighbors_format_validate_positive(self):
+        filepath = self.get_data_path('spatial_neighbors.tsv')
+        format = SpatialNeighborsFormat(filepath, mode='r')
+        format.validate()
+
+    def test_spatial_neighbors_format_validate_negative(self):
+        filepath = self.get_data_path('bad_spatial_neighbors.tsv')
+        format = SpatialNeighborsFormat(filepath, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'SpatialNeighbors'):
+            format.validate()
+
+    def test_spatial_neighbors_dir_fmt_validate_positive(self):
+        filepath = self.get_data_path('spatial_neighbors.tsv')
+        shutil.copy(filepath, self.temp_dir.name + '/neighbors.tsv')
+        format = SpatialNeighborsDirectoryFormat(self.temp_dir.name, mode='r')
+        format.validate()
+
+    def test_spatial_neighbors_semantic_type_registration(self):
+        self.assertRegisteredSemanticType(SpatialNeighbors)
+
+    def test_spatial_neighbors_to_dir_fmt_registration(self):
+        self.assertSemanticTypeRegisteredToFormat(
+            SpatialNeighbors, SpatialNeighborsDirectoryFormat)
+
+    def test_spatial_neighbors_format_to_pd_dataframe(self):
+        _, obs = self.transform_format(
+            SpatialNeighborsFormat, pd.DataFrame, 'spatial_neighbors.tsv')
+        exp = pd.DataFrame(
+            {'sample_id': ['a', 'a', 'b', 'b', 'c', 'c'],
+             'neighbor_id': ['b', 'c', 'a', 'c', 'a', 'b'],
+             'distance': [0., 1520.25, 0., 1520.25, 1520.25, 1520.25]})
+        pdt.assert_frame_equal(obs, exp, check_dtype=False)
+
+    def test_pd_dataframe_to_spatial_neighbors_format(self):
+        transformer = self.get_transformer(
+            pd.DataFrame, SpatialNeighborsFormat)
+        exp = pd.DataFrame({'sample_id': ['a', 'b'],
+                            'neighbor_id': ['b', 'a'],
+                            'distance': [12.5, 12.5]})
+        obs = transformer(exp)
+        obs = pd.read_csv(str(obs), sep='\t', header=0)
+        pdt.assert_frame_equal(obs, exp)
+
+
+class TestSpatialIndexTypes(CoordinatesTestPluginBase):
+
+    def test_spatial_index_format_validate_positive(self):
+        filepath = self.get_data_path('spatial_index.npz')
+        format = SpatialIndexFormat(filepath, mode='r')
+        format.validate()
+
+    def test_spatial_index_format_validate_negative(self):
+        filepath = self.get_data_path('bad_spatial_index.npz')
+        format = SpatialIndexFormat(filepath, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'Missing arrays'):
+            format.validate()
+
+    def test_spatial_index_format_validate_not_npz(self):
+        filepath = self.get_data_path('spatial_neighbors.tsv')
+        format = SpatialIndexFormat(filepath, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'npz'):
+            format.validate()
+
+    def test_spatial_index_dir_fmt_validate_positive(self):
+        filepath = self.get_data_path('spatial_index.npz')
+        shutil.copy(filepath, self.temp_dir.name + '/index.npz')
+        format = SpatialIndexDirectoryFormat(self.temp_dir.name, mode='r')
+        format.validate()
+
+    def test_spatial_index_semantic_type_registration(self):
+        self.assertRegisteredSemanticType(SpatialIndex)
+
+    def test_spatial_index_to_dir_fmt_registration(self):
+        self.assertSemanticTypeRegisteredToFormat(
+            SpatialIndex, SpatialIndexDirectoryFormat)
+
+    def test_spatial_index_round_trip(self):
+        _, index = self.transform_format(
+            SpatialIndexFormat, QuadTreeIndex, 'spatial_index.npz')
+        self.assertEqual(len(index), 6)
+        self.assertEqual((index.x_coord, index.y_coord), ('x', 'y'))
+        transformer = self.get_transformer(QuadTreeIndex, SpatialIndexFormat)
+        obs = QuadTreeIndex.load(str(transformer(index)))
+        for name in QuadTreeIndex.ARRAYS:
+            np.testing.assert_array_equal(getattr(obs, name),
+                                          getattr(index, name))
+
+
+class TestBinStatisticsTypes(CoordinatesTestPluginBase):
+
+    def test_bin_statistics_format_validate_positive(self):
+        filepath = self.get_data_path('bin_statistics.tsv')
+        format = BinStatisticsFormat(filepath, mode='r')
+        format.validate()
+
+    def test_bin_statistics_format_validate_negative(self):
+        filepath = self.get_data_path('bad_bin_statistics.tsv')
+        format = BinStatisticsFormat(filepath, mode='r')
+        with self.assertRaisesRegex(ValidationError, 'integers'):
+            format.validate()
+
+    def test_bin_statistics_dir_fmt_validate_positive(self):
+        filepath = self.get_data_path('bin_statistics.tsv')
+        shutil.copy(filepath, self.temp_dir.name + '/bin-statistics.tsv')
+        format = BinStatisticsDirectoryFormat(self.temp_dir.name, mode='r')
+        format.validate()
+
+    def test_bin_statistics_semantic_type_registration(self):
+        self.assertRegisteredSemanticType(BinStatistics)
+
+    def test_bin_statistics_to_dir_fmt_registration(self):
+        self.assertSemanticTypeRegisteredToFormat(
+            BinStatistics, BinStatisticsDirectoryFormat)
+
+    def test_bin_statistics_format_to_pd_dataframe(self):
+        _, obs = self.transform_format(
+            BinStatisticsFormat, pd.DataFrame, 'bin_statistics.tsv')
+        self.assertEqual(obs.index.name, 'lineage')
+        self.assertEqual(list(obs.index[:3]), ['2.', '2.1.', '2.4.'])
+        self.assertEqual(list(obs['count'][:3]), [2, 1, 1])
+        self.assertEqual(obs.loc['3.', 'centroid-x'], 0.65)
+
+    def test_bin_statistics_format_to_metadata(self):
+        _, obs = self.transform_format(
+            BinStatisticsFormat, qiime2.Metadata, 'bin_statistics.tsv')
+        self.assertEqual(obs.id_count, 10)
+        self.assertEqual(
+            obs.get_column('mean-observed_features').to_series()['4.'],
+            84.5)
@@ -0,0 +1,242 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import numpy as np
+from geopy import distance
+from scipy.spatial.distance import pdist, squareform
+
+from q2_coordinates._distance import (
+    vincenty, great_circle, haversine, geodesic_pdist, geodesic_cdist,
+    deduplicated_pdist, paired_distances, max_relative_error, neighbor_pairs,
+    nearest_reference, anchor_points, _row_blocks, _row_offset,
+    _condensed_pairs)
+
+
+class TestGeodesicKernel(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.lat = rng.uniform(-90, 90, 200)
+        self.lon = rng.uniform(-180, 180, 200)
+
+    def test_vincenty_matches_geopy(self):
+        lat1, lat2 = self.lat[:100], self.lat[100:]
+        lon1, lon2 = self.lon[:100], self.lon[100:]
+        obs = vincenty(lat1, lon1, lat2, lon2)
+        exp = [distance.geodesic(a, b).meters
+               for a, b in zip(zip(lat1, lon1), zip(lat2, lon2))]
+        np.testing.assert_allclose(obs, exp, rtol=0, atol=1e-3)
+
+    def test_vincenty_edge_cases(self):
+        # coincident, equatorial, pole-to-pole, nearly antipodal (fallback)
+        lat1, lon1 = [10., 0., 90., 0.5], [20., 0., 0., 0.]
+        lat2, lon2 = [10., 0., -90., -0.5], [20., 10., 0., 179.7]
+        obs = vincenty(lat1, lon1, lat2, lon2)
+        exp = [distance.geodesic(a, b).meters
+               for a, b in zip(zip(lat1, lon1), zip(lat2, lon2))]
+        np.testing.assert_allclose(obs, exp, rtol=0, atol=1e-3)
+        self.assertEqual(obs[0], 0.)
+
+    def test_geodesic_pdist_condensed_order(self):
+        lat, lon = self.lat[:20], self.lon[:20]
+        obs = geodesic_pdist(lat, lon)
+        exp = [distance.geodesic((lat[i], lon[i]), (lat[j], lon[j])).meters
+               for i in range(20) for j in range(i + 1, 20)]
+        np.testing.assert_allclose(obs, exp, rtol=0, atol=1e-3)
+
+    def test_geodesic_pdist_block_size_invariant(self):
+        exp = geodesic_pdist(self.lat, self.lon)
+        for block_size in (1, 7, 1000):
+            obs = geodesic_pdist(self.lat, self.lon, block_size=block_size)
+            np.testing.assert_array_equal(obs, exp)
+
+    def test_geodesic_pdist_parallel_identical_to_serial(self):
+        exp = geodesic_pdist(self.lat, self.lon, block_size=500)
+        for n_jobs in (2, 3, 4):
+            obs = geodesic_pdist(
+                self.lat, self.lon, n_jobs=n_jobs, block_size=500)
+            np.testing.assert_array_equal(obs, exp)
+
+    def test_geodesic_pdist_parallel_scaling(self):
+        # more workers than blocks, and more blocks than workers
+        lat, lon = self.lat[:30], self.lon[:30]
+        exp = geodesic_pdist(lat, lon)
+        for n_jobs, block_size in ((8, 200), (2, 10), (2, 1)):
+            obs = geodesic_pdist(
+                lat, lon, n_jobs=n_jobs, block_size=block_size)
+            np.testing.assert_array_equal(obs, exp)
+
+    def test_spherical_metrics_match_geopy_great_circle(self):
+        lat1, lat2 = self.lat[:100], self.lat[100:]
+        lon1, lon2 = self.lon[:100], self.lon[100:]
+        exp = [distance.great_circle(a, b).meters
+               for a, b in zip(zip(lat1, lon1), zip(lat2, lon2))]
+        np.testing.assert_allclose(
+            great_circle(lat1, lon1, lat2, lon2), exp, rtol=1e-9)
+        np.testing.assert_allclose(
+            haversine(lat1, lon1, lat2, lon2), exp, rtol=1e-6)
+
+    def test_max_relative_error(self):
+        lat, lon = self.lat[:100], self.lon[:100]
+        exp = geodesic_pdist(lat, lon)
+        for metric in ('great-circle', 'haversine'):
+            obs = geodesic_pdist(lat, lon, metric=metric)
+            error, n_pairs = max_relative_error(lat, lon, obs)
+            self.assertEqual(n_pairs, obs.size)
+            self.assertAlmostEqual(
+                error, np.max(np.abs(obs - exp) / exp), places=12)
+            self.assertLess(error, 0.006)
+            # subsampled pairs
+            error_, n_pairs = max_relative_error(
+                lat, lon, obs, max_pairs=100)
+            self.assertEqual(n_pairs, 100)
+            self.assertLessEqual(error_, error)
+        error, _ = max_relative_error(lat, lon, exp)
+        self.assertLess(error, 1e-9)
+
+    def test_condensed_pairs(self):
+        n = 6
+        i, j = _condensed_pairs(np.arange(n * (n - 1) // 2), n)
+        exp_i, exp_j = np.triu_indices(n, k=1)
+        np.testing.assert_array_equal(i, exp_i)
+        np.testing.assert_array_equal(j, exp_j)
+
+    def test_geodesic_pdist_symmetric(self):
+        obs = geodesic_pdist(self.lat[:50], self.lon[:50])
+        rev = geodesic_pdist(self.lat[:50][::-1], self.lon[:50][::-1])
+        np.testing.assert_array_equal(
+            squareform(obs), squareform(rev)[::-1, ::-1])
+
+    def test_deduplicated_pdist_geodesic(self):
+        # 40 sites, 5 samples per site, in shuffled order
+        rng = np.random.RandomState(0)
+        sites = np.column_stack([self.lat[:40], self.lon[:40]])
+        coords = sites[rng.permutation(np.repeat(np.arange(40), 5))]
+
+        def geodesic(coords):
+            return geodesic_pdist(coords[:, 0], coords[:, 1])
+
+        exp = geodesic(coords)
+        for block_size in (2 ** 20, 100):
+            obs = deduplicated_pdist(coords, geodesic, block_size=block_size)
+            np.testing.assert_array_equal(obs, exp)
+
+    def test_deduplicated_pdist_euclidean(self):
+        coords = np.array([[0., 1., 2.], [3., 4., 5.], [0., 1., 2.],
+                           [1., 1., 1.], [3., 4., 5.]])
+        obs = deduplicated_pdist(coords, pdist)
+        np.testing.assert_array_equal(obs, pdist(coords))
+
+    def test_deduplicated_pdist_single_site(self):
+        coords = np.ones((4, 2))
+        obs = deduplicated_pdist(coords, pdist)
+        np.testing.assert_array_equal(obs, np.zeros(6))
+
+    def test_geodesic_cdist(self):
+        lat_a, lon_a = self.lat[:15], self.lon[:15]
+        lat_b, lon_b = self.lat[15:40], self.lon[15:40]
+        exp = squareform(geodesic_pdist(self.lat[:40], self.lon[:40]))
+        for block_size in (2 ** 20, 30, 1):
+            obs = geodesic_cdist(lat_a, lon_a, lat_b, lon_b,
+                                 block_size=block_size)
+            np.testing.assert_array_equal(obs, exp[:15, 15:])
+
+    def test_paired_distances(self):
+        exp = squareform(geodesic_pdist(self.lat[:10], self.lon[:10]))
+        obs = paired_distances(self.lat[:9], self.lon[:9],
+                               self.lat[1:10], self.lon[1:10])
+        np.testing.assert_array_equal(obs, np.diagonal(exp, offset=1))
+
+    def test_anchor_points(self):
+        # two samples per site, on the equator except for the last site
+        lat = [0., 0., 0., 0., 1., 1.]
+        lon = [0., 0., 2., 2., 1., 1.]
+        np.testing.assert_array_equal(anchor_points(lat, lon), [0, 2, 4])
+        np.testing.assert_array_equal(
+            anchor_points(lat[:4], lon[:4]), [0, 2])
+        np.testing.assert_array_equal(anchor_points(lat[:2], lon[:2]), [0])
+
+    def test_geodesic_pdist_invalid_metric(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown metric'):
+            geodesic_pdist([1., 0.], [0., 0.], metric='manhattan')
+
+    def test_geodesic_pdist_invalid_latitude(self):
+        with self.assertRaisesRegex(ValueError, 'Latitude must be'):
+            geodesic_pdist([91., 0.], [0., 0.])
+
+    def test_row_blocks_cover_condensed_vector(self):
+        n = 50
+        blocks = _row_blocks(n, block_size=100)
+        self.assertEqual(blocks[0][0], 0)
+        self.assertEqual(blocks[-1][1], n - 1)
+        for (_, stop), (start, _) in zip(blocks[:-1], blocks[1:]):
+            self.assertEqual(stop, start)
+        self.assertEqual(_row_offset(n - 1, n), n * (n - 1) // 2)
+        self.assertEqual(_row_blocks(1), [])
+
+
+class TestNeighborPairs(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        # include a site shared by three points
+        self.lat = np.concatenate([rng.uniform(-85, 85, 150), [10.] * 3])
+        self.lon = np.concatenate([rng.uniform(-180, 180, 150), [5.] * 3])
+        self.n = len(self.lat)
+
+    def brute_force(self, metric, k, radius):
+        dm = squareform(geodesic_pdist(self.lat, self.lon, metric=metric))
+        i, j, d = [], [], []
+        for a in range(self.n):
+            neighbors = sorted(
+                (dm[a, b], b) for b in range(self.n) if b != a)
+            if radius is not None:
+                neighbors = [(x, b) for x, b in neighbors if x <= radius]
+            if k is not None:
+                neighbors = neighbors[:k]
+            i.extend([a] * len(neighbors))
+            j.extend(b for _, b in neighbors)
+            d.extend(x for x, _ in neighbors)
+        return i, j, d
+
+    def test_neighbor_pairs_match_brute_force(self):
+        for metric in ('geodesic', 'haversine'):
+            for k, radius in ((5, None), (None, 2e6), (3, 1e6)):
+                obs = neighbor_pairs(self.lat, self.lon, k=k, radius=radius,
+                                     metric=metric)
+                exp = self.brute_force(metric, k, radius)
+                for o, e in zip(obs, exp):
+                    np.testing.assert_array_equal(o, e)
+
+    def test_neighbor_pairs_k_exceeds_n(self):
+        i, j, d = neighbor_pairs(self.lat[:5], self.lon[:5], k=10)
+        self.assertEqual(len(i), 20)
+        i, j, d = neighbor_pairs(self.lat[:1], self.lon[:1], k=10)
+        self.assertEqual(len(i), 0)
+
+    def test_nearest_reference_matches_brute_force(self):
+        lat_b = np.concatenate([self.lat[100:], [self.lat[0]]])
+        lon_b = np.concatenate([self.lon[100:], [self.lon[0]]])
+        for metric in ('geodesic', 'great-circle'):
+            dm = geodesic_cdist(self.lat[:100], self.lon[:100], lat_b, lon_b,
+                                metric=metric)
+            index, d = nearest_reference(self.lat[:100], self.lon[:100],
+                                         lat_b, lon_b, metric=metric)
+            np.testing.assert_array_equal(index, np.argmin(dm, axis=1))
+            np.testing.assert_array_equal(d, np.min(dm, axis=1))
+            self.assertEqual(d[0], 0.)
+
+    def test_neighbor_pairs_no_k_or_radius(self):
+        with self.assertRaisesRegex(ValueError, 'Either k or radius'):
+            neighbor_pairs(self.lat, self.lon)
+
+
+if __name__ == '__main__':
+    unittest.main()
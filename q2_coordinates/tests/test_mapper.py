@@ -10,6 +10,7 @@ from .test_coordinates import CoordinatesTestPluginBase
 from qiime2.plugins import coordinates
 import qiime2
 import numpy as np
+import pandas as pd
 from skbio import DistanceMatrix
 
 
@@ -46,6 +47,116 @@ class TestMapper(CoordinatesTestPluginBase):
         dm = dm.view(DistanceMatrix)
         np.testing.assert_array_almost_equal(dm.data, exp.data, decimal=3)
 
+    def test_geodesic_distance_spherical(self):
+        exp = qiime2.Artifact.load(self.get_data_path(
+            'geodesic_distance_matrix.qza')).view(DistanceMatrix)
+        for metric in ['great-circle', 'haversine']:
+            with self.assertWarnsRegex(UserWarning, 'Estimated maximum'):
+                dm, = coordinates.actions.geodesic_distance(
+                    metadata=self.sample_md, latitude='latitude',
+                    longitude='longitude', missing_data='error',
+                    metric=metric)
+            dm = dm.view(DistanceMatrix)
+            np.testing.assert_allclose(dm.data, exp.data, rtol=0.006)
+
+    def test_update_geodesic_distance(self):
+        exp, = coordinates.actions.geodesic_distance(
+            metadata=self.sample_md, latitude='latitude',
+            longitude='longitude', missing_data='error')
+        exp = exp.view(DistanceMatrix)
+        old_ids = exp.ids[:len(exp.ids) // 2]
+        old = qiime2.Artifact.import_data(
+            'DistanceMatrix', exp.filter(old_ids))
+        dm, = coordinates.actions.update_geodesic_distance(
+            distance_matrix=old, metadata=self.sample_md,
+            latitude='latitude', longitude='longitude',
+            missing_data='error')
+        dm = dm.view(DistanceMatrix)
+        self.assertEqual(dm.ids[:len(old_ids)], old_ids)
+        np.testing.assert_array_equal(dm.filter(exp.ids).data, exp.data)
+
+    def test_update_geodesic_distance_moved_samples(self):
+        dm, = coordinates.actions.geodesic_distance(
+            metadata=self.sample_md, latitude='latitude',
+            longitude='longitude', missing_data='error')
+        md = self.sample_md.to_dataframe()
+        md.loc[md.index[0], 'latitude'] += 0.1
+        with self.assertRaisesRegex(ValueError, 'do not match'):
+            coordinates.actions.update_geodesic_distance(
+                distance_matrix=dm, metadata=qiime2.Metadata(md),
+                latitude='latitude', longitude='longitude',
+                missing_data='error')
+
+    def test_update_geodesic_distance_mirrored_sample(self):
+        # sample b is mirrored across the great circle through its
+        # neighbors a and c, which leaves its distances to both unchanged
+        md = pd.DataFrame(
+            {'latitude': [0., 1., 2., -1.], 'longitude': [0., 1., 0., 0.5]},
+            index=pd.Index(['a', 'b', 'c', 'd'], name='sample-id'))
+        dm, = coordinates.actions.geodesic_distance(
+            metadata=qiime2.Metadata(md), latitude='latitude',
+            longitude='longitude', missing_data='error')
+        md.loc['b', 'longitude'] = -1.
+        with self.assertRaisesRegex(ValueError, 'do not match'):
+            coordinates.actions.update_geodesic_distance(
+                distance_matrix=dm, metadata=qiime2.Metadata(md),
+                latitude='latitude', longitude='longitude',
+                missing_data='error')
+
+    def test_geodesic_neighbors(self):
+        dm, = coordinates.actions.geodesic_distance(
+            metadata=self.sample_md, latitude='latitude',
+            longitude='longitude', missing_data='error')
+        dm = dm.view(DistanceMatrix)
+        neighbors, = coordinates.actions.geodesic_neighbors(
+            metadata=self.sample_md, latitude='latitude',
+            longitude='longitude', missing_data='error', k=3)
+        neighbors = neighbors.view(pd.DataFrame)
+        self.assertEqual(len(neighbors), 3 * len(dm.ids))
+        for sample_id, group in neighbors.groupby('sample_id'):
+            exp = np.sort(np.delete(dm[sample_id], dm.index(sample_id)))[:3]
+            np.testing.assert_allclose(group['distance'], exp)
+
+    def test_geodesic_neighbors_radius(self):
+        neighbors, = coordinates.actions.geodesic_neighbors(
+            metadata=self.sample_md, latitude='latitude',
+            longitude='longitude', missing_data='error', radius=1000.)
+        neighbors = neighbors.view(pd.DataFrame)
+        self.assertTrue((neighbors['distance'] <= 1000.).all())
+        self.assertTrue(
+            (neighbors['sample_id'] != neighbors['neighbor_id']).all())
+
+    def test_geodesic_neighbors_no_k_or_radius(self):
+        with self.assertRaisesRegex(ValueError, 'Either k or radius'):
+            coordinates.actions.geodesic_neighbors(
+                metadata=self.sample_md, latitude='latitude',
+                longitude='longitude', missing_data='error')
+
+    def test_geodesic_cross_distance(self):
+        dm, = coordinates.actions.geodesic_distance(
+            metadata=self.sample_md, latitude='latitude',
+            longitude='longitude', missing_data='error')
+        dm = dm.view(DistanceMatrix)
+        query_ids, reference_ids = dm.ids[:5], dm.ids[5:]
+        md = self.sample_md.to_dataframe()
+        query = qiime2.Metadata(md.loc[list(query_ids)])
+        reference = qiime2.Metadata(md.loc[list(reference_ids)])
+        distances, = coordinates.actions.geodesic_cross_distance(
+            query_metadata=query, reference_metadata=reference,
+            latitude='latitude', longitude='longitude', missing_data='error')
+        distances = distances.view(pd.DataFrame)
+        self.assertEqual(len(distances), len(query_ids) * len(reference_ids))
+        for _, (sample_id, neighbor_id, d) in distances.iterrows():
+            self.assertEqual(d, dm[sample_id, neighbor_id])
+        nearest, = coordinates.actions.geodesic_cross_distance(
+            query_metadata=query, reference_metadata=reference,
+            latitude='latitude', longitude='longitude', missing_data='error',
+            nearest=True)
+        nearest = nearest.view(pd.DataFrame)
+        self.assertEqual(list(nearest['sample_id']), list(query_ids))
+        exp = dm.filter(query_ids + reference_ids).data[:5, 5:].min(axis=1)
+        np.testing.assert_array_equal(nearest['distance'], exp)
+
     def test_draw_interactive_map_from_alpha_diversity_vector(self):
         coordinates.actions.draw_interactive_map(
             metadata=self.sample_md.merge(self.alpha.view(qiime2.Metadata)),
@@ -78,6 +189,29 @@ class TestCoordMethods(CoordinatesTestPluginBase):
                         1.37477271, 1.55563492, 0.57445626])
         np.testing.assert_allclose(dm, exp)
 
+    def test_euclidean_cross_distance(self):
+        dm, = coordinates.actions.euclidean_distance(
+            metadata=self.coord_md, x='x', y='y', z='z',
+            missing_data='error')
+        dm = dm.view(DistanceMatrix)
+        md = self.coord_md.to_dataframe()
+        query = qiime2.Metadata(md.iloc[:2])
+        reference = qiime2.Metadata(md.iloc[2:])
+        distances, = coordinates.actions.euclidean_cross_distance(
+            query_metadata=query, reference_metadata=reference,
+            x='x', y='y', z='z', missing_data='error')
+        distances = distances.view(pd.DataFrame)
+        np.testing.assert_allclose(distances['distance'],
+                                   dm.data[:2, 2:].ravel())
+        nearest, = coordinates.actions.euclidean_cross_distance(
+            query_metadata=query, reference_metadata=reference,
+            x='x', y='y', z='z', missing_data='error', nearest=True)
+        nearest = nearest.view(pd.DataFrame)
+        exp = [dm.ids[2 + i] for i in dm.data[:2, 2:].argmin(axis=1)]
+        self.assertEqual(list(nearest['neighbor_id']), exp)
+        np.testing.assert_allclose(nearest['distance'],
+                                   dm.data[:2, 2:].min(axis=1))
+
     def test_euclidean_distance_2d(self):
         dm, = coordinates.actions.euclidean_distance(
             metadata=self.coord_md, x='x', y='y', z=None,
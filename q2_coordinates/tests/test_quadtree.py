@@ -6,11 +6,12 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import numpy as np
 import pandas as pd
 import pandas.testing as pdt
 import skbio
 import q2_coordinates.qtrees as qtrees
-from io import StringIO
+from io import StringIO, BytesIO
 import unittest
 
 
@@ -219,6 +220,385 @@ class BasicTest(unittest.TestCase):
                                                index='SampleID')
         pdt.assert_frame_equal(samples_2, samples)
 
+    def test_subdivide_closed_quadrants(self):
+        # the center point lies on the edge of all four quadrants
+        x = np.array([0., 2., 1., 0., 2.])
+        y = np.array([0., 2., 1., 2., 0.])
+        points, depths, lineages = qtrees.subdivide(x, y, 2., 2., 3)
+        self.assertEqual(list(lineages),
+                         ['1.', '1.', '2.', '2.', '3.', '3.', '4.', '4.'])
+        np.testing.assert_array_equal(points, [2, 3, 1, 2, 0, 2, 2, 4])
+        np.testing.assert_array_equal(depths, [1] * 8)
+
+    def test_trees_correct_morton(self):
+        test_tree, test_samples = qtrees.get_results(
+            self.moved_df, 2, index='SampleID', method='morton')
+        pdt.assert_frame_equal(test_samples.sort_index(),
+                               self.correct_dataframe.sort_index())
+        self.assertEqual(test_tree.compare_rfd(self.correct_tree), 0.0)
+
+    def test_morton_half_open_quadrants(self):
+        # the center point belongs to the north-east quadrant only
+        x = np.array([0., 2., 1., 0., 2.])
+        y = np.array([0., 2., 1., 2., 0.])
+        points, depths, lineages = qtrees.morton_subdivide(x, y, 2., 2., 3)
+        self.assertEqual(list(lineages), ['1.', '2.', '2.', '3.', '4.'])
+        np.testing.assert_array_equal(points, [3, 1, 2, 0, 4])
+        np.testing.assert_array_equal(depths, [1] * 5)
+
+    def test_half_open_quadrants(self):
+        x = np.array([0., 2., 1., 0., 2.])
+        y = np.array([0., 2., 1., 2., 0.])
+        points, depths, lineages = qtrees.subdivide(x, y, 2., 2., 3,
+                                                    half_open=True)
+        self.assertEqual(list(lineages), ['1.', '2.', '2.', '3.', '4.'])
+        np.testing.assert_array_equal(points, [3, 1, 2, 0, 4])
+
+    def test_half_open_matches_morton(self):
+        boundary_df = pd.DataFrame(
+            [['test_1', 180, 90], ['test_2', 90, 90], ['test_3', 180, 45],
+             ['test_4', 180, 135], ['test_5', 360.0, 90.0],
+             ['test_6', 0., 0.]],
+            columns=['SampleID', 'longitude', 'latitude'])
+        boundary_df = boundary_df.set_index('SampleID')
+        tree, samples = qtrees.get_results(boundary_df, 2, index='SampleID',
+                                           half_open=True)
+        tree_m, samples_m = qtrees.get_results(boundary_df, 2,
+                                               index='SampleID',
+                                               method='morton')
+        pdt.assert_frame_equal(samples, samples_m)
+        self.assertEqual(tree.compare_rfd(tree_m), 0.0)
+        self.assertEqual(samples.loc['test_1', 'lineage'], '2.3.')
+
+    def test_half_open_matches_morton_on_grid(self):
+        # grid coordinates that are not powers of two put many samples on
+        # partition edges, where rounding must agree between both methods
+        for seed in range(20):
+            rng = np.random.RandomState(seed)
+            x, y = rng.randint(0, 33, (2, 200)) * 0.3
+            exp = qtrees.subdivide(x, y, x.max(), y.max(), 4,
+                                   half_open=True)
+            obs = qtrees.morton_subdivide(x, y, x.max(), y.max(), 4)
+            self.assertEqual(sorted(zip(obs[0].tolist(), obs[2])),
+                             sorted(zip(exp[0].tolist(), exp[2])))
+
+    def test_morton_codes_order(self):
+        # codes of the four quadrants sort as NW, NE, SW, SE
+        codes = qtrees.morton_codes([0., 1., 0., 1.], [1., 1., 0., 0.],
+                                    1., 1., bits=1)
+        np.testing.assert_array_equal(codes, [0, 1, 2, 3])
+
+    def test_multi_threshold(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(rng.uniform(0, 10, (200, 2)),
+                          columns=['longitude', 'latitude'],
+                          index=pd.Index(['s%d' % i for i in range(200)],
+                                         name='SampleID'))
+        for method in qtrees.METHODS:
+            trees, samples = qtrees.get_multi_results(
+                df, [20, 5, 50], index='SampleID', method=method)
+            self.assertEqual(list(samples.columns),
+                             ['lineage-5', 'lineage-20', 'lineage-50'])
+            for threshold, tree in zip([5, 20, 50], trees):
+                exp_tree, exp = qtrees.get_results(
+                    df, threshold, index='SampleID', method=method)
+                pdt.assert_series_equal(
+                    samples['lineage-%d' % threshold], exp['lineage'],
+                    check_names=False)
+                self.assertEqual(str(tree), str(exp_tree))
+
+    def test_insert_points(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(rng.randint(0, 9, (300, 2)).astype(float),
+                          columns=['longitude', 'latitude'],
+                          index=pd.Index(['s%03d' % i for i in range(300)],
+                                         name='SampleID'))
+        df.iloc[0] = [0., 0.]
+        df.iloc[1] = [8., 8.]
+        old, new = df.index[:250], df.index[250:]
+        for half_open in (False, True):
+            _, samples = qtrees.get_results(
+                df.loc[old], 5, index='SampleID', half_open=half_open)
+            tree, obs = qtrees.insert_points(
+                samples['lineage'], df, 5, 'SampleID', half_open=half_open)
+            exp_tree, exp = qtrees.get_results(
+                df, 5, index='SampleID', half_open=half_open)
+            pdt.assert_frame_equal(obs, exp)
+            self.assertEqual(str(tree), str(exp_tree))
+        # bins without new samples are unchanged
+        touched = set(obs.loc[new, 'lineage'])
+        untouched = [i for i in old if not any(
+            lin.startswith(samples.loc[i, 'lineage']) for lin in touched)]
+        self.assertGreater(len(untouched), 0)
+        pdt.assert_series_equal(obs.loc[untouched, 'lineage'],
+                                samples.loc[untouched, 'lineage'])
+
+    def test_insert_points_on_grid_edges(self):
+        # grid coordinates put many new samples on partition edges, whose
+        # rounding must agree with a full rebuild
+        rng = np.random.RandomState(5)
+        df = pd.DataFrame(rng.randint(0, 45, (300, 2)) * 0.1,
+                          columns=['longitude', 'latitude'],
+                          index=pd.Index(['s%03d' % i for i in range(300)],
+                                         name='SampleID'))
+        df.iloc[0] = [0., 0.]
+        df.iloc[1] = [4.4, 4.4]
+        for method, half_open in (('morton', True), ('quadtree', False)):
+            _, samples = qtrees.get_results(
+                df.iloc[:250], 4, index='SampleID', method=method,
+                half_open=half_open)
+            tree, obs = qtrees.insert_points(
+                samples['lineage'], df, 4, 'SampleID', half_open=half_open)
+            exp_tree, exp = qtrees.get_results(
+                df, 4, index='SampleID', method=method, half_open=half_open)
+            pdt.assert_frame_equal(obs, exp)
+            self.assertEqual(str(tree), str(exp_tree))
+
+    def test_insert_points_no_new_samples(self):
+        tree, samples = qtrees.get_results(self.moved_df, 2, index='SampleID')
+        obs_tree, obs = qtrees.insert_points(
+            samples['lineage'], self.moved_df, 2, 'SampleID')
+        pdt.assert_frame_equal(obs, samples)
+        self.assertEqual(str(obs_tree), str(tree))
+
+    def test_insert_points_outside(self):
+        _, samples = qtrees.get_results(self.moved_df, 2, index='SampleID')
+        df = self.moved_df.copy()
+        df.loc['test_id_new'] = [361., 0.]
+        with self.assertRaisesRegex(ValueError, 'test_id_new'):
+            qtrees.insert_points(samples['lineage'], df, 2, 'SampleID')
+
+    def test_subdivide_parallel_half_open_on_grid(self):
+        # samples on the outer edges of subtree roots, whose edges are
+        # rounded, stay in the subtrees
+        for seed in range(10):
+            rng = np.random.RandomState(seed)
+            x, y = rng.randint(0, 33, (2, 400)) * 0.1
+            exp = qtrees.subdivide(x, y, x.max(), y.max(), 4,
+                                   half_open=True)
+            obs = qtrees.subdivide(x, y, x.max(), y.max(), 4,
+                                   half_open=True, n_jobs=4)
+            for o, e in zip(obs, exp):
+                np.testing.assert_array_equal(o, e)
+
+    def test_subdivide_parallel_identical_to_serial(self):
+        rng = np.random.RandomState(0)
+        x, y, z = rng.randint(0, 20, (3, 2000)).astype(float)
+        for half_open in (False, True):
+            for kwargs in ({}, {'z': z, 'z_size': z.max()},
+                           {'max_depth': 4}):
+                exp = qtrees.subdivide(x, y, x.max(), y.max(), 5,
+                                       half_open=half_open, **kwargs)
+                for n_jobs in (2, 3):
+                    obs = qtrees.subdivide(x, y, x.max(), y.max(), 5,
+                                           half_open=half_open,
+                                           n_jobs=n_jobs, **kwargs)
+                    for o, e in zip(obs, exp):
+                        np.testing.assert_array_equal(o, e)
+
+    def test_octree(self):
+        corners = [[x, y, z] for x in (0., 1.) for y in (0., 1.)
+                   for z in (0., 1.)]
+        df = pd.DataFrame(corners, columns=['longitude', 'latitude', 'depth'],
+                          index=pd.Index(['c%d' % i for i in range(8)],
+                                         name='SampleID'))
+        tree, samples = qtrees.get_results(df, 2, index='SampleID')
+        self.assertEqual(samples.loc['c3', 'lineage'], '1.')
+        self.assertEqual(samples.loc['c6', 'lineage'], '6.')
+        self.assertEqual(sorted(samples['lineage']),
+                         ['%d.' % i for i in range(1, 9)])
+        self.assertEqual(len(tree.children), 8)
+
+    def test_octree_flat_matches_quadtree(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(rng.randint(0, 9, (200, 2)).astype(float),
+                          columns=['longitude', 'latitude'],
+                          index=pd.Index(['s%d' % i for i in range(200)],
+                                         name='SampleID'))
+        for half_open in (False, True):
+            _, exp = qtrees.get_results(df, 5, index='SampleID',
+                                        half_open=half_open)
+            _, obs = qtrees.get_results(df.assign(depth=0.), 5,
+                                        index='SampleID', half_open=half_open)
+            pdt.assert_frame_equal(obs, exp)
+
+    def test_octree_unknown_method(self):
+        df = self.moved_df.assign(depth=0.)
+        with self.assertRaisesRegex(ValueError, 'z coordinates'):
+            qtrees.get_results(df, 2, index='SampleID', method='morton')
+
+    def test_kdtree_balanced(self):
+        # samples along a transect, with a dense cluster at one end
+        rng = np.random.RandomState(0)
+        x = np.concatenate([rng.uniform(0, 1000, 24), rng.uniform(0, 1, 1000)])
+        y = rng.uniform(0, 1, x.size)
+        _, depths, _ = qtrees.subdivide(x, y, x.max(), y.max(), 8)
+        self.assertGreater(depths.max(), 10)
+        points, depths, lineages = qtrees.kdtree_subdivide(
+            x, y, x.max(), y.max(), 8)
+        # 1024 points are halved 8 times into bins of 4
+        self.assertEqual(depths.max(), 8)
+        leaves = lineages[depths == 8]
+        self.assertEqual(len(set(leaves)), 256)
+        self.assertEqual(pd.Series(leaves).value_counts().max(), 4)
+        # every point is in exactly one bin per level
+        self.assertEqual(len(points), 8 * x.size)
+
+    def test_kdtree_median_split(self):
+        x = np.array([0., 1., 2., 3., 4.])
+        y = np.array([4., 3., 2., 1., 0.])
+        points, depths, lineages = qtrees.kdtree_subdivide(
+            x, y, 4., 4., 3)
+        first = dict(zip(points[depths == 1], lineages[depths == 1]))
+        self.assertEqual(first, {0: '1.', 1: '1.', 2: '1.', 3: '2.',
+                                 4: '2.'})
+        # the first half is then divided along y
+        second = dict(zip(points[depths == 2], lineages[depths == 2]))
+        self.assertEqual(second, {2: '1.1.', 1: '1.1.', 0: '1.2.'})
+
+    def test_bin_statistics(self):
+        df = self.test_df.assign(value=[1., 2., 3., 4., 5., 6., 7., np.nan])
+        bins = qtrees._get_bins(self.moved_df, 2, 'SampleID', 'quadtree',
+                                None, None, False)
+        obs = qtrees.bin_statistics(bins, 'SampleID', df, 'longitude',
+                                    'latitude')
+        self.assertEqual(list(obs.index), sorted(set(bins['lineage'])))
+        self.assertEqual(list(obs['count']), [2, 1, 1] * 4)
+        # south-west: test_id_sw1 and test_id_sw2
+        exp = pd.Series({'depth': 1, 'count': 2, 'centroid-x': -135.5,
+                         'centroid-y': -67., 'min-x': -180., 'max-x': -91.,
+                         'min-y': -90., 'max-y': -44., 'mean-value': 3.},
+                        name='3.')
+        pdt.assert_series_equal(obs.loc['3.'], exp, check_dtype=False)
+        # missing values are ignored
+        self.assertEqual(obs.loc['4.', 'mean-value'], 4.)
+        self.assertTrue(np.isnan(obs.loc['4.2.', 'mean-value']))
+
+    def test_unknown_method(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown method'):
+            qtrees.get_results(self.moved_df, 2, index='SampleID',
+                               method='octree')
+
+    def test_colocated_points(self):
+        # co-located samples above the threshold are not divided further
+        coords = [['test_%d' % i, 10., 20.] for i in range(50)]
+        coords += [['test_50', 0., 0.], ['test_51', 40., 40.]]
+        df = pd.DataFrame(coords, columns=['SampleID', 'longitude',
+                                           'latitude']).set_index('SampleID')
+        tree, samples = qtrees.get_results(df, 3, index='SampleID')
+        self.assertEqual(samples.loc['test_0', 'lineage'], '3.1.')
+        colocated = ['test_%d' % i for i in range(50)]
+        self.assertEqual(samples.loc[colocated, 'lineage'].nunique(), 1)
+        self.assertEqual(samples.loc['test_50', 'lineage'], '3.3.')
+
+    def test_max_depth(self):
+        x, y = np.random.RandomState(0).uniform(0, 1, (2, 500))
+        for method in qtrees.METHODS:
+            _, depths, _ = qtrees.METHODS[method](x, y, 1., 1., 2)
+            self.assertGreater(depths.max(), 3)
+            _, depths, lineages = qtrees.METHODS[method](
+                x, y, 1., 1., 2, max_depth=3)
+            self.assertEqual(depths.max(), 3)
+            self.assertEqual(max(lin.count('.') for lin in lineages), 3)
+
+    def test_min_cell_size(self):
+        x, y = np.random.RandomState(0).uniform(0, 1, (2, 500))
+        for method in ('quadtree', 'morton'):
+            # cells of depth 3 are 0.125 wide
+            _, depths, _ = qtrees.METHODS[method](
+                x, y, 1., 1., 2, min_cell_size=0.1)
+            self.assertEqual(depths.max(), 3)
+        # k-d cells are divided at medians, so their sizes vary
+        _, full, _ = qtrees.kdtree_subdivide(x, y, 1., 1., 2)
+        _, depths, _ = qtrees.kdtree_subdivide(x, y, 1., 1., 2,
+                                               min_cell_size=0.25)
+        self.assertLess(depths.max(), full.max())
+
+    def test_deep_clustered_points(self):
+        # tightly clustered points need more levels than the recursion limit
+        x = np.concatenate([[0., 1.], 1e-300 * np.arange(3)])
+        y = np.concatenate([[0., 1.], 1e-300 * np.arange(3)])
+        _, depths, _ = qtrees.subdivide(x, y, 1., 1., 2)
+        self.assertGreater(depths.max(), 990)
+
+    def test_lineage_tree(self):
+        tree = qtrees.lineage_tree(['b', 'a', 'c', 'd'],
+                                   ['1.2.', '1.', '3.4.', '1.2.'])
+        self.assertEqual(
+            str(tree), '(((b:1.0,d:1.0)2:1.0,a:1.0)1:1.0,'
+                       '((c:1.0)4:1.0)3:1.0):1.0;\n')
+        self.assertEqual(tree.find('d').parent.parent.name, '1')
+
+
+class TestQuadTreeIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # clustered points with duplicates
+        self.x = np.concatenate([rng.normal(0, 10, 300), [5.] * 20])
+        self.y = np.concatenate([rng.exponential(3, 300), [1.] * 20])
+        self.ids = ['s%d' % i for i in range(320)]
+        self.index = qtrees.QuadTreeIndex.build(self.ids, self.x, self.y, 8)
+
+    def test_build_structure(self):
+        index = self.index
+        np.testing.assert_array_equal(np.sort(index.order), np.arange(320))
+        np.testing.assert_array_equal(index.x, self.x[index.order])
+        for node in range(len(index.start)):
+            x = index.x[index.start[node]:index.stop[node]]
+            self.assertEqual(index.bounds[node, 0], x.min())
+            self.assertEqual(index.bounds[node, 2], x.max())
+            children = range(index.first_child[node],
+                             index.first_child[node] + index.n_children[node])
+            if index.n_children[node]:
+                self.assertEqual(index.start[children[0]], index.start[node])
+                self.assertEqual(index.stop[children[-1]], index.stop[node])
+
+    def test_bounding_box(self):
+        for box in ((-5, 5, 0, 2), (5, 5, 1, 1), (100, 200, 0, 1)):
+            x0, x1, y0, y1 = box
+            exp = np.flatnonzero((self.x >= x0) & (self.x <= x1)
+                                 & (self.y >= y0) & (self.y <= y1))
+            np.testing.assert_array_equal(
+                self.index.bounding_box(*box), exp)
+
+    def brute_force(self, qx, qy, k, radius, exclude):
+        queries, positions, distances = [], [], []
+        for i, (x, y) in enumerate(zip(qx, qy)):
+            d = np.hypot(self.x - x, self.y - y)
+            candidates = sorted((d[j], j) for j in range(len(d))
+                                if j != exclude[i]
+                                and (radius is None or d[j] <= radius))
+            candidates = candidates[:k]
+            queries.extend([i] * len(candidates))
+            positions.extend(j for _, j in candidates)
+            distances.extend(d for d, _ in candidates)
+        return queries, positions, distances
+
+    def test_neighbors(self):
+        qx = np.concatenate([self.x[:10], [-100., 3.]])
+        qy = np.concatenate([self.y[:10], [50., 1.]])
+        exclude = np.concatenate([np.arange(10), [-1, -1]])
+        for k, radius in ((5, None), (None, 2.), (3, 1.), (500, None)):
+            obs = self.index.neighbors(qx, qy, k=k, radius=radius,
+                                       exclude=exclude, chunk_size=5)
+            exp = self.brute_force(qx, qy, k, radius, exclude)
+            for o, e in zip(obs, exp):
+                np.testing.assert_array_equal(o, e)
+
+    def test_neighbors_no_k_or_radius(self):
+        with self.assertRaisesRegex(ValueError, 'Either k or radius'):
+            self.index.neighbors([0.], [0.])
+
+    def test_save_load(self):
+        fh = BytesIO()
+        self.index.save(fh)
+        fh.seek(0)
+        obs = qtrees.QuadTreeIndex.load(fh)
+        for name in qtrees.QuadTreeIndex.ARRAYS:
+            np.testing.assert_array_equal(getattr(obs, name),
+                                          getattr(self.index, name))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -17,6 +17,7 @@ from qiime2.plugin import ValidationError
 import pandas as pd
 import pandas.testing as pdt
 import qiime2
+from qiime2.plugins import coordinates
 
 
 class QuadTreeTestPluginBase(TestPluginBase):
@@ -99,3 +100,98 @@ class TestSemanticTypeQuad(QuadTreeTestPluginBase):
         exp = pd.Series(['1', '1', '1', '1'],
                         name='split_depth_1', index=exp_index)
         pdt.assert_series_equal(exp, obs_category.to_series())
+
+
+class TestSpatialIndexActions(QuadTreeTestPluginBase):
+
+    def setUp(self):
+        super().setUp()
+        self.md = self.load_md('xyz-coordinates.tsv')
+        self.index, = coordinates.actions.build_spatial_index(
+            metadata=self.md, x_coord='x', y_coord='y', threshold=2)
+
+    def test_query_bounding_box(self):
+        obs, = coordinates.actions.query_bounding_box(
+            index=self.index, min_x=1., max_x=4.5, min_y=0.5, max_y=2.)
+        obs = obs.view(pd.DataFrame)
+        exp = self.md.to_dataframe().loc[['b', 'c', 'd'], ['x', 'y']]
+        pdt.assert_frame_equal(obs, exp, check_names=False)
+
+    def test_query_neighbors(self):
+        obs, = coordinates.actions.query_neighbors(
+            index=self.index, metadata=self.md, k=1)
+        obs = obs.view(pd.DataFrame)
+        self.assertEqual(list(obs['sample_id']), list('abcdef'))
+        self.assertEqual(list(obs['neighbor_id']), list('badcfe'))
+        self.assertAlmostEqual(obs['distance'][2],
+                               (0.4 ** 2 + 0.5 ** 2) ** 0.5)
+
+
+class TestInsertQuadTree(QuadTreeTestPluginBase):
+
+    def test_insert_quadtree(self):
+        md = self.load_md('xyz-coordinates.tsv')
+        old = qiime2.Metadata(md.to_dataframe().drop(['d', 'e']))
+        _, quadtree = coordinates.actions.quadtree(
+            metadata=old, x_coord='x', y_coord='y', threshold=2)
+        _, obs = coordinates.actions.insert_quadtree(
+            quadtree=quadtree, metadata=md, x_coord='x', y_coord='y',
+            threshold=2)
+        _, exp = coordinates.actions.quadtree(
+            metadata=md, x_coord='x', y_coord='y', threshold=2)
+        pdt.assert_series_equal(obs.view(pd.DataFrame)['lineage'],
+                                exp.view(pd.DataFrame)['lineage'])
+
+    def test_insert_quadtree_missing_coordinates(self):
+        md = self.load_md('xyz-coordinates.tsv')
+        _, quadtree = coordinates.actions.quadtree(
+            metadata=md, x_coord='x', y_coord='y', threshold=2)
+        old = qiime2.Metadata(md.to_dataframe().drop(['b']))
+        with self.assertRaisesRegex(ValueError, 'no coordinates.*b'):
+            coordinates.actions.insert_quadtree(
+                quadtree=quadtree, metadata=old, x_coord='x', y_coord='y',
+                threshold=2)
+
+    def test_insert_quadtree_octree_table(self):
+        md = self.load_md('xyz-coordinates.tsv')
+        _, octree = coordinates.actions.octree(
+            metadata=md, x_coord='x', y_coord='y', z_coord='z', threshold=2)
+        with self.assertRaisesRegex(ValueError, 'octree action'):
+            coordinates.actions.insert_quadtree(
+                quadtree=octree, metadata=md, x_coord='x', y_coord='y',
+                threshold=2)
+
+
+class TestOcTree(QuadTreeTestPluginBase):
+
+    def test_octree(self):
+        md = self.load_md('xyz-coordinates.tsv')
+        tree, table = coordinates.actions.octree(
+            metadata=md, x_coord='x', y_coord='y', z_coord='z', threshold=2)
+        table = table.view(pd.DataFrame)
+        self.assertEqual(list(table['lineage']),
+                         ['7.7.3.', '7.7.4.', '6.5.', '6.4.', '4.4.', '4.2.'])
+
+
+class TestQuadTreeStatistics(QuadTreeTestPluginBase):
+
+    def test_quadtree_statistics(self):
+        md = self.load_md('xyz-coordinates.tsv')
+        _, table, statistics = coordinates.actions.quadtree_statistics(
+            metadata=md, x_coord='x', y_coord='y', threshold=2,
+            columns=['observed_features'])
+        _, exp = coordinates.actions.quadtree(
+            metadata=md, x_coord='x', y_coord='y', threshold=2)
+        pdt.assert_frame_equal(table.view(pd.DataFrame),
+                               exp.view(pd.DataFrame))
+        obs = statistics.view(pd.DataFrame)
+        exp = pd.read_csv(self.get_data_path('bin_statistics.tsv'),
+                          sep='\t', index_col=0)
+        pdt.assert_frame_equal(obs, exp)
+
+    def test_quadtree_statistics_not_numeric(self):
+        md = self.load_md('chardonnay_sample_metadata.txt')
+        with self.assertRaisesRegex(ValueError, 'sample_type.*not numeric'):
+            coordinates.actions.quadtree_statistics(
+                metadata=md, x_coord='longitude', y_coord='latitude',
+                threshold=5, columns=['sample_type'])
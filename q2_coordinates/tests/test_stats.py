@@ -13,7 +13,9 @@ import pandas as pd
 import numpy as np
 from skbio import DistanceMatrix
 import pandas.util.testing as pdt
-from q2_coordinates.stats import autocorr_from_dm, match_ids
+from pysal.explore.esda import geary, moran
+from pysal.lib import weights as psw
+from q2_coordinates.stats import autocorr_from_dm, match_ids, distance_weights
 from q2_coordinates._utilities import _load_and_validate
 
 
@@ -39,7 +41,8 @@ class TestStats(CoordinatesTestPluginBase):
             intersect_ids=True,
             permutations=999,
             two_tailed=True,
-            transformation='R')
+            transformation='R',
+            random_seed=42)
 
     def test_autocorr_nonintersecting_ids_warning(self):
         with self.assertRaisesRegex(ValueError, "matrix are missing"):
@@ -78,6 +81,128 @@ class TestStats(CoordinatesTestPluginBase):
             two_tailed=True, transformation='R')
         pdt.assert_frame_equal(results, exp)
 
+    def test_autocorr_from_dm_permutations(self):
+        distance_matrix = self.dm.view(DistanceMatrix)
+        metadata, distance_matrix = match_ids(
+            self.alpha.to_series(), distance_matrix, intersect_ids=True)
+        exp, _ = autocorr_from_dm(
+            metadata, distance_matrix, permutations=999, two_tailed=True,
+            transformation='R', random_seed=42)
+        obs, _ = autocorr_from_dm(
+            metadata, distance_matrix, permutations=999, two_tailed=True,
+            transformation='R', random_seed=42)
+        pdt.assert_frame_equal(obs, exp)
+        obs, _ = autocorr_from_dm(
+            metadata, distance_matrix, permutations=999, two_tailed=True,
+            transformation='R', random_seed=42, n_jobs=2)
+        pdt.assert_frame_equal(obs, exp)
+        self.assertEqual(list(obs.index[4:]), [
+            'Permuted Avg Test Statistic', 'Z simulated', 'p simulated',
+            'Permutations used'])
+        self.assertTrue((obs.loc['Permutations used'] == 999).all())
+        self.assertTrue(((obs.iloc[6] > 0) & (obs.iloc[6] <= 0.5)).all())
+        self.assertAlmostEqual(
+            obs.loc['Permuted Avg Test Statistic', 'Moran\'s I'],
+            -1 / 11, places=1)
+
+    def test_autocorr_from_dm_adaptive(self):
+        distance_matrix = self.dm.view(DistanceMatrix)
+        metadata, distance_matrix = match_ids(
+            self.alpha.to_series(), distance_matrix, intersect_ids=True)
+        full, _ = autocorr_from_dm(
+            metadata, distance_matrix, permutations=9999, two_tailed=True,
+            transformation='R', kernel='inverse', random_seed=0)
+        obs, _ = autocorr_from_dm(
+            metadata, distance_matrix, permutations=9999, two_tailed=True,
+            transformation='R', kernel='inverse', random_seed=0,
+            adaptive=True, min_exceedances=20)
+        pdt.assert_frame_equal(obs.iloc[:4], full.iloc[:4])
+        used = obs.loc['Permutations used']
+        self.assertTrue((used == used.iloc[0]).all())
+        self.assertLess(used.iloc[0], 9999)
+        np.testing.assert_allclose(
+            obs.loc['p simulated'], full.loc['p simulated'], atol=0.15)
+
+    def test_autocorr_from_dm_sparse_weights(self):
+        distance_matrix = self.dm.view(DistanceMatrix)
+        metadata, distance_matrix = match_ids(
+            self.alpha.to_series(), distance_matrix, intersect_ids=True)
+        dense = distance_matrix.data
+        for k, radius in ((3, None), (None, np.median(dense)), (3, 1e5)):
+            results, weights = autocorr_from_dm(
+                metadata, distance_matrix, permutations=0, two_tailed=True,
+                transformation='B', k=k, radius=radius)
+            neighbors = weights.toarray() > 0
+            if k is not None:
+                self.assertTrue((neighbors.sum(axis=1) <= k).all())
+            if radius is not None:
+                self.assertTrue((dense[neighbors] <= radius).all())
+            self.assertFalse(np.diagonal(neighbors).any())
+
+    def test_distance_weights_all_neighbors(self):
+        distance_matrix = self.dm.view(DistanceMatrix)
+        weights = distance_weights(distance_matrix)
+        exp = psw.util.full2W(distance_matrix.data, ids=distance_matrix.ids)
+        np.testing.assert_array_equal(weights.toarray(),
+                                      exp.sparse.toarray())
+
+    def test_autocorr_from_dm_matches_esda(self):
+        distance_matrix = self.dm.view(DistanceMatrix)
+        metadata, distance_matrix = match_ids(
+            self.alpha.to_series(), distance_matrix, intersect_ids=True)
+        for transformation in ('R', 'B', 'D', 'V'):
+            for k in (None, 3):
+                results, _ = autocorr_from_dm(
+                    metadata, distance_matrix, permutations=0,
+                    two_tailed=True, transformation=transformation, k=k)
+                w = psw.WSP2W(psw.WSP(
+                    distance_weights(distance_matrix, k=k),
+                    id_order=list(distance_matrix.ids)))
+                mi = moran.Moran(metadata, w, permutations=0,
+                                 transformation=transformation)
+                gc = geary.Geary(metadata, w, permutations=0,
+                                 transformation=transformation)
+                np.testing.assert_allclose(
+                    results['Moran\'s I'],
+                    [mi.I, mi.EI, mi.z_norm, mi.p_norm], rtol=1e-10)
+                np.testing.assert_allclose(
+                    results['Geary\'s C'],
+                    [gc.C, gc.EC, gc.z_norm, gc.p_norm], rtol=1e-10)
+
+    def test_autocorr_sparse_weights(self):
+        coordinates.actions.autocorr(
+            distance_matrix=self.dm,
+            metadata=self.alpha,
+            intersect_ids=True,
+            permutations=99,
+            k=3)
+
+    def test_autocorr_kernel(self):
+        coordinates.actions.autocorr(
+            distance_matrix=self.dm,
+            metadata=self.alpha,
+            intersect_ids=True,
+            permutations=99,
+            kernel='gaussian',
+            bandwidth=10000.)
+
+    def test_autocorr_kernel_no_bandwidth(self):
+        with self.assertRaisesRegex(ValueError, 'bandwidth must be defined'):
+            coordinates.actions.autocorr(
+                distance_matrix=self.dm,
+                metadata=self.alpha,
+                intersect_ids=True,
+                kernel='exponential')
+
+    def test_autocorr_no_neighbors(self):
+        with self.assertRaisesRegex(ValueError, 'No samples have neighbors.*'
+                                                'radius=1.0'):
+            coordinates.actions.autocorr(
+                distance_matrix=self.dm,
+                metadata=self.alpha,
+                intersect_ids=True,
+                radius=1.)
+
 
 class TestUtilities(CoordinatesTestPluginBase):
 